@@ -25,20 +25,38 @@ __version__ = '1.5.0'
 
 # Used by mkinit to expose the following modules an all fels attributes.
 __submodules__ = {
+    'cache': [],
+    'columnar': [],
+    'download': [],
     'fels': None,
+    'footprints': [],
     'landsat': [],
+    'ledger': [],
     'utils': [],
     'sentinel2': [],
+    'server': [],
+    'verify': [],
 }
 
 
+from . import cache
+from . import columnar
+from . import download
 from . import fels
+from . import footprints
 from . import landsat
+from . import ledger
 from . import sentinel2
+from . import server
 from . import utils
+from . import verify
 
-from .fels import (convert_wkt_to_scene, get_parser, main, normalize_satcode,
-                   run_fels,)
+from .fels import (convert_aois_to_scenes, convert_wkt_to_scene, cover_report,
+                   find_covering_scenes, get_parser, main, normalize_satcode,
+                   read_aois, run_fels,)
 
-__all__ = ['convert_wkt_to_scene', 'fels', 'get_parser', 'landsat', 'main',
-           'normalize_satcode', 'run_fels', 'sentinel2', 'utils']
+__all__ = ['cache', 'columnar', 'convert_aois_to_scenes',
+           'convert_wkt_to_scene', 'cover_report', 'download', 'fels',
+           'find_covering_scenes', 'footprints', 'get_parser', 'landsat',
+           'ledger', 'main', 'normalize_satcode', 'read_aois', 'run_fels',
+           'sentinel2', 'server', 'utils', 'verify']
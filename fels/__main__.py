@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
+import sys
 from fels.fels import main
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+A persistent cache of small metadata files, such as the ``manifest.safe``
+and ``INSPIRE.xml`` of Sentinel-2 products and the ``MTL.txt`` and
+``ANG.txt`` of Landsat scenes.
+
+The files are stored by url in a sqlite database in the fels cache
+directory. Entries checked within :data:`METADATA_CACHE_MAX_AGE` are used
+without any request. Older entries are revalidated with their ETag, which
+costs a request but no transfer if the file did not change. The least
+recently used entries are evicted when the cache grows over
+:data:`METADATA_CACHE_MAX_BYTES`.
+"""
+from __future__ import absolute_import, division, print_function
+import atexit
+import os
+import sqlite3
+import threading
+import time
+import ubelt
+try:
+    from urllib2 import urlopen, Request, HTTPError
+    from httplib import IncompleteRead
+except ImportError:
+    from urllib.request import urlopen, Request, HTTPError
+    from http.client import IncompleteRead
+
+from fels.download import DEFAULT_RETRY_POLICY, DOWNLOAD_TIMEOUT, PART_SUFFIX
+from fels.utils import FELS_DEFAULT_OUTPUTDIR
+
+
+# Directory of the cache database
+METADATA_CACHE_DPATH = os.environ.get('FELS_METADATA_CACHE_DPATH',
+                                      FELS_DEFAULT_OUTPUTDIR)
+
+METADATA_CACHE_FNAME = 'metadata_cache.sqlite'
+
+# Total size of the cached files before the least recently used are evicted
+METADATA_CACHE_MAX_BYTES = 2 ** 26
+
+# Larger files are not cached
+METADATA_CACHE_MAX_FILE_BYTES = 2 ** 21
+
+# Seconds an entry is used without asking the server if it changed. The
+# public Landsat and Sentinel-2 objects do not change once published.
+METADATA_CACHE_MAX_AGE = 30 * 24 * 3600
+
+# Endings of the urls of the files that are cached by the downloads
+METADATA_URL_SUFFIXES = ('/manifest.safe', '/INSPIRE.xml', '_MTL.txt',
+                         '_ANG.txt')
+
+METADATA_CACHE_CREATE_CMD = ubelt.codeblock(
+    '''
+    CREATE TABLE IF NOT EXISTS entries (
+        url TEXT PRIMARY KEY,
+        etag TEXT,
+        size INTEGER NOT NULL,
+        data BLOB NOT NULL,
+        validated REAL NOT NULL,
+        last_used REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+    ''')
+
+_CACHE_CONNECTIONS = {}
+_CACHE_LOCK = threading.RLock()
+
+
+def is_metadata_url(url):
+    """
+    Check if the downloads take a file from the metadata cache.
+
+    Example:
+        >>> from fels.cache import *  # NOQA
+        >>> is_metadata_url('http://host/LC08_L1TP_034032_20170301_20170316_01_T1_MTL.txt')
+        True
+        >>> is_metadata_url('http://host/LC08_L1TP_034032_20170301_20170316_01_T1_B1.TIF')
+        False
+    """
+    return url.endswith(METADATA_URL_SUFFIXES)
+
+
+def fetch_cached(url, max_age=None, timeout=DOWNLOAD_TIMEOUT, retry=None,
+                 cache_dpath=None):
+    """
+    Read a small remote file through the metadata cache.
+
+    Args:
+        url (str): the http url of the file
+        max_age (float | None): seconds since the last check of a cached
+            copy after which the server is asked if it changed. Defaults to
+            :data:`METADATA_CACHE_MAX_AGE`.
+        timeout (float): socket timeout in seconds
+        retry (RetryPolicy | None): how failed attempts are retried.
+            Defaults to :data:`fels.download.DEFAULT_RETRY_POLICY`.
+        cache_dpath (str | None): directory of the cache. Defaults to
+            :data:`METADATA_CACHE_DPATH`.
+
+    Returns:
+        bytes: the content of the file
+    """
+    if max_age is None:
+        max_age = METADATA_CACHE_MAX_AGE
+    if retry is None:
+        retry = DEFAULT_RETRY_POLICY
+    conn = _connect_cache(cache_dpath)
+    now = time.time()
+    with _CACHE_LOCK:
+        row = conn.execute(
+            'SELECT etag, data, validated FROM entries WHERE url = ?',
+            (url,)).fetchone()
+    if row is not None and now - row[2] < max_age:
+        with _CACHE_LOCK:
+            conn.execute('UPDATE entries SET last_used = ? WHERE url = ?',
+                         (now, url))
+        return bytes(row[1])
+
+    etag = None if row is None else row[0]
+
+    def _attempt():
+        request = Request(url)
+        if etag is not None:
+            request.add_header('If-None-Match', etag)
+        try:
+            with urlopen(request, timeout=timeout) as content:
+                data = content.read()
+                length = content.headers.get('Content-Length')
+                new_etag = content.headers.get('ETag')
+        except HTTPError as error:
+            if error.code == 304 and etag is not None:
+                return None, etag
+            raise
+        if length is not None and len(data) < int(length):
+            raise IncompleteRead(data, int(length) - len(data))
+        return data, new_etag
+
+    data, new_etag = retry.call(_attempt, desc=url)
+    if data is None:
+        # Not modified
+        data = bytes(row[1])
+    with _CACHE_LOCK:
+        if len(data) <= METADATA_CACHE_MAX_FILE_BYTES:
+            conn.execute(
+                'INSERT OR REPLACE INTO entries '
+                '(url, etag, size, data, validated, last_used) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (url, new_etag, len(data), sqlite3.Binary(data), now, now))
+            _evict(conn, METADATA_CACHE_MAX_BYTES)
+    return data
+
+
+def download_cached(url, target_file, **kwargs):
+    """
+    Write a small remote file to disk through the metadata cache.
+
+    Like :func:`fels.download.download_file`, the file only gets its name
+    once it is complete.
+
+    Args:
+        url (str): the http url of the file
+        target_file (str): where to write it
+        **kwargs: see :func:`fetch_cached`
+    """
+    data = fetch_cached(url, **kwargs)
+    part_file = target_file + PART_SUFFIX
+    with open(part_file, 'wb') as file:
+        file.write(data)
+    os.replace(part_file, target_file)
+
+
+def clear_metadata_cache(cache_dpath=None):
+    """
+    Remove all entries of the metadata cache.
+    """
+    with _CACHE_LOCK:
+        _connect_cache(cache_dpath).execute('DELETE FROM entries')
+
+
+def _evict(conn, max_bytes):
+    # Remove the least recently used entries until the rest fits
+    total, = conn.execute('SELECT coalesce(sum(size), 0) FROM entries').fetchone()
+    if total <= max_bytes:
+        return
+    urls = []
+    for url, size in conn.execute(
+            'SELECT url, size FROM entries ORDER BY last_used').fetchall():
+        urls.append((url,))
+        total -= size
+        if total <= max_bytes:
+            break
+    conn.executemany('DELETE FROM entries WHERE url = ?', urls)
+
+
+def _connect_cache(cache_dpath=None):
+    if cache_dpath is None:
+        cache_dpath = METADATA_CACHE_DPATH
+    fpath = os.path.abspath(os.path.join(cache_dpath, METADATA_CACHE_FNAME))
+    with _CACHE_LOCK:
+        conn = _CACHE_CONNECTIONS.get(fpath)
+        if conn is None:
+            os.makedirs(cache_dpath, exist_ok=True)
+            conn = sqlite3.connect(fpath, timeout=30, isolation_level=None,
+                                   check_same_thread=False)
+            conn.executescript(METADATA_CACHE_CREATE_CMD)
+            _CACHE_CONNECTIONS[fpath] = conn
+    return conn
+
+
+@atexit.register
+def _close_caches():
+    with _CACHE_LOCK:
+        for conn in _CACHE_CONNECTIONS.values():
+            conn.close()
+        _CACHE_CONNECTIONS.clear()
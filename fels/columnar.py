@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+"""
+A columnar, memory-mapped cache of the catalogue csv files.
+
+Each selected csv column is stored as a compact typed array in its own
+``.npy`` file: scene identifiers as small integer codes, acquisition dates as
+int32 days since 1970-01-01, cloud cover as float32 and urls as offsets into
+a single string heap. The rows are sorted by the scene keys and date, so a
+query is a binary search for the scene followed by vectorized filtering of
+the matching slice.
+
+The arrays are opened with memory mapping, so opening a catalogue does not
+read or build anything in Python, and processes on the same machine share
+the pages through the OS page cache.
+"""
+from __future__ import absolute_import, division, print_function
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import time
+from fels.utils import (
+    CACHE_DATE_FIELD, _catalog_basepath, catalog_dates, iter_catalog_chunks)
+
+
+# Version of the on-disk layout of the columnar caches
+COLUMNAR_CACHE_VERSION = 'v001'
+
+GLOBAL_COLUMNAR_CATALOGS = {}
+
+_EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+# The dtype stored for each kind of column
+_COLUMN_KINDS = {
+    'code': 'uint16',
+    'uint8': 'uint8',
+    'date': 'int32',
+    'float32': 'float32',
+}
+
+
+def isodate_to_days(date):
+    """
+    Convert a date to the number of days since 1970-01-01 used by the
+    columnar caches.
+
+    Args:
+        date (str | datetime.date | datetime.datetime): an ISO date or datetime
+
+    Example:
+        >>> from fels.columnar import *  # NOQA
+        >>> isodate_to_days('1970-01-02T10:24:02.026Z')
+        1
+        >>> isodate_to_days(datetime.date(2016, 1, 2))
+        16802
+    """
+    if isinstance(date, datetime.date):
+        date = date.isoformat()
+    day = datetime.date(int(date[0:4]), int(date[5:7]), int(date[8:10]))
+    return day.toordinal() - _EPOCH_ORDINAL
+
+
+class ColumnarCatalog(object):
+    """
+    Read-only access to a columnar catalogue cache.
+
+    Args:
+        dpath (str): directory written by :func:`build_columnar_catalog`
+
+    Example:
+        >>> import ubelt
+        >>> from fels.columnar import *  # NOQA
+        >>> dpath = ubelt.ensure_app_cache_dir('fels', 'tests', 'columnar')
+        >>> fpath = os.path.join(dpath, 'demo_index.csv')
+        >>> with open(fpath, 'w') as file:
+        >>>     _ = file.write('TILE,DATE,CC,URL\\n')
+        >>>     _ = file.write('B,2017-01-02,10.5,gs://b1\\n')
+        >>>     _ = file.write('A,2017-01-01,3,gs://a1\\n')
+        >>>     _ = file.write('B,2016-12-31,80,gs://b2\\n')
+        >>> columns = {
+        >>>     'TILE': ('TILE', 'code'),
+        >>>     'ACQ_DATE': ('DATE', 'date'),
+        >>>     'CLOUD_COVER': ('CC', 'float32'),
+        >>>     'BASE_URL': ('URL', 'string'),
+        >>> }
+        >>> catalog = ensure_columnar_catalog(fpath, columns, ['TILE', 'ACQ_DATE'])
+        >>> catalog.num_rows
+        3
+        >>> catalog.search({'TILE': 'B'}, '2016-01-01', '2018-01-01', 100)
+        ['gs://b2', 'gs://b1']
+        >>> catalog.search({'TILE': 'B'}, '2016-01-01', '2018-01-01', 50)
+        ['gs://b1']
+        >>> catalog.search({'TILE': 'C'}, '2016-01-01', '2018-01-01', 100)
+        []
+    """
+
+    def __init__(self, dpath):
+        self.dpath = dpath
+        with open(os.path.join(dpath, 'meta.json'), 'r') as file:
+            self.meta = json.load(file)
+        self.num_rows = self.meta['num_rows']
+        self.sort_keys = self.meta['sort_keys']
+        self._vocabs = {
+            name: {value: code for code, value in enumerate(vocab)}
+            for name, vocab in self.meta['vocabs'].items()}
+        self._columns = {}
+
+    def column(self, name):
+        """
+        The memory-mapped array of a column.
+        """
+        import numpy as np
+        if name not in self._columns:
+            fpath = os.path.join(self.dpath, name + '.npy')
+            self._columns[name] = np.load(fpath, mmap_mode='r')
+        return self._columns[name]
+
+    def encode(self, name, value):
+        """
+        The stored representation of a value of a column, or None if a coded
+        column never has this value.
+        """
+        if name in self._vocabs:
+            return self._vocabs[name].get(value, None)
+        return value
+
+    def strings(self, name, indexes):
+        """
+        Decode the values of a string column at the given row indexes.
+        """
+        heap = self.column(name + '.heap')
+        starts = self.column(name + '.start')
+        lengths = self.column(name + '.length')
+        return [
+            heap[start:start + length].tobytes().decode('utf8')
+            for start, length in zip(starts[indexes].tolist(),
+                                     lengths[indexes].tolist())]
+
+    def key_range(self, keys):
+        """
+        Use binary search on the sorted leading key columns to find the
+        range of rows that can match the encoded ``keys``.
+        """
+        import numpy as np
+        lo, hi = 0, self.num_rows
+        for name in self.sort_keys:
+            if name not in keys:
+                break
+            values = self.column(name)[lo:hi]
+            start = int(np.searchsorted(values, keys[name], side='left'))
+            stop = int(np.searchsorted(values, keys[name], side='right'))
+            lo, hi = lo + start, lo + stop
+        return lo, hi
+
+    def search(self, keys, date_start, date_end, cc_limit, latest=False,
+               column='BASE_URL'):
+        """
+        Find the rows with the given key values, a date within the
+        (inclusive) date range and a cloud cover at most ``cc_limit``.
+
+        Results are sorted by increasing date and same-day results by
+        decreasing cloud cover, like the sqlite caches.
+
+        Args:
+            keys (Dict[str, object]): decoded values of key columns
+            date_start (str | datetime.date): first date
+            date_end (str | datetime.date): last date
+            cc_limit (float): maximum cloud cover
+            latest (bool): only return the last result
+            column (str): the string column to return
+
+        Returns:
+            List[str]: the value of ``column`` for each matching row
+        """
+        import numpy as np
+        encoded = {}
+        for name, value in keys.items():
+            encoded[name] = self.encode(name, value)
+            if encoded[name] is None:
+                return []
+        lo, hi = self.key_range(encoded)
+        dates = self.column(CACHE_DATE_FIELD)[lo:hi]
+        cloud_cover = self.column('CLOUD_COVER')[lo:hi]
+        mask = ((dates >= isodate_to_days(date_start)) &
+                (dates <= isodate_to_days(date_end)) &
+                (cloud_cover <= np.float32(cc_limit)))
+        for name, value in encoded.items():
+            # Also covers keys that are not a prefix of the sort order
+            mask &= (self.column(name)[lo:hi] == value)
+        found = np.nonzero(mask)[0]
+        order = np.lexsort((-cloud_cover[found], dates[found]))
+        indexes = lo + found[order]
+        if latest:
+            indexes = indexes[-1:]
+        return self.strings(column, indexes)
+
+
+def ensure_columnar_catalog(collection_file, columns, sort_keys):
+    """
+    Returns a :class:`ColumnarCatalog` for a csv file, (re)building the
+    cache if it does not exist or the csv file has changed.
+
+    Args:
+        collection_file (str): path to the csv or csv.gz catalogue
+        columns (Dict[str, Tuple[str, str]]): maps the name of each cached
+            column to the csv field it is read from and its kind, which is
+            one of 'code' (a string stored as a uint16 code), 'uint8',
+            'date' (int32 days since 1970-01-01), 'float32' or 'string'.
+        sort_keys (List[str]): columns the rows are sorted by
+
+    Returns:
+        ColumnarCatalog
+    """
+    dpath = (_catalog_basepath(collection_file) + '.' +
+             COLUMNAR_CACHE_VERSION + '.columnar')
+    col_stat = os.stat(collection_file)
+    source = {'size': col_stat.st_size, 'mtime': col_stat.st_mtime,
+              'columns': columns, 'sort_keys': sort_keys}
+    # Normalize to the form that is read back from the meta file
+    source = json.loads(json.dumps(source))
+    catalog = GLOBAL_COLUMNAR_CATALOGS.get(dpath, None)
+    if catalog is None or catalog.meta['source'] != source:
+        catalog = None
+        meta_fpath = os.path.join(dpath, 'meta.json')
+        if os.path.exists(meta_fpath):
+            with open(meta_fpath, 'r') as file:
+                if json.load(file)['source'] == source:
+                    catalog = ColumnarCatalog(dpath)
+        if catalog is None:
+            print('Computing (or recomputing) a columnar cache')
+            build_columnar_catalog(collection_file, dpath, columns,
+                                   sort_keys, source)
+            catalog = ColumnarCatalog(dpath)
+        GLOBAL_COLUMNAR_CATALOGS[dpath] = catalog
+    return catalog
+
+
+def build_columnar_catalog(collection_file, dpath, columns, sort_keys,
+                           source=None):
+    """
+    Read the csv once and write the columnar cache to ``dpath``.
+
+    The csv is parsed in chunks with pandas (see
+    :func:`fels.utils.iter_catalog_chunks`) and each column of a chunk is
+    converted with vectorized operations. Rows with an empty or unparsable
+    value in one of the columns are skipped.
+
+    The cache is written to a temporary directory of its own, which
+    replaces ``dpath`` when complete, so concurrent builds do not mix their
+    files. Processes that still have the old arrays mapped keep reading them
+    until they re-open the catalogue.
+    """
+    import numpy as np
+    import pandas as pd
+    start_time = time.perf_counter()
+    parts = {name: [] for name in columns}
+    vocabs = {name: {} for name, (_, kind) in columns.items()
+              if kind == 'code'}
+    fields = sorted({field for field, _ in columns.values()})
+    num_rows = 0
+    for chunk in iter_catalog_chunks(collection_file,
+                                     {field: str for field in fields},
+                                     desc='build columnar cache'):
+        chunk = chunk[(chunk != '').all(axis=1).values]
+        converted = {}
+        valid = np.ones(len(chunk), dtype=bool)
+        for name, (field, kind) in columns.items():
+            if kind == 'date':
+                days = catalog_dates(chunk[field].values)
+                valid &= ~np.isnat(days)
+                converted[name] = days.astype(np.int64)
+            elif kind in ('uint8', 'float32'):
+                numbers = pd.to_numeric(chunk[field], errors='coerce').values
+                valid &= ~np.isnan(numbers)
+                converted[name] = numbers
+        chunk = chunk[valid]
+        for name, (field, kind) in columns.items():
+            values = chunk[field]
+            if kind == 'string':
+                encoded = values.str.encode('utf8')
+                parts[name].append((b''.join(encoded.values),
+                                    encoded.str.len().values.astype(np.int32)))
+            elif kind == 'code':
+                codes, uniques = pd.factorize(values)
+                vocab = vocabs[name]
+                # Map the codes of the chunk to the codes of the catalogue
+                remap = np.array([vocab.setdefault(value, len(vocab))
+                                  for value in uniques], dtype=np.int64)
+                parts[name].append(
+                    remap[codes].astype(_COLUMN_KINDS[kind]))
+            else:
+                parts[name].append(
+                    converted[name][valid].astype(_COLUMN_KINDS[kind]))
+        num_rows += len(chunk)
+
+    arrays = {}
+    heaps = {}
+    vocab_lists = {}
+    for name, (_, kind) in columns.items():
+        if kind == 'string':
+            heaps[name] = b''.join(heap for heap, _ in parts[name])
+            lengths = np.concatenate(
+                [np.zeros(0, dtype=np.int32)] +
+                [lengths for _, lengths in parts[name]])
+            starts = np.zeros(len(lengths), dtype=np.int64)
+            np.cumsum(lengths[:-1], out=starts[1:])
+            arrays[name + '.start'] = starts
+            arrays[name + '.length'] = lengths
+            continue
+        dtype = _COLUMN_KINDS[kind]
+        values = np.concatenate([np.zeros(0, dtype=dtype)] + parts[name])
+        if kind == 'code':
+            vocab = vocabs[name]
+            if len(vocab) > np.iinfo(values.dtype).max + 1:
+                raise ValueError('Too many distinct values in {}'.format(name))
+            # Re-number the codes so they sort like the strings they encode
+            vocab = sorted(vocab, key=vocab.__getitem__)
+            order = sorted(range(len(vocab)), key=vocab.__getitem__)
+            remap = np.empty(len(vocab), dtype=values.dtype)
+            remap[order] = np.arange(len(vocab), dtype=values.dtype)
+            values = remap[values]
+            vocab_lists[name] = [vocab[idx] for idx in order]
+        arrays[name] = values
+
+    # Sort the rows by the keys so queries can use binary search
+    order = np.lexsort([arrays[name] for name in sort_keys[::-1]])
+
+    parent, fname = os.path.split(os.path.abspath(dpath))
+    tmp_dpath = tempfile.mkdtemp(dir=parent, prefix=fname + '.tmp')
+    for name, values in arrays.items():
+        np.save(os.path.join(tmp_dpath, name + '.npy'), values[order])
+    for name, heap in heaps.items():
+        np.save(os.path.join(tmp_dpath, name + '.heap.npy'),
+                np.frombuffer(heap, dtype=np.uint8))
+    meta = {
+        'version': COLUMNAR_CACHE_VERSION,
+        'num_rows': num_rows,
+        'sort_keys': sort_keys,
+        'vocabs': vocab_lists,
+        'source': source,
+    }
+    with open(os.path.join(tmp_dpath, 'meta.json'), 'w') as file:
+        json.dump(meta, file)
+
+    old_dpath = tmp_dpath + '.old'
+    try:
+        os.rename(dpath, old_dpath)
+    except FileNotFoundError:
+        pass
+    try:
+        os.rename(tmp_dpath, dpath)
+    except OSError:
+        # Another process put its build in place first
+        shutil.rmtree(tmp_dpath)
+    if os.path.exists(old_dpath):
+        shutil.rmtree(old_dpath)
+    elapsed = time.perf_counter() - start_time
+    print('Wrote {} rows to the columnar cache in {:.2f}s'.format(
+        num_rows, elapsed))
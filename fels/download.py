@@ -0,0 +1,466 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers to download the files of a product, possibly concurrently.
+"""
+from __future__ import absolute_import, division, print_function
+import collections
+import os
+import random
+import re
+import shutil
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+try:
+    from urllib2 import urlopen, Request
+    from urllib2 import HTTPError
+    from urllib2 import URLError
+    from urlparse import urlparse
+    from httplib import IncompleteRead
+except ImportError:
+    from urllib.request import urlopen, Request, HTTPError, URLError
+    from urllib.parse import urlparse
+    from http.client import IncompleteRead
+
+from fels.verify import ChecksumError, check_file, expected_from_headers
+
+
+# Timeout in seconds of a single blocking network operation
+DOWNLOAD_TIMEOUT = 600
+
+# Suffix of files that are still being downloaded
+PART_SUFFIX = '.part'
+
+# Suffix of the file next to a ``.part`` file that holds the ETag or
+# Last-Modified value of the remote file its data came from
+VALIDATOR_SUFFIX = '.etag'
+
+# Errors after which an interrupted download can be resumed. Note that
+# HTTPError is a subclass of URLError and must be handled before these.
+TRANSIENT_ERRORS = (URLError, socket.timeout, ConnectionError, IncompleteRead)
+
+# HTTP status codes that are worth trying again
+RETRYABLE_HTTP_CODES = {408, 425, 429, 500, 502, 503, 504}
+
+
+def is_retryable(error):
+    """
+    Classify a network error as retryable (e.g. a timeout or a 503) or
+    permanent (e.g. a 404).
+
+    Example:
+        >>> from fels.download import *  # NOQA
+        >>> is_retryable(socket.timeout())
+        True
+        >>> is_retryable(HTTPError('http://a/b', 404, 'Not Found', {}, None))
+        False
+        >>> is_retryable(HTTPError('http://a/b', 503, 'Unavailable', {}, None))
+        True
+    """
+    if isinstance(error, HTTPError):
+        return error.code in RETRYABLE_HTTP_CODES
+    return isinstance(error, TRANSIENT_ERRORS + (ChecksumError,))
+
+
+class RetryPolicy(object):
+    """
+    How often and how fast failed network requests are tried again.
+
+    The delay before the n-th retry is ``base_delay * 2 ** (n - 1)``, capped
+    at ``max_delay``, of which a random fraction of up to ``jitter`` is
+    removed so concurrent downloads do not retry in lockstep.
+
+    Args:
+        max_attempts (int): the number of attempts, including the first one
+        base_delay (float): seconds to wait before the first retry
+        max_delay (float): maximum number of seconds between attempts
+        jitter (float): between 0 and 1
+
+    Example:
+        >>> from fels.download import *  # NOQA
+        >>> policy = RetryPolicy(max_attempts=8, base_delay=1, max_delay=10, jitter=0)
+        >>> [policy.delay(n) for n in range(1, 7)]
+        [1.0, 2.0, 4.0, 8.0, 10.0, 10.0]
+        >>> calls = []
+        >>> def flaky():
+        >>>     calls.append(1)
+        >>>     if len(calls) < 3:
+        >>>         raise socket.timeout('timed out')
+        >>>     return 'ok'
+        >>> result = RetryPolicy(base_delay=0).call(flaky, desc='flaky')
+        >>> result, len(calls)
+        ('ok', 3)
+    """
+
+    def __init__(self, max_attempts=5, base_delay=2.0, max_delay=60.0,
+                 jitter=0.5):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def delay(self, retry):
+        """
+        Seconds to wait before the ``retry``-th retry (starting at 1).
+        """
+        delay = min(self.max_delay, self.base_delay * 2 ** (retry - 1))
+        return delay * (1 - self.jitter * random.random())
+
+    def call(self, func, desc=None):
+        """
+        Call ``func`` until it succeeds, it raises a permanent error, or the
+        attempts run out. The last error is raised in the last two cases.
+        """
+        attempt = 1
+        while True:
+            try:
+                return func()
+            except Exception as error:
+                if not is_retryable(error) or attempt >= self.max_attempts:
+                    raise
+                delay = self.delay(attempt)
+                print('Retrying {} in {:.1f}s after {!r} [attempt {}/{}]'.format(
+                    desc or func, delay, error, attempt + 1, self.max_attempts))
+                time.sleep(delay)
+                attempt += 1
+
+
+# Used by all catalog and product downloads unless another one is given
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+
+def download_file(url, target_file, timeout=DOWNLOAD_TIMEOUT, retry=None,
+                  chunksize=2 ** 20, verify=False):
+    """
+    Download a single file.
+
+    The data is written to ``target_file + '.part'``, which is renamed to
+    ``target_file`` once it is complete, so ``target_file`` never holds a
+    partial download. If the ``.part`` file already exists, for example
+    after an earlier interrupted download, the download continues from its
+    end with an HTTP Range request. Retries resume the same way. The ETag
+    of the remote file is kept in a ``.part.etag`` file and sent with the
+    Range request (If-Range), so a remote file that changed in between is
+    downloaded from the start instead of being spliced.
+
+    Args:
+        url (str): the http url of the file
+        target_file (str): where to write the file
+        timeout (float): socket timeout in seconds
+        retry (RetryPolicy | None): how failed attempts are retried.
+            Defaults to :data:`DEFAULT_RETRY_POLICY`.
+        chunksize (int): number of bytes written at a time
+        verify (bool): check the file against the size and checksums sent
+            by the server. A file that does not match is downloaded again.
+
+    Returns:
+        Dict[str, object]: information about the download, with keys
+        ``attempts``, the number of attempts it took, ``expected``, the size
+        and checksums the server sent (see
+        :func:`fels.verify.expected_from_headers`), and ``verified``, the
+        result of :func:`fels.verify.check_file` or None if ``verify`` is
+        False.
+
+    Raises:
+        HTTPError: if the server answers with an error, e.g. 404
+        URLError | socket.timeout | ConnectionError | IncompleteRead:
+            on connection problems, once the retries are used up. The
+            ``.part`` file is kept so a later call can resume it.
+        ChecksumError: if ``verify`` is True and the file never matched
+    """
+    if retry is None:
+        retry = DEFAULT_RETRY_POLICY
+    part_file = target_file + PART_SUFFIX
+    info = {'attempts': 0, 'expected': None, 'verified': None}
+
+    def _attempt():
+        info['attempts'] += 1
+        headers, total = _download_part(url, part_file, timeout, chunksize)
+        expected = expected_from_headers(headers)
+        if expected['size'] is None:
+            expected['size'] = total
+        info['expected'] = expected
+        if verify:
+            try:
+                info['verified'] = check_file(part_file, expected)
+            except ChecksumError:
+                # Do not resume from corrupt data
+                _remove_part(part_file)
+                raise
+
+    retry.call(_attempt, desc=url)
+    os.replace(part_file, target_file)
+    _remove_part(part_file)
+    return info
+
+
+def fetch_headers(url, timeout=DOWNLOAD_TIMEOUT, retry=None):
+    """
+    Get the response headers of a remote file without downloading it.
+
+    Args:
+        url (str): the http url of the file
+        timeout (float): socket timeout in seconds
+        retry (RetryPolicy | None): how failed attempts are retried.
+            Defaults to :data:`DEFAULT_RETRY_POLICY`.
+
+    Returns:
+        http.client.HTTPMessage: the headers of a HEAD request
+    """
+    if retry is None:
+        retry = DEFAULT_RETRY_POLICY
+
+    def _attempt():
+        with urlopen(Request(url, method='HEAD'), timeout=timeout) as content:
+            return content.headers
+
+    return retry.call(_attempt, desc=url)
+
+
+def fetch_url(url, timeout=DOWNLOAD_TIMEOUT, retry=None):
+    """
+    Read a small remote file into memory.
+
+    Args:
+        url (str): the http url of the file
+        timeout (float): socket timeout in seconds
+        retry (RetryPolicy | None): how failed attempts are retried.
+            Defaults to :data:`DEFAULT_RETRY_POLICY`.
+
+    Returns:
+        bytes: the content of the file
+    """
+    if retry is None:
+        retry = DEFAULT_RETRY_POLICY
+
+    def _attempt():
+        with urlopen(url, timeout=timeout) as content:
+            data = content.read()
+            length = content.headers.get('Content-Length')
+        if length is not None and len(data) < int(length):
+            raise IncompleteRead(data, int(length) - len(data))
+        return data
+
+    return retry.call(_attempt, desc=url)
+
+
+def _download_part(url, part_file, timeout, chunksize):
+    """
+    Download the rest of a ``.part`` file.
+
+    The ETag or Last-Modified value of the response is written next to the
+    ``.part`` file before any data, see :data:`VALIDATOR_SUFFIX`. It is sent
+    back when the download is resumed (If-Range), so a changed remote file
+    is downloaded from the start instead of being appended to old data.
+
+    Returns:
+        Tuple[HTTPMessage, int | None]: the response headers and the size of
+        the remote file if the server told it
+    """
+    offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+    validator_file = part_file + VALIDATOR_SUFFIX
+    request = Request(url)
+    if offset:
+        request.add_header('Range', 'bytes={}-'.format(offset))
+        if os.path.exists(validator_file):
+            with open(validator_file, 'r') as file:
+                request.add_header('If-Range', file.read())
+    try:
+        content = urlopen(request, timeout=timeout)
+    except HTTPError as error:
+        if error.code != 416 or not offset:
+            raise
+        # The requested range starts at or after the end of the file, so the
+        # part file is complete if it has the same size as the remote file.
+        total = _content_range_total(error.headers.get('Content-Range'))
+        if total != offset:
+            _remove_part(part_file)
+            return _download_part(url, part_file, timeout, chunksize)
+        return error.headers, total
+    with content:
+        headers = content.headers
+        status = content.getcode()
+        validator = headers.get('ETag') or headers.get('Last-Modified')
+        if status == 206:
+            start = _content_range_start(headers.get('Content-Range'))
+            if start != offset:
+                # Start over rather than append at the wrong position
+                _remove_part(part_file)
+                raise IncompleteRead(b'', None)
+            total = _content_range_total(headers.get('Content-Range'))
+            mode = 'ab'
+        else:
+            # The server sent the whole file
+            mode = 'wb'
+            offset = 0
+            total = None
+        length = headers.get('Content-Length')
+        if total is None and length is not None:
+            total = offset + int(length)
+        # Recorded first, so a transfer that breaks off can be resumed
+        if validator is not None:
+            with open(validator_file, 'w') as file:
+                file.write(validator)
+        elif os.path.exists(validator_file):
+            os.remove(validator_file)
+        with open(part_file, mode) as f:
+            shutil.copyfileobj(content, f, chunksize)
+            size = f.tell()
+    # A connection closed early can look like the end of the data
+    if length is not None and size < offset + int(length):
+        raise IncompleteRead(b'', offset + int(length) - size)
+    return headers, total
+
+
+def _remove_part(part_file):
+    # Remove a .part file, if it still exists, and its validator
+    for fpath in [part_file, part_file + VALIDATOR_SUFFIX]:
+        if os.path.exists(fpath):
+            os.remove(fpath)
+
+
+def _content_range_start(content_range):
+    """
+    Example:
+        >>> from fels.download import _content_range_start
+        >>> _content_range_start('bytes 100-199/200')
+        100
+    """
+    match = re.match(r'bytes (\d+)-', content_range or '')
+    return int(match.group(1)) if match else None
+
+
+def _content_range_total(content_range):
+    """
+    Example:
+        >>> from fels.download import _content_range_total
+        >>> _content_range_total('bytes */200')
+        200
+    """
+    match = re.match(r'bytes [^/]+/(\d+)', content_range or '')
+    return int(match.group(1)) if match else None
+
+
+def run_jobs(jobs, workers=1):
+    """
+    Run each job and return their results in order.
+
+    Args:
+        jobs (List[Callable[[], object]]): functions without arguments
+        workers (int): the number of jobs that run at the same time. If this
+            is 1, the jobs run one after another in the calling thread.
+
+    Returns:
+        List[object]: the result of each job
+
+    Example:
+        >>> from fels.download import *  # NOQA
+        >>> import functools
+        >>> jobs = [functools.partial(pow, 2, i) for i in range(5)]
+        >>> run_jobs(jobs, workers=3)
+        [1, 2, 4, 8, 16]
+    """
+    if workers <= 1:
+        return [job() for job in jobs]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(job) for job in jobs]
+        return [future.result() for future in futures]
+
+
+def schedule_jobs(groups, workers=1, max_per_host=None, verbose=1):
+    """
+    Run the download jobs of several groups from a single queue.
+
+    Jobs are started in round-robin order over the groups, so all groups
+    make progress together, and at most ``workers`` jobs run at a time.
+    Jobs that download from the same host share a connection limit.
+
+    Args:
+        groups (Dict[object, List[Tuple[str, Callable[[], object]]]]):
+            for each group, e.g. a scene, its ``(url, job)`` pairs. The host
+            of the url is used for the connection limit.
+        workers (int): the maximum number of jobs that run at the same time
+        max_per_host (int | None): the maximum number of jobs for the same
+            host that run at the same time. Defaults to ``workers``.
+        verbose (int): if true, report the wall time of each group
+
+    Returns:
+        Dict[object, List[object]]: the job results of each group, in the
+        same order as the jobs
+
+    Example:
+        >>> from fels.download import *  # NOQA
+        >>> import functools
+        >>> groups = {
+        >>>     'a': [('http://h1/x', functools.partial(str, 1)),
+        >>>           ('http://h1/y', functools.partial(str, 2))],
+        >>>     'b': [('http://h2/z', functools.partial(str, 3))],
+        >>> }
+        >>> schedule_jobs(groups, workers=2, max_per_host=1, verbose=0)
+        {'a': ['1', '2'], 'b': ['3']}
+    """
+    workers = max(1, workers)
+    if max_per_host is None:
+        max_per_host = workers
+    results = {group: [None] * len(jobs) for group, jobs in groups.items()}
+    remaining = {group: len(jobs) for group, jobs in groups.items()}
+    start_times = {}
+
+    # Interleave the groups, then queue the jobs separately for each host
+    host_queues = collections.OrderedDict()
+    iters = [[(group, idx, url, job) for idx, (url, job) in enumerate(jobs)]
+             for group, jobs in groups.items()]
+    for items in _roundrobin(map(iter, iters)):
+        host = urlparse(items[2]).netloc
+        host_queues.setdefault(host, collections.deque()).append(items)
+    running_per_host = collections.Counter()
+
+    def _next_item():
+        # Take the next job of the first host below its limit, then move that
+        # host to the back so hosts take turns.
+        for host in list(host_queues):
+            if running_per_host[host] < max_per_host:
+                queue = host_queues.pop(host)
+                item = queue.popleft()
+                if queue:
+                    host_queues[host] = queue
+                return host, item
+        return None, None
+
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while host_queues or running:
+            while len(running) < workers:
+                host, item = _next_item()
+                if item is None:
+                    break
+                group, idx, url, job = item
+                start_times.setdefault(group, time.time())
+                running_per_host[host] += 1
+                running[executor.submit(job)] = (host, group, idx)
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                host, group, idx = running.pop(future)
+                running_per_host[host] -= 1
+                results[group][idx] = future.result()
+                remaining[group] -= 1
+                if verbose and remaining[group] == 0:
+                    print('Finished {} in {:.1f}s'.format(
+                        group, time.time() - start_times[group]))
+    return results
+
+
+def _roundrobin(iterables):
+    """
+    Example:
+        >>> from fels.download import _roundrobin
+        >>> list(_roundrobin([iter('ABC'), iter('D'), iter('EF')]))
+        ['A', 'D', 'E', 'B', 'F', 'C']
+    """
+    iterables = collections.deque(iterables)
+    while iterables:
+        iterable = iterables.popleft()
+        for item in iterable:
+            yield item
+            iterables.append(iterable)
+            break
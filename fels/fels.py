@@ -12,23 +12,31 @@ For programatic use see :func:`run_fels`.
 from __future__ import absolute_import, division, print_function
 import argparse
 import datetime
-import geopandas
+import functools
 import json
 import os
-import pkg_resources
-import shapely as shp
-import ubelt
+import sys
+from fels.download import run_jobs, schedule_jobs, TRANSIENT_ERRORS
+from fels.footprints import ensure_footprint_index
 from fels.landsat import (
-    get_landsat_image, query_landsat_catalogue, landsatdir_to_date,
-    ensure_landsat_metadata)
+    plan_landsat_image, query_landsat_catalogue, landsatdir_to_date,
+    ensure_landsat_metadata, query_landsat_catalogue_batch,
+    finalize_landsat_image)
 from fels.sentinel2 import (
-    query_sentinel2_catalogue, get_sentinel2_image, safedir_to_datetime,
-    ensure_sentinel2_metadata)
+    query_sentinel2_catalogue, plan_sentinel2_image, safedir_to_datetime,
+    ensure_sentinel2_metadata, query_sentinel2_catalogue_batch,
+    finalize_sentinel2_image)
+from fels.verify import verify_main
 
 
-@ubelt.memoize
-def _memo_geopandas_read(path):
-    return geopandas.read_file(path)
+# Typical size of a product with all bands, to estimate what a selection of
+# scenes saves. The sizes vary with the scene and processing level.
+TYPICAL_PRODUCT_BYTES = {
+    'S2': 700e6,
+    'OLI_TIRS': 1000e6,
+    'ETM': 500e6,
+    'TM': 350e6,
+}
 
 
 def convert_wkt_to_scene(sat, geometry, include_overlap, thresh=0.0):
@@ -61,41 +69,184 @@ def convert_wkt_to_scene(sat, geometry, include_overlap, thresh=0.0):
         >>> sorted(convert_wkt_to_scene('LC', geometry, include_overlap))
         ['140113', '141112', '141113', ...
     """
+    # NOTE: the footprints are looked up in a prebuilt index, which does not
+    # need GDAL.
+    feat = _parse_geometry(geometry)
+    index = ensure_footprint_index(sat)
+    return index.find(feat, include_overlap, float(thresh))
 
-    if sat == 'S2':
-        path = pkg_resources.resource_filename(__name__, os.path.join('data', 'sentinel_2_index_shapefile.shp'))
+
+def find_covering_scenes(sat, geometry, thresh=0.0):
+    """
+    Find a small set of scenes whose footprints jointly cover a geometry.
+
+    Neighbouring S2 tiles and WRS2 path/rows overlap, so many of the scenes
+    that intersect a geometry are not needed to cover it. The scenes are
+    picked with a greedy set cover, see :func:`fels.footprints.FootprintIndex.cover`.
+
+    Args:
+        sat: 'S2', 'ETM', 'OLI_TIRS'
+        geometry: WKT or GeoJSON string
+        thresh (float):
+            only consider the tiles that cover more than this fraction of
+            the region.
+
+    Returns:
+        Tuple[List[str], float]: the scenes, and the fraction of the
+        geometry they cover, which is less than 1 if part of the geometry is
+        outside of all tiles
+
+    Example:
+        >>> from fels.fels import *  # NOQA
+        >>> geometry = 'POLYGON((-72 40, -70 40, -70 42, -72 42, -72 40))'
+        >>> scenes, covered = find_covering_scenes('S2', geometry)
+        >>> set(scenes) <= set(convert_wkt_to_scene('S2', geometry, True))
+        True
+        >>> covered
+        1.0
+    """
+    feat = _parse_geometry(geometry)
+    index = ensure_footprint_index(sat)
+    idxs, covered = index.cover(feat, float(thresh))
+    return index.names[idxs].tolist(), covered
+
+
+def convert_aois_to_scenes(sat, aois, include_overlap, thresh=0.0,
+                           id_field=None):
+    """
+    Find the scenes of many areas of interest at once.
+
+    All areas are joined with the tile footprints in one vectorized pass,
+    which is much faster than calling :func:`convert_wkt_to_scene` for each.
+
+    Args:
+        sat: 'S2', 'ETM', 'OLI_TIRS'
+        aois: the areas of interest, see :func:`read_aois`
+        include_overlap: if True, use predicate 'intersects', else use predicate 'contains'
+        thresh (float):
+            the fraction of an area that must intersect and overlap with a
+            tile.
+        id_field (str | None): see :func:`read_aois`
+
+    Returns:
+        Tuple[Dict[object, List[str]], List[str]]: the scenes of each area,
+        and the scenes of all areas without duplicates
+
+    Example:
+        >>> from fels.fels import *  # NOQA
+        >>> aois = {'type': 'FeatureCollection', 'features': [
+        >>>     {'type': 'Feature', 'id': 'field1', 'properties': {},
+        >>>      'geometry': {'type': 'Point', 'coordinates': [-72.5, 40.8]}},
+        >>>     {'type': 'Feature', 'id': 'field2', 'properties': {},
+        >>>      'geometry': {'type': 'Point', 'coordinates': [-72.4, 40.9]}},
+        >>> ]}
+        >>> aoi_scenes, scenes = convert_aois_to_scenes('S2', aois, False)
+        >>> sorted(aoi_scenes)
+        ['field1', 'field2']
+        >>> set(scenes) == set(aoi_scenes['field1']) | set(aoi_scenes['field2'])
+        True
+    """
+    import numpy as np
+    ids, feats = read_aois(aois, id_field)
+    index = ensure_footprint_index(sat)
+    feat_idxs, idxs = index.query_many(feats, include_overlap, float(thresh))
+    aoi_scenes = {aoi_id: [] for aoi_id in ids}
+    for feat_idx, name in zip(feat_idxs.tolist(), index.names[idxs].tolist()):
+        found = aoi_scenes[ids[feat_idx]]
+        # Areas that share an id share a list
+        if name not in found:
+            found.append(name)
+    scenes = index.names[np.unique(idxs)].tolist()
+    return aoi_scenes, scenes
+
+
+def read_aois(aois, id_field=None):
+    """
+    Read areas of interest.
+
+    Args:
+        aois (str | dict | List):
+            a GeoJSON FeatureCollection, as a dict or as text, the path of a
+            GeoJSON file or of any vector file geopandas can read, or a list
+            of GeoJSON features, GeoJSON geometries, WKT strings or shapely
+            geometries.
+        id_field (str | None): the property that identifies each area.
+            Defaults to the id of the GeoJSON features, or else the position
+            of the area.
+
+    Returns:
+        Tuple[List[object], ndarray]: the id and the shapely geometry of each
+        area, in lon/lat. Features without a geometry have None.
+
+    Example:
+        >>> from fels.fels import *  # NOQA
+        >>> ids, feats = read_aois(['POINT (1 2)', {'type': 'Point', 'coordinates': [3, 4]}])
+        >>> ids, [feat.wkt for feat in feats]
+        ([0, 1], ['POINT (1 2)', 'POINT (3 4)'])
+    """
+    import numpy as np
+    if isinstance(aois, str):
+        if os.path.exists(aois):
+            ext = os.path.splitext(aois)[1].lower()
+            if ext not in {'.json', '.geojson'}:
+                return _read_aoi_file(aois, id_field)
+            with open(aois, 'r') as file:
+                aois = json.load(file)
+        else:
+            aois = json.loads(aois)
+    if isinstance(aois, dict):
+        if aois.get('type') == 'FeatureCollection':
+            aois = aois['features']
+        else:
+            aois = [aois]
+
+    ids = []
+    feats = []
+    for idx, item in enumerate(aois):
+        aoi_id = idx
+        if isinstance(item, dict) and item.get('type') == 'Feature':
+            if id_field is not None:
+                aoi_id = (item.get('properties') or {})[id_field]
+            elif item.get('id', None) is not None:
+                aoi_id = item['id']
+            item = item.get('geometry', None)
+        ids.append(aoi_id)
+        feats.append(None if item is None else _parse_geometry(item))
+    geometries = np.empty(len(feats), dtype=object)
+    geometries[:] = feats
+    return ids, geometries
+
+
+def _read_aoi_file(fpath, id_field=None):
+    # Other vector formats need geopandas (and its io backend)
+    import geopandas
+    gdf = geopandas.read_file(fpath)
+    if gdf.crs is not None and not gdf.crs.equals('EPSG:4326'):
+        gdf = gdf.to_crs('EPSG:4326')
+    if id_field is None:
+        ids = gdf.index.tolist()
     else:
-        path = pkg_resources.resource_filename(__name__, os.path.join('data', 'WRS2_descending.shp'))
+        ids = gdf[id_field].tolist()
+    return ids, gdf.geometry.values.to_numpy()
 
+
+def _parse_geometry(geometry):
+    # NOTE: shapely is only imported when a geometry is converted, so scene
+    # queries and the CLI start quickly.
+    import shapely.geometry
+    import shapely.wkt
     if isinstance(geometry, dict):
-        feat = shp.geometry.shape(geometry)
+        return shapely.geometry.shape(geometry)
     elif isinstance(geometry, str):
         try:
-            feat = shp.geometry.shape(json.loads(geometry))
+            return shapely.geometry.shape(json.loads(geometry))
         except json.JSONDecodeError:
-            feat = shp.wkt.loads(geometry)
+            return shapely.wkt.loads(geometry)
+    elif isinstance(geometry, shapely.geometry.base.BaseGeometry):
+        return geometry
     else:
         raise TypeError(type(geometry))
 
-    gdf = _memo_geopandas_read(path)
-
-    if include_overlap:
-        if thresh > 0:
-            # Requires some minimum overlap
-            overlap = gdf.geometry.intersection(feat).area / feat.area
-            found = gdf[overlap > thresh]
-        else:
-            # Any amount of overlap is ok
-            found = gdf[gdf.geometry.intersects(feat)]
-    else:
-        # This is the bottleneck when the downloaded data exists
-        found = gdf[gdf.geometry.contains(feat)]
-
-    if sat == 'S2':
-        return found.Name.values.tolist()
-    else:
-        return found.WRSPR.values.tolist()
-
 
 def normalize_satcode(sat):
     known = {'TM', 'ETM', 'OLI_TIRS', 'S2'}
@@ -126,11 +277,18 @@ def get_parser():
     parser.add_argument('start_date', help='Start date, in format YYYY-MM-DD. Note: Changed in 1.4.0 to be Left-inclusive in sqlite mode, but still Left-exclusive if use_csv.', default=('2010-01-01'))
     parser.add_argument('end_date', help='End date, in format YYYY-MM-DD. Note: Changed in 1.4.0 to be Right-inclusive in sqlite mode, but still Right-exclusive if use_csv.', default=('2020-01-01'))
     parser.add_argument('-g', '--geometry', help='Geometry to run search. Must be valid GeoJSON `geometry` or Well Known Text (WKT). This is only used if --scene is blank.', default=None)
+    parser.add_argument('--aois', help='GeoJSON FeatureCollection, or path to a GeoJSON or other vector file, of many areas of interest. The scenes of all areas are searched in one pass. This is only used if --scene and --geometry are blank.', default=None)
+    parser.add_argument('--aoi_id', help='With --aois, the property that identifies each area. Defaults to the feature id, else the position of the area.', default=None)
+    parser.add_argument('--aoi_scenes', help='With --aois, write the scenes of each area to this JSON file', default=None)
     parser.add_argument('-i', '--includeoverlap', help='If -g is used, include scenes that overlap the geometry but do not completely contain it', action='store_true', default=False)
+    parser.add_argument('--cover', action='store_true', help='If -g is used, only select a small set of the overlapping scenes that jointly cover the geometry, instead of every scene that overlaps it. Prints the number of products this saves.', default=False)
     parser.add_argument('--minoverlap', help='If -i is not used, include scenes that overlap the geometry but do not completely contain it', action='store_true', default=False)
     parser.add_argument('-c', '--cloudcover', type=float, help='Set a limit to the cloud cover of the image', default=100)
     parser.add_argument('-o', '--output', help='Where to download files', default=os.getcwd())
     parser.add_argument('-e', '--excludepartial', help='Exclude partial tiles - only for Sentinel-2', default=False)
+    parser.add_argument('--partial_thresh', type=float, help='With -e, the fraction of no-data pixels above which a tile is partial. By default any no-data pixel makes a tile partial.', default=0.0)
+    parser.add_argument('--partial_overviews', action='store_true', help='With -e, check a low resolution overview of the B01 band instead of the full band. Faster, but small no-data areas can be missed.', default=False)
+    parser.add_argument('--bands', type=_split_bands, help='Comma separated list of the bands to download, e.g. B4,B5,BQA for Landsat or B04,B08 for S2. The metadata files are always downloaded. Defaults to all bands.', default=None)
     parser.add_argument('--latest', help='Limit to the latest scene', action='store_true', default=False)
     parser.add_argument('--noinspire', help='Do not rename output image folder to the title collected from the inspire.xml file (only for S2 datasets)', action='store_true', default=False)
     parser.add_argument('--outputcatalogs', help='Where to download metadata catalog files', default=None)
@@ -138,18 +296,50 @@ def get_parser():
     parser.add_argument('-l', '--list', help='List available download urls and exit without downloading', action='store_true', default=False)
     parser.add_argument('-d', '--dates', help='List or return dates instead of download urls', action='store_true', default=False)
     parser.add_argument('-r', '--reject_old', help='For S2, skip redundant old-format (before Nov 2016) images', action='store_true', default=False)
-    parser.add_argument('-t', '--thresh', help='Only select intersecting areas where the fraction of the tile that overlaps with the spatial region is greater than this threshold', default=0.0)
+    parser.add_argument('-t', '--thresh', type=float, help='Only select intersecting areas where the fraction of the tile that overlaps with the spatial region is greater than this threshold', default=0.0)
+    parser.add_argument('--refresh_catalogs', action='store_true', help='Download a new copy of the metadata catalogs. The local sqlite caches are updated with only the newly appended rows when possible.', default=False)
+    parser.add_argument('--workers', type=int, help='Number of files that are downloaded at the same time, across all scenes', default=1)
+    parser.add_argument('--max_per_host', type=int, help='Maximum number of files downloaded at the same time from the same server. Defaults to --workers', default=None)
+    parser.add_argument('--verify', action='store_true', help='Check downloaded files against the size and checksums of the remote files, and record the results. Files verified by an earlier run are not checked again. Use "fels verify <output>" to check an existing output directory.', default=False)
     parser.add_argument('--use_csv', action='store_true', dest='use_csv', help='use the direct csv query instead of sqlite3 (only useful if you are doing 1 query for the first time)')
+    parser.add_argument('--use_columnar', action='store_true', dest='use_columnar', help='use a memory-mapped columnar cache of the catalog instead of sqlite3. Queries start instantly and the cache is shared between processes.')
+    parser.add_argument('--server', action='store_true', help='Run on a "fels serve" process, which keeps the catalogs and footprints loaded, at the FELS_SERVER_ADDRESS environment variable or 127.0.0.1:8950. Runs locally if no server is running.', default=False)
     parser.add_argument('--version', action='version', version='{version}'.format(**version_info))
     return parser
 
 
-def main():
+def main(argv=None):
     """
     CLI entrypoint.
-    """
-    options = get_parser().parse_args()
 
+    ``fels verify <output>`` checks the files of an existing output
+    directory, see :func:`fels.verify.verify_main`.
+
+    ``fels serve`` runs a server that keeps the catalogs and footprints
+    loaded, and ``fels --server ...`` runs a command on it, see
+    :mod:`fels.server`.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] == 'verify':
+        return verify_main(argv[1:])
+    if argv and argv[0] == 'serve':
+        from fels.server import serve_main
+        return serve_main(argv[1:])
+    options = get_parser().parse_args(argv)
+
+    if options.server:
+        from fels.server import forward_cli, DEFAULT_SERVER_ADDRESS
+        code = forward_cli(options)
+        if code is not None:
+            return code
+        print('No fels server is running at {}, running locally'.format(
+            DEFAULT_SERVER_ADDRESS))
+
+    return _run_cli(options)
+
+
+def _run_cli(options):
     if not options.outputcatalogs:
         options.outputcatalogs = options.output
 
@@ -160,6 +350,10 @@ def main():
             print(u)
 
 
+def _split_bands(text):
+    return [band for band in text.split(',') if band.strip()]
+
+
 def run_fels(*args, **kwargs):
     """
     Python entrypoint.
@@ -172,6 +366,8 @@ def run_fels(*args, **kwargs):
         start_date: can pass in a datetime.date directly
         end_date: can pass in a datetime.date directly
         geometry: can pass in GeoJSON as a dict instead of a string
+        aois: can pass in a FeatureCollection dict or a list of geometries
+        bands: can pass in a list of band names, such as ['B4', 'B5']
 
     Other differences from CLI:
         Returns the list of urls. Therefore, will not print them with list=True.
@@ -194,6 +390,7 @@ def _get_options(*args, **kwargs):
     """
     Example:
         >>> from fels.fels import *  # NOQA
+        >>> import ubelt
         >>> kwargs = {
         >>>     'scene': '23KPQ',
         >>>     'sat': 'S2',
@@ -232,6 +429,9 @@ def _get_options(*args, **kwargs):
     if isinstance(start_date, datetime.datetime):
         start_date = kwargs['start_date'] = datetime.datetime.isoformat(start_date)
 
+    if isinstance(kwargs.get('bands', None), str):
+        kwargs['bands'] = _split_bands(kwargs['bands'])
+
     if 'geometry' in kwargs:
         if isinstance(kwargs['geometry'], dict):
             kwargs['geometry'] = json.dumps(kwargs['geometry'])
@@ -260,6 +460,7 @@ def _run_fels(options):
 
     Example:
         >>> from fels.fels import *  # NOQA
+        >>> import ubelt
         >>> kwargs = {
         >>>     'scene': '23KPQ',
         >>>     'sat': 'S2',
@@ -280,61 +481,100 @@ def _run_fels(options):
         >>> _run_fels(options)
     """
 
-    if not options.scene and options.geometry:
+    cover = None
+    if not options.scene and options.geometry and options.cover:
+        all_scenes = convert_wkt_to_scene(options.sat, options.geometry, True, options.thresh)
+        scenes, covered = find_covering_scenes(options.sat, options.geometry, options.thresh)
+        cover = (all_scenes, covered)
+        for i, s in enumerate(scenes):
+            print(f'Selected scene to cover the geometry: {s} [{i+1}/{len(scenes)}]')
+        if not scenes:
+            print('No matching scenes found for spatial region!')
+    elif not options.scene and options.geometry:
         scenes = convert_wkt_to_scene(options.sat, options.geometry, options.includeoverlap, options.thresh)
         if len(scenes) > 0:
             for i, s in enumerate(scenes):
                 print(f'Converted WKT to scene: {s} [{i+1}/{len(scenes)}]')
         else:
             print('No matching scenes found for spatial region!')
+    elif not options.scene and options.aois:
+        aoi_scenes, scenes = convert_aois_to_scenes(
+            options.sat, options.aois, options.includeoverlap, options.thresh,
+            options.aoi_id)
+        print('Converted {} areas of interest to {} scenes'.format(
+            len(aoi_scenes), len(scenes)))
+        if options.aoi_scenes:
+            with open(options.aoi_scenes, 'w') as file:
+                json.dump({str(aoi_id): found
+                           for aoi_id, found in aoi_scenes.items()}, file,
+                          indent=1)
     elif options.scene:
         scenes = [options.scene]
 
     # Run functions
-    result = []
-    for scene in scenes:
-
+    if options.sat == 'S2':
+        sentinel2_metadata_file = ensure_sentinel2_metadata(
+            options.outputcatalogs, unzip=options.use_csv,
+            refresh=options.refresh_catalogs)
+    else:
+        landsat_metadata_file = ensure_landsat_metadata(
+            options.outputcatalogs, unzip=options.use_csv,
+            refresh=options.refresh_catalogs)
+
+    # When a geometry expands to several scenes, query all of them at once.
+    # With --cover, the scenes that are not selected are also queried, to
+    # report what is saved.
+    query_scenes = scenes if cover is None else cover[0]
+    scene_urls = None
+    if len(query_scenes) > 1:
         if options.sat == 'S2':
-            sentinel2_metadata_file = ensure_sentinel2_metadata(
-                options.outputcatalogs)
-            url = query_sentinel2_catalogue(
+            scene_urls = query_sentinel2_catalogue_batch(
                 sentinel2_metadata_file, options.cloudcover,
-                options.start_date, options.end_date, scene, options.latest,
-                use_csv=options.use_csv)
-            if not url:
-                print('No image was found with the criteria you chose! Please review your parameters and try again.')
-            else:
-                print('Found {} files.'.format(len(url)))
-                if not options.list:
-                    valid_mask = []
-                    for i, u in enumerate(url):
-                        print('Downloading {} of {}...'.format(i + 1, len(url)))
-                        ok = get_sentinel2_image(
-                            u, options.output, options.overwrite,
-                            options.excludepartial, options.noinspire,
-                            options.reject_old)
-                        if not ok:
-                            print(f'Skipped {u}')
-                        valid_mask.append(ok)
-                    url = [u for u, m in zip(url, valid_mask) if m]
+                options.start_date, options.end_date, query_scenes, options.latest,
+                use_csv=options.use_csv,
+                use_columnar=options.use_columnar)
         else:
-            landsat_metadata_file = ensure_landsat_metadata(
-                options.outputcatalogs)
+            scene_urls = query_landsat_catalogue_batch(
+                landsat_metadata_file, options.cloudcover, options.start_date,
+                options.end_date, query_scenes, options.sat, options.latest,
+                use_csv=options.use_csv,
+                use_columnar=options.use_columnar)
 
+    found_urls = []
+    for scene in scenes:
+        if scene_urls is not None:
+            url = scene_urls[scene]
+        elif options.sat == 'S2':
+            url = query_sentinel2_catalogue(
+                sentinel2_metadata_file, options.cloudcover,
+                options.start_date, options.end_date, scene,
+                options.latest, use_csv=options.use_csv,
+                use_columnar=options.use_columnar)
+        else:
             url = query_landsat_catalogue(
-                landsat_metadata_file, options.cloudcover, options.start_date,
-                options.end_date, scene[0:3], scene[3:6], options.sat,
-                options.latest, use_csv=options.use_csv)
+                landsat_metadata_file, options.cloudcover,
+                options.start_date, options.end_date, scene[0:3],
+                scene[3:6], options.sat, options.latest,
+                use_csv=options.use_csv,
+                use_columnar=options.use_columnar)
+        if not url:
+            print('No image was found with the criteria you chose! Please review your parameters and try again.')
+        else:
+            print('Found {} files.'.format(len(url)))
+        found_urls.append(url)
 
-            if not url:
-                print('No image was found with the criteria you chose! Please review your parameters and try again.')
-            else:
-                print('Found {} files.'.format(len(url)))
-                for i, u in enumerate(url):
-                    if not options.list:
-                        print('Downloading {} of {}...'.format(i + 1, len(url)))
-                        get_landsat_image(u, options.output, options.overwrite, options.sat)
+    if cover is not None:
+        if scene_urls is None:
+            scene_urls = dict(zip(scenes, found_urls))
+        print(cover_report(options.sat, scenes, cover[0], cover[1],
+                           scene_urls))
 
+    if not options.list:
+        # The files of all scenes are downloaded from a single queue
+        found_urls = _download_scenes(options, scenes, found_urls)
+
+    result = []
+    for url in found_urls:
         if options.dates:
             dirs = [u.split('/')[-1] for u in url]
             if options.sat == 'S2':
@@ -351,5 +591,132 @@ def _run_fels(options):
     return result
 
 
+def cover_report(sat, scenes, all_scenes, covered, scene_urls):
+    """
+    Describe what selecting covering scenes saves compared with selecting
+    all scenes that intersect a geometry.
+
+    Args:
+        sat: 'S2', 'TM', 'ETM', 'OLI_TIRS'
+        scenes (List[str]): the covering scenes
+        all_scenes (List[str]): the intersecting scenes
+        covered (float): the fraction of the geometry that ``scenes`` cover
+        scene_urls (Dict[str, List[str]]): the products found for each of
+            ``all_scenes``
+
+    Returns:
+        str: the report. The bytes are estimated with the typical size of
+        a product of all bands, see :data:`TYPICAL_PRODUCT_BYTES`.
+
+    Example:
+        >>> from fels.fels import *  # NOQA
+        >>> print(cover_report('S2', ['A', 'C'], ['A', 'B', 'C'], 1.0, {
+        >>>     'A': ['a1', 'a2'], 'B': ['b1', 'b2', 'b3'], 'C': ['c1']}))
+        Covering 100.0% of the geometry with 2 of 3 scenes (3 of 6 products)
+        Skipped 1 scenes with 3 products, about 2.1 GB
+    """
+    selected = set(scenes)
+    skipped = [scene for scene in all_scenes if scene not in selected]
+    num_products = sum(len(scene_urls.get(scene, [])) for scene in scenes)
+    num_skipped = sum(len(scene_urls.get(scene, [])) for scene in skipped)
+    saved = num_skipped * TYPICAL_PRODUCT_BYTES.get(sat, 0)
+    return (
+        'Covering {:.1f}% of the geometry with {} of {} scenes '
+        '({} of {} products)\n'
+        'Skipped {} scenes with {} products, about {:.1f} GB').format(
+            100 * covered, len(scenes), len(all_scenes), num_products,
+            num_products + num_skipped, len(skipped), num_skipped, saved / 1e9)
+
+
+def _download_scenes(options, scenes, found_urls):
+    """
+    Download the images found for all scenes and return the urls of each
+    scene that were downloaded.
+
+    The files of all images are put in one queue, and the scenes take turns
+    so they all progress together. At most ``options.workers`` files are
+    downloaded at the same time, and at most ``options.max_per_host`` from
+    the same server.
+    """
+    # Listing the files of S2 images needs their manifest
+    if options.sat == 'S2':
+        plan_jobs = [
+            functools.partial(plan_sentinel2_image, u, options.output,
+                              options.overwrite, options.reject_old,
+                              verify=options.verify,
+                              partial=options.excludepartial,
+                              partial_thresh=options.partial_thresh,
+                              partial_overviews=options.partial_overviews,
+                              bands=options.bands)
+            for urls in found_urls for u in urls]
+    else:
+        plan_jobs = [
+            functools.partial(plan_landsat_image, u, options.output,
+                              options.overwrite, options.sat,
+                              verify=options.verify, bands=options.bands)
+            for urls in found_urls for u in urls]
+    # A product that cannot be planned, e.g. because its manifest cannot be
+    # fetched, fails alone
+    plan_jobs = [functools.partial(_try_plan, job) for job in plan_jobs]
+    plans = iter(run_jobs(plan_jobs, workers=options.workers))
+    scene_plans = [[next(plans) for _ in urls] for urls in found_urls]
+    for urls, plan_list in zip(found_urls, scene_plans):
+        for u, plan in zip(urls, plan_list):
+            if isinstance(plan, Exception):
+                print('Could not prepare the download of {} [{!r}]'.format(
+                    u, plan))
+
+    groups = {}
+    for scene, plan_list in zip(scenes, scene_plans):
+        plan_list = [plan for plan in plan_list
+                     if not isinstance(plan, Exception)]
+        if options.sat == 'S2':
+            groups[scene] = [item for plan in plan_list for item in plan['jobs']]
+        else:
+            groups[scene] = [item for plan in plan_list for item in plan]
+    results = schedule_jobs(groups, workers=options.workers,
+                            max_per_host=options.max_per_host)
+
+    if options.sat != 'S2':
+        for scene, urls, plan_list in zip(scenes, found_urls, scene_plans):
+            scene_results = iter(results[scene])
+            for u, plan in zip(urls, plan_list):
+                if isinstance(plan, Exception):
+                    continue
+                finalize_landsat_image(
+                    u, options.output, [next(scene_results) for _ in plan],
+                    bands=options.bands)
+        return found_urls
+
+    downloaded_urls = []
+    for scene, urls, plan_list in zip(scenes, found_urls, scene_plans):
+        scene_results = iter(results[scene])
+        valid_urls = []
+        for u, plan in zip(urls, plan_list):
+            if isinstance(plan, Exception):
+                print(f'Skipped {u}')
+                continue
+            plan_results = [next(scene_results) for _ in plan['jobs']]
+            ok = finalize_sentinel2_image(
+                plan, plan_results, options.excludepartial,
+                options.noinspire, options.reject_old,
+                partial_thresh=options.partial_thresh,
+                partial_overviews=options.partial_overviews)
+            if not ok:
+                print(f'Skipped {u}')
+            else:
+                valid_urls.append(u)
+        downloaded_urls.append(valid_urls)
+    return downloaded_urls
+
+
+def _try_plan(plan_job):
+    # The plan, or the network error that prevented it
+    try:
+        return plan_job()
+    except TRANSIENT_ERRORS as error:
+        return error
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,448 @@
+# -*- coding: utf-8 -*-
+"""
+A compact, memory-mapped index of the Landsat and Sentinel-2 tile
+footprints.
+
+The shipped shapefiles are converted once to a directory of ``.npy`` arrays:
+the bounding box of each footprint as float64, the footprint geometries as
+WKB in a single byte heap, and the WRS path/row or MGRS tile name of each
+footprint. A lookup filters the bounding boxes with numpy and only decodes
+the WKB of the candidates to evaluate the exact predicate, so converting a
+geometry to scenes needs neither GDAL/OGR nor geopandas.
+
+The indexes are built into ``fels/data/footprints`` by the ``build_py``
+step of ``setup.py`` (install ``requirements/build.txt`` first), which
+runs::
+
+    python -m fels.footprints
+
+If that is not possible, e.g. because geopandas is not installed in the
+build environment, no index is shipped and one is built in the fels cache
+directory from the shapefile the first time it is needed.
+"""
+from __future__ import absolute_import, division, print_function
+import json
+import os
+import shutil
+import tempfile
+import time
+import ubelt
+from fels.utils import FELS_DEFAULT_OUTPUTDIR
+
+
+# Version of the on-disk layout of the footprint indexes
+FOOTPRINT_INDEX_VERSION = 'v001'
+
+# The shapefile of each kind of tile and the column with the tile names
+FOOTPRINT_SHAPEFILES = {
+    'S2': ('sentinel_2_index_shapefile', 'Name'),
+    'LANDSAT': ('WRS2_descending', 'WRSPR'),
+}
+
+DATA_DPATH = os.path.join(os.path.dirname(__file__), 'data')
+
+# Where the package ships the prebuilt indexes
+SHIPPED_FOOTPRINTS_DPATH = os.path.join(DATA_DPATH, 'footprints')
+
+GLOBAL_FOOTPRINT_INDEXES = {}
+
+
+class FootprintIndex(object):
+    """
+    Read-only access to a footprint index.
+
+    Args:
+        dpath (str): directory written by :func:`build_footprint_index`
+
+    Example:
+        >>> from fels.footprints import *  # NOQA
+        >>> import shapely.geometry
+        >>> dpath = ubelt.ensure_app_cache_dir('fels', 'tests', 'footprints')
+        >>> tiles = [shapely.geometry.box(x, 0, x + 1.5, 1) for x in range(3)]
+        >>> build_footprint_index(tiles, ['A', 'B', 'C'], dpath)
+        >>> index = FootprintIndex(dpath)
+        >>> index.num_rows
+        3
+        >>> index.find(shapely.geometry.Point(1.2, 0.5), include_overlap=False)
+        ['A', 'B']
+        >>> index.find(shapely.geometry.box(1.2, 0, 2.4, 1), include_overlap=True)
+        ['A', 'B', 'C']
+        >>> index.find(shapely.geometry.box(1.2, 0, 2.4, 1), include_overlap=True, thresh=0.5)
+        ['B']
+    """
+
+    def __init__(self, dpath):
+        import numpy as np
+        self.dpath = dpath
+        with open(os.path.join(dpath, 'meta.json'), 'r') as file:
+            self.meta = json.load(file)
+        self.num_rows = self.meta['num_rows']
+
+        def _load(name):
+            return np.load(os.path.join(dpath, name + '.npy'), mmap_mode='r')
+
+        self.bounds = _load('bounds')
+        self.names = _load('names')
+        self._wkb_heap = _load('wkb.heap')
+        self._wkb_start = _load('wkb.start')
+        self._wkb_length = _load('wkb.length')
+        self._tree = None
+
+    def geometries(self, indexes):
+        """
+        Decode the footprints at the given row indexes.
+
+        Returns:
+            ndarray: an object array of shapely geometries
+        """
+        import shapely
+        heap = self._wkb_heap
+        blobs = [heap[start:start + length].tobytes()
+                 for start, length in zip(self._wkb_start[indexes].tolist(),
+                                          self._wkb_length[indexes].tolist())]
+        return shapely.from_wkb(blobs)
+
+    def query(self, feat, include_overlap, thresh=0.0):
+        """
+        Find the footprints that match a geometry.
+
+        Args:
+            feat (shapely.geometry.base.BaseGeometry): the geometry
+            include_overlap (bool): if True, find the footprints that
+                intersect the geometry, else the ones that contain it
+            thresh (float): with ``include_overlap``, the fraction of the
+                geometry that must be covered by a footprint
+
+        Returns:
+            ndarray: sorted integer positions of the matching footprints
+        """
+        import numpy as np
+        import shapely
+        minx, miny, maxx, maxy = feat.bounds
+        bounds = self.bounds
+        if include_overlap:
+            mask = ((bounds[:, 0] <= maxx) & (bounds[:, 2] >= minx) &
+                    (bounds[:, 1] <= maxy) & (bounds[:, 3] >= miny))
+        else:
+            # Only a footprint whose box contains the box of the geometry can
+            # contain the geometry
+            mask = ((bounds[:, 0] <= minx) & (bounds[:, 2] >= maxx) &
+                    (bounds[:, 1] <= miny) & (bounds[:, 3] >= maxy))
+        idxs = np.flatnonzero(mask)
+        if len(idxs) == 0:
+            return idxs
+        geoms = self.geometries(idxs)
+        shapely.prepare(feat)
+        if include_overlap:
+            keep = shapely.intersects(feat, geoms)
+            idxs, geoms = idxs[keep], geoms[keep]
+            if thresh > 0:
+                # Requires some minimum overlap
+                overlap = shapely.area(shapely.intersection(geoms, feat)) / feat.area
+                idxs = idxs[overlap > thresh]
+        else:
+            # The footprint contains the geometry
+            idxs = idxs[shapely.within(feat, geoms)]
+        return idxs
+
+    def query_many(self, feats, include_overlap, thresh=0.0):
+        """
+        Find the footprints that match each of many geometries in one pass.
+
+        The bounding boxes of the geometries are joined with the bounding
+        boxes of the footprints through an STRtree, and the footprints of
+        all candidate pairs are decoded once and tested with vectorized
+        predicates.
+
+        Args:
+            feats (Sequence[shapely.geometry.base.BaseGeometry]): the
+                geometries
+            include_overlap (bool): see :func:`query`
+            thresh (float): see :func:`query`
+
+        Returns:
+            Tuple[ndarray, ndarray]: the position of the geometry and of the
+            footprint of each match, sorted by geometry and then footprint
+        """
+        import numpy as np
+        import shapely
+        feats = np.asarray(feats, dtype=object)
+        feat_idxs, idxs = self._box_tree().query(feats)
+        if not include_overlap:
+            # Only a footprint whose box contains the box of the geometry can
+            # contain the geometry
+            feat_bounds = shapely.bounds(feats)[feat_idxs]
+            bounds = self.bounds[idxs]
+            keep = ((bounds[:, 0] <= feat_bounds[:, 0]) &
+                    (bounds[:, 1] <= feat_bounds[:, 1]) &
+                    (bounds[:, 2] >= feat_bounds[:, 2]) &
+                    (bounds[:, 3] >= feat_bounds[:, 3]))
+            feat_idxs, idxs = feat_idxs[keep], idxs[keep]
+        if len(idxs):
+            # Decode each candidate footprint once
+            unique_idxs, inverse = np.unique(idxs, return_inverse=True)
+            geoms = self.geometries(unique_idxs)[inverse]
+            pair_feats = feats[feat_idxs]
+            shapely.prepare(feats)
+            if include_overlap:
+                keep = shapely.intersects(pair_feats, geoms)
+                if thresh > 0:
+                    # Requires some minimum overlap
+                    overlap = (shapely.area(shapely.intersection(
+                        geoms[keep], pair_feats[keep])) /
+                        shapely.area(pair_feats[keep]))
+                    keep[keep] = overlap > thresh
+            else:
+                # The footprint contains the geometry
+                keep = shapely.within(pair_feats, geoms)
+            feat_idxs, idxs = feat_idxs[keep], idxs[keep]
+        order = np.lexsort((idxs, feat_idxs))
+        return feat_idxs[order], idxs[order]
+
+    def cover(self, feat, thresh=0.0, min_gain=1e-6):
+        """
+        Select a small set of footprints that jointly cover a geometry.
+
+        This is the greedy set cover: among the footprints that intersect
+        the geometry, the one that covers the largest uncovered part is
+        picked until the geometry is covered or no footprint covers more.
+        The gains only decrease as parts get covered, so a footprint is only
+        re-evaluated when its last gain is the largest that is left.
+
+        The parts are measured by area, or by length for lines and by the
+        number of points for points.
+
+        Args:
+            feat (shapely.geometry.base.BaseGeometry): the geometry
+            thresh (float): only consider the footprints that cover more
+                than this fraction of the geometry
+            min_gain (float): footprints that would cover at most this
+                fraction of the geometry are not selected
+
+        Returns:
+            Tuple[ndarray, float]: the sorted positions of the selected
+            footprints, and the fraction of the geometry they cover
+
+        Example:
+            >>> from fels.footprints import *  # NOQA
+            >>> import shapely.geometry
+            >>> dpath = ubelt.ensure_app_cache_dir('fels', 'tests', 'footprints')
+            >>> tiles = [shapely.geometry.box(0, 0, 2, 1),
+            >>>          shapely.geometry.box(1.8, 0, 4, 1),
+            >>>          shapely.geometry.box(1, 0, 2.9, 1)]
+            >>> build_footprint_index(tiles, ['A', 'B', 'C'], dpath)
+            >>> index = FootprintIndex(dpath)
+            >>> feat = shapely.geometry.box(0.2, 0, 3.8, 1)
+            >>> index.find(feat, include_overlap=True)
+            ['A', 'B', 'C']
+            >>> idxs, covered = index.cover(feat)
+            >>> index.names[idxs].tolist(), covered
+            (['A', 'B'], 1.0)
+        """
+        import heapq
+        import numpy as np
+        import shapely
+        idxs = self.query(feat, True, thresh)
+        if feat.area > 0:
+            measure = shapely.area
+        elif feat.length > 0:
+            measure = shapely.length
+        else:
+            measure = shapely.get_num_coordinates
+        total = float(measure(feat))
+        geoms = self.geometries(idxs)
+        gains = measure(shapely.intersection(geoms, feat))
+        # Heap of (-gain, position) with the gain when it was last measured
+        heap = [(-gain, pos) for pos, gain in
+                enumerate(np.asarray(gains, dtype=float).tolist())]
+        heapq.heapify(heap)
+        remaining = feat
+        selected = []
+        while heap:
+            _, pos = heapq.heappop(heap)
+            gain = float(measure(shapely.intersection(geoms[pos], remaining)))
+            if gain <= min_gain * total:
+                continue
+            if heap and gain < -heap[0][0]:
+                # Another footprint may cover more now
+                heapq.heappush(heap, (-gain, pos))
+                continue
+            selected.append(pos)
+            remaining = shapely.difference(remaining, geoms[pos])
+        covered = 1.0 - float(measure(remaining)) / total if total > 0 else 1.0
+        return np.sort(idxs[selected]), covered
+
+    def _box_tree(self):
+        # An STRtree of the bounding boxes, built on first use
+        if self._tree is None:
+            import shapely
+            bounds = self.bounds
+            self._tree = shapely.STRtree(shapely.box(
+                bounds[:, 0], bounds[:, 1], bounds[:, 2], bounds[:, 3]))
+        return self._tree
+
+    def find(self, feat, include_overlap, thresh=0.0):
+        """
+        Like :func:`query`, but returns the names of the footprints.
+
+        Returns:
+            List[str]: the names, in the order of the shapefile
+        """
+        return self.names[self.query(feat, include_overlap, thresh)].tolist()
+
+
+def footprint_shapefile(sat):
+    """
+    The path of the shipped shapefile with the footprints of the tiles of a
+    satellite, and the column with the tile names.
+
+    Args:
+        sat (str): 'S2' for the Sentinel-2 tiles, anything else for the
+            Landsat WRS-2 path/rows
+
+    Returns:
+        Tuple[str, str]
+    """
+    fname, name_column = FOOTPRINT_SHAPEFILES['S2' if sat == 'S2' else 'LANDSAT']
+    return os.path.join(DATA_DPATH, fname + '.shp'), name_column
+
+
+def ensure_footprint_index(sat):
+    """
+    Returns the :class:`FootprintIndex` of the tiles of a satellite.
+
+    The index shipped with the package is used if there is one and it was
+    built from the shapefile next to it. Otherwise an index is built in the
+    fels cache directory, which requires geopandas, and is rebuilt when the
+    shapefile changes.
+
+    Args:
+        sat (str): 'S2' for the Sentinel-2 tiles, anything else for the
+            Landsat WRS-2 path/rows
+
+    Returns:
+        FootprintIndex
+    """
+    shp_fpath, name_column = footprint_shapefile(sat)
+    fname = os.path.splitext(os.path.basename(shp_fpath))[0]
+    shipped_dpath = os.path.join(SHIPPED_FOOTPRINTS_DPATH, fname)
+    cache_dpath = os.path.join(FELS_DEFAULT_OUTPUTDIR, fname + '.' +
+                               FOOTPRINT_INDEX_VERSION + '.footprints')
+    source = _shapefile_source(shp_fpath)
+    for dpath in [shipped_dpath, cache_dpath]:
+        index = GLOBAL_FOOTPRINT_INDEXES.get(dpath, None)
+        if index is not None:
+            return index
+        meta_fpath = os.path.join(dpath, 'meta.json')
+        if os.path.exists(meta_fpath):
+            with open(meta_fpath, 'r') as file:
+                meta = json.load(file)
+            # The shipped index does not need the shapefile
+            if (meta['version'] == FOOTPRINT_INDEX_VERSION and
+                    (source is None or meta['source'] == source)):
+                index = GLOBAL_FOOTPRINT_INDEXES[dpath] = FootprintIndex(dpath)
+                return index
+    print('Computing (or recomputing) the footprint index of {}'.format(fname))
+    build_footprint_index_from_shapefile(shp_fpath, name_column, cache_dpath)
+    index = GLOBAL_FOOTPRINT_INDEXES[cache_dpath] = FootprintIndex(cache_dpath)
+    return index
+
+
+def build_footprint_index_from_shapefile(shp_fpath, name_column, dpath):
+    """
+    Read a shapefile with geopandas and write its footprint index to
+    ``dpath``.
+    """
+    import geopandas
+    gdf = geopandas.read_file(shp_fpath)
+    build_footprint_index(gdf.geometry.values, gdf[name_column].values,
+                          dpath, source=_shapefile_source(shp_fpath))
+
+
+def build_footprint_index(geometries, names, dpath, source=None):
+    """
+    Write a footprint index to ``dpath``.
+
+    The index is written to a temporary directory of its own, which
+    replaces ``dpath`` when complete, so concurrent builds do not mix their
+    files.
+
+    Args:
+        geometries (Sequence[shapely.geometry.base.BaseGeometry]): the
+            footprints
+        names (Sequence): the name of each footprint
+        dpath (str): the directory of the index
+        source (dict | None): identifies the data the index was built from
+    """
+    import numpy as np
+    import shapely
+    geometries = np.asarray(geometries, dtype=object)
+    names = np.asarray(names)
+    if names.dtype == object:
+        names = names.astype(str)
+    blobs = shapely.to_wkb(geometries).tolist()
+    lengths = np.array([len(blob) for blob in blobs], dtype=np.int32)
+    starts = np.zeros(len(blobs), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    arrays = {
+        'bounds': shapely.bounds(geometries).astype(np.float64),
+        'names': names,
+        'wkb.heap': np.frombuffer(b''.join(blobs), dtype=np.uint8),
+        'wkb.start': starts,
+        'wkb.length': lengths,
+    }
+
+    parent, fname = os.path.split(os.path.abspath(dpath))
+    ubelt.ensuredir(parent)
+    tmp_dpath = tempfile.mkdtemp(dir=parent, prefix=fname + '.tmp')
+    for name, values in arrays.items():
+        np.save(os.path.join(tmp_dpath, name + '.npy'), values)
+    meta = {
+        'version': FOOTPRINT_INDEX_VERSION,
+        'num_rows': len(names),
+        'source': source,
+    }
+    with open(os.path.join(tmp_dpath, 'meta.json'), 'w') as file:
+        json.dump(meta, file)
+
+    old_dpath = tmp_dpath + '.old'
+    try:
+        os.rename(dpath, old_dpath)
+    except FileNotFoundError:
+        pass
+    try:
+        os.rename(tmp_dpath, dpath)
+    except OSError:
+        # Another process put its build in place first
+        shutil.rmtree(tmp_dpath)
+    if os.path.exists(old_dpath):
+        shutil.rmtree(old_dpath)
+
+
+def build_shipped_footprint_indexes(dpath=SHIPPED_FOOTPRINTS_DPATH):
+    """
+    Build the indexes of all shipped shapefiles into the package data.
+    """
+    for sat in ['S2', 'LANDSAT']:
+        start_time = time.perf_counter()
+        shp_fpath, name_column = footprint_shapefile(sat)
+        fname = os.path.splitext(os.path.basename(shp_fpath))[0]
+        build_footprint_index_from_shapefile(
+            shp_fpath, name_column, os.path.join(dpath, fname))
+        print('Wrote the footprint index of {} in {:.2f}s'.format(
+            fname, time.perf_counter() - start_time))
+
+
+def _shapefile_source(shp_fpath):
+    # The sizes identify the shapefile, the mtimes change when it is installed
+    base = os.path.splitext(shp_fpath)[0]
+    source = {}
+    for ext in ['.shp', '.dbf']:
+        if not os.path.exists(base + ext):
+            return None
+        source[ext[1:] + '_size'] = os.stat(base + ext).st_size
+    return source
+
+
+if __name__ == '__main__':
+    build_shipped_footprint_indexes()
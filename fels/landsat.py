@@ -1,33 +1,50 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function
-import csv
 import datetime
+import functools
 import os
-import socket
 import time
-import shutil
 import ubelt
-import dateutil
 try:
-    from urllib2 import urlopen
     from urllib2 import HTTPError
-    from urllib2 import URLError
 except ImportError:
-    from urllib.request import urlopen, HTTPError, URLError
+    from urllib.request import HTTPError
 
+from fels.cache import download_cached, is_metadata_url
+from fels.columnar import ensure_columnar_catalog
+from fels.download import (
+    download_file, is_retryable, run_jobs, TRANSIENT_ERRORS)
+from fels.ledger import (
+    bands_cover, complete_product, is_missing_file, product_bands,
+    product_status, record_file, record_missing_file, start_product, COMPLETE)
 from fels.utils import (
-    sort_url_list, download_metadata_file, ensure_sqlite_csv_conn)
+    sort_url_list, download_metadata_file, ensure_sqlite_csv_conn,
+    iter_catalog_chunks, catalog_dates, isodate_to_int, gs_to_http_url, sql_order_clause,
+    sqlite_temp_table)
+from fels.verify import (
+    ChecksumError, check_existing_file, flush_checksums, record_checksum)
 
 
 LANDSAT_METADATA_URL = 'http://storage.googleapis.com/gcp-public-data-landsat/index.csv.gz'
 
 
-def ensure_landsat_metadata(outputdir=None):
-    return download_metadata_file(LANDSAT_METADATA_URL, outputdir, 'Landsat')
+def ensure_landsat_metadata(outputdir=None, unzip=False, refresh=False):
+    """
+    Download the Landsat catalogue if needed and return its path.
+
+    Args:
+        outputdir (str | None): where to store the catalogue
+        unzip (bool): if True, keep an uncompressed csv on disk. Otherwise
+            the gzipped catalogue is streamed directly into the sqlite cache.
+        refresh (bool): if True, download a new copy of the catalogue.
+    """
+    return download_metadata_file(
+        LANDSAT_METADATA_URL, outputdir, 'Landsat', unzip=unzip, refresh=refresh)
 
 
 def query_landsat_catalogue(collection_file, cc_limit, date_start, date_end, wr2path, wr2row,
-                            sensor, latest=False, use_csv=False):
+                            sensor, latest=False, use_csv=False,
+                            use_columnar=False):
     """
     Query the Landsat index catalogue and retrieve urls for the best images
     found.
@@ -74,8 +91,14 @@ def query_landsat_catalogue(collection_file, cc_limit, date_start, date_end, wr2
     print('Searching for Landsat-{} images in catalog...'.format(sensor))
     if use_csv:
         return _query_landsat_with_csv(
-            collection_file, cc_limit, date_start, date_end, wr2path, wr2row,
-            sensor, latest=latest)
+            collection_file, cc_limit, date_start, date_end,
+            [(wr2path, wr2row)], sensor,
+            latest=latest)[(int(wr2path), int(wr2row))]
+    elif use_columnar:
+        return _query_landsat_with_columnar(
+            collection_file, cc_limit, date_start, date_end,
+            [(wr2path, wr2row)], sensor,
+            latest=latest)[(int(wr2path), int(wr2row))]
     else:
         # Generally SQL is faster
         return _query_landsat_with_sqlite(
@@ -84,27 +107,108 @@ def query_landsat_catalogue(collection_file, cc_limit, date_start, date_end, wr2
 
 
 def _query_landsat_with_csv(collection_file, cc_limit, date_start, date_end,
-                            wr2path, wr2row, sensor, latest=False):
-    cc_values = []
-    all_urls = []
-    all_acqdates = []
-    with open(collection_file) as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in ubelt.ProgIter(reader, desc='searching'):
-            year_acq = int(row['DATE_ACQUIRED'][0:4])
-            month_acq = int(row['DATE_ACQUIRED'][5:7])
-            day_acq = int(row['DATE_ACQUIRED'][8:10])
-            acqdate = datetime.datetime(year_acq, month_acq, day_acq)
-            if int(row['WRS_PATH']) == int(wr2path) and int(row['WRS_ROW']) == int(wr2row) \
-                    and row['SENSOR_ID'] == sensor and float(row['CLOUD_COVER']) <= cc_limit \
-                    and date_start < acqdate < date_end:
-                all_urls.append(row['BASE_URL'])
-                cc_values.append(float(row['CLOUD_COVER']))
-                all_acqdates.append(acqdate)
-
-    if latest and all_urls:
-        return [sort_url_list(cc_values, all_acqdates, all_urls).pop()]
-    return sort_url_list(cc_values, all_acqdates, all_urls)
+                            pathrows, sensor, latest=False):
+    """
+    Scan the csv once for all (path, row) pairs and return the urls found for
+    each of them.
+
+    Only the csv lines that mention one of the path / rows are parsed, and
+    those are filtered with vectorized comparisons.
+    """
+    import numpy as np
+    date_start = np.datetime64(date_start)
+    date_end = np.datetime64(date_end)
+    dtypes = {'SENSOR_ID': str, 'WRS_PATH': np.int64, 'WRS_ROW': np.int64,
+              'DATE_ACQUIRED': str, 'CLOUD_COVER': float, 'BASE_URL': str}
+    found = {(int(wr2path), int(wr2row)): [] for wr2path, wr2row in pathrows}
+    # Encode each path / row as a single integer so chunks can use isin
+    pathrow_codes = [wr2path * 1000 + wr2row for wr2path, wr2row in found]
+    # WRS_PATH and WRS_ROW are adjacent columns, so matching lines contain
+    # ",<path>,<row>,", with or without zero padding.
+    tokens = []
+    for wr2path, wr2row in found:
+        tokens.append(',{},{},'.format(wr2path, wr2row))
+        tokens.append(',{:03d},{:03d},'.format(wr2path, wr2row))
+    for chunk in iter_catalog_chunks(collection_file, dtypes, tokens=tokens,
+                                     desc='searching'):
+        codes = chunk['WRS_PATH'].values * 1000 + chunk['WRS_ROW'].values
+        chunk = chunk[(chunk['SENSOR_ID'].values == sensor) &
+                      np.isin(codes, pathrow_codes)]
+        if len(chunk) == 0:
+            continue
+        acqdates = catalog_dates(chunk['DATE_ACQUIRED'])
+        flags = ((chunk['CLOUD_COVER'].values <= cc_limit) &
+                 (acqdates > date_start) & (acqdates < date_end))
+        chunk = chunk[flags].assign(ACQ_DATE=acqdates[flags])
+        for key, group in chunk.groupby(['WRS_PATH', 'WRS_ROW']):
+            found[(int(key[0]), int(key[1]))].append(group)
+
+    scene_urls = {}
+    for key, groups in found.items():
+        cc_values, all_acqdates, all_urls = [], [], []
+        for group in groups:
+            cc_values.extend(group['CLOUD_COVER'].tolist())
+            all_acqdates.extend(group['ACQ_DATE'].tolist())
+            all_urls.extend(group['BASE_URL'].tolist())
+        urls = sort_url_list(cc_values, all_acqdates, all_urls)
+        scene_urls[key] = urls[-1:] if latest else urls
+    return scene_urls
+
+
+def query_landsat_catalogue_batch(collection_file, cc_limit, date_start,
+                                  date_end, scenes, sensor, latest=False,
+                                  use_csv=False, use_columnar=False):
+    """
+    Query the Landsat index catalogue for several WRS2 path / rows at once.
+
+    This is equivalent to calling :func:`query_landsat_catalogue` for each
+    scene, but answers all scenes with a single catalogue query.
+
+    Args:
+        scenes (List[str | Tuple[int, int]]): WRS2 scenes given either as a
+            'PPPRRR' string or as a (path, row) tuple
+
+    Returns:
+        Dict[str | Tuple[int, int], List[str]]: the urls found for each scene
+
+    Example:
+        >>> from fels.landsat import *  # NOQA
+        >>> collection_file = ensure_landsat_metadata()
+        >>> scene_urls = query_landsat_catalogue_batch(
+        >>>     collection_file, 30, '2015-01-01', '2015-06-30',
+        >>>     ['034032', '033032'], 'OLI_TIRS', latest=True)
+        >>> print('scene_urls = {}'.format(ubelt.repr2(scene_urls, nl=1)))
+    """
+    print('Searching for Landsat-{} images of {} scenes in catalog...'.format(
+        sensor, len(scenes)))
+    pathrows = [_scene_to_pathrow(scene) for scene in scenes]
+    if use_csv:
+        found = _query_landsat_with_csv(
+            collection_file, cc_limit, date_start, date_end, pathrows,
+            sensor, latest=latest)
+    elif use_columnar:
+        found = _query_landsat_with_columnar(
+            collection_file, cc_limit, date_start, date_end, pathrows,
+            sensor, latest=latest)
+    else:
+        found = _query_landsat_with_sqlite_batch(
+            collection_file, cc_limit, date_start, date_end, pathrows,
+            sensor, latest=latest)
+    return {scene: list(found[pathrow])
+            for scene, pathrow in zip(scenes, pathrows)}
+
+
+def _scene_to_pathrow(scene):
+    """
+    Example:
+        >>> _scene_to_pathrow('034032')
+        (34, 32)
+        >>> _scene_to_pathrow((203, 31))
+        (203, 31)
+    """
+    if isinstance(scene, tuple):
+        return int(scene[0]), int(scene[1])
+    return int(scene[0:3]), int(scene[3:6])
 
 
 def _query_landsat_with_sqlite(collection_file, cc_limit, date_start, date_end,
@@ -115,43 +219,79 @@ def _query_landsat_with_sqlite(collection_file, cc_limit, date_start, date_end,
     try:
         result = cur.execute(
             '''
-            SELECT BASE_URL, CLOUD_COVER, DATE_ACQUIRED from landsat WHERE
+            SELECT BASE_URL from landsat WHERE
 
-            WRS_PATH=? AND WRS_ROW=? AND SENSOR_ID=? AND CLOUD_COVER <= ?
-            and
-            date(DATE_ACQUIRED) BETWEEN date(?) AND date(?)
-            ''', (
+            WRS_PATH=? AND WRS_ROW=? AND SENSOR_ID=?
+            AND ACQ_DATE BETWEEN ? AND ? AND CLOUD_COVER <= ?
+            {order_clause}
+            '''.format(order_clause=sql_order_clause(latest)), (
                 int(wr2path),
                 int(wr2row),
                 sensor,
+                isodate_to_int(date_start),
+                isodate_to_int(date_end),
                 cc_limit,
-                date_start,
-                date_end,
             ))
-        cc_values = []
-        all_urls = []
-        all_acqdates = []
-        for found in result:
-            all_urls.append(found[0])
-            cc_values.append(found[1])
-            all_acqdates.append(dateutil.parser.isoparse(found[2]))
+        urls = [gs_to_http_url(found[0]) for found in result]
     finally:
         cur.close()
+    return urls
 
-    if latest and all_urls:
-        return [sort_url_list(cc_values, all_acqdates, all_urls).pop()]
-    return sort_url_list(cc_values, all_acqdates, all_urls)
+
+def _query_landsat_with_sqlite_batch(collection_file, cc_limit, date_start,
+                                     date_end, pathrows, sensor, latest=False):
+    conn = _ensure_landsat_sqlite_conn(collection_file)
+    cur = conn.cursor()
+    scene_urls = {pathrow: [] for pathrow in pathrows}
+    params = (sensor, isodate_to_int(date_start), isodate_to_int(date_end),
+              cc_limit)
+    if latest:
+        # A correlated subquery per scene only visits the latest row of each
+        query = '''
+            SELECT q.WRS_PATH, q.WRS_ROW, (
+                SELECT BASE_URL from landsat WHERE
+
+                WRS_PATH=q.WRS_PATH AND WRS_ROW=q.WRS_ROW AND SENSOR_ID=?
+                AND ACQ_DATE BETWEEN ? AND ? AND CLOUD_COVER <= ?
+                {order_clause}
+            ) FROM temp.query_pathrows AS q
+            '''
+    else:
+        query = '''
+            SELECT s.WRS_PATH, s.WRS_ROW, s.BASE_URL
+            FROM temp.query_pathrows AS q JOIN landsat AS s
+            ON s.WRS_PATH=q.WRS_PATH AND s.WRS_ROW=q.WRS_ROW WHERE
+
+            SENSOR_ID=? AND ACQ_DATE BETWEEN ? AND ? AND CLOUD_COVER <= ?
+            {order_clause}
+            '''
+    query = query.format(order_clause=sql_order_clause(latest))
+    try:
+        with sqlite_temp_table(cur, 'query_pathrows',
+                               ['WRS_PATH INTEGER', 'WRS_ROW INTEGER'],
+                               list(scene_urls)):
+            for wr2path, wr2row, url in cur.execute(query, params):
+                if url is not None:
+                    scene_urls[(wr2path, wr2row)].append(gs_to_http_url(url))
+    finally:
+        cur.close()
+    return scene_urls
 
 
 def _ensure_landsat_sqlite_conn(collection_file):
     tablename = 'landsat'
     fields = ['SCENE_ID', 'SENSOR_ID', 'PRODUCT_ID', 'BASE_URL',
               'DATE_ACQUIRED', 'WRS_PATH', 'WRS_ROW', 'CLOUD_COVER']
-    index_cols = ['WRS_ROW', 'WRS_PATH']
+    # Covers the path / row / sensor / date range / cloud cover filter and
+    # the result column of every query, in the order of sql_order_clause, so
+    # a scene is answered from one index range without a sort or table
+    # lookups
+    index_cols = [['WRS_PATH', 'WRS_ROW', 'SENSOR_ID', 'ACQ_DATE',
+                   'CLOUD_COVER DESC', 'BASE_URL']]
     table_create_cmd = ubelt.codeblock(
         '''
         CREATE TABLE landsat (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            id INTEGER PRIMARY KEY,
             SCENE_ID TEXT NOT NULL,
             SENSOR_ID TEXT NOT NULL,
             PRODUCT_ID TEXT NOT NULL,
@@ -159,17 +299,91 @@ def _ensure_landsat_sqlite_conn(collection_file):
             DATE_ACQUIRED TEXT NOT NULL,
             WRS_PATH INTEGER NOT NULL,
             WRS_ROW INTEGER NOT NULL,
-            CLOUD_COVER REAL NOT NULL
+            CLOUD_COVER REAL NOT NULL,
+            ACQ_DATE INTEGER NOT NULL
         );
         ''')
     conn = ensure_sqlite_csv_conn(
         collection_file, fields, table_create_cmd, tablename,
-        index_cols=index_cols, overwrite=False)
+        index_cols=index_cols, overwrite=False, date_field='DATE_ACQUIRED')
     return conn
 
 
-def get_landsat_image(url, outputdir, overwrite=False, sat='TM'):
-    """Download a Landsat image file."""
+def _query_landsat_with_columnar(collection_file, cc_limit, date_start,
+                                 date_end, pathrows, sensor, latest=False):
+    catalog = _ensure_landsat_columnar(collection_file)
+    scene_urls = {}
+    for wr2path, wr2row in pathrows:
+        keys = {'WRS_PATH': int(wr2path), 'WRS_ROW': int(wr2row),
+                'SENSOR_ID': sensor}
+        urls = catalog.search(keys, date_start, date_end, cc_limit,
+                              latest=latest)
+        scene_urls[(int(wr2path), int(wr2row))] = [
+            gs_to_http_url(url) for url in urls]
+    return scene_urls
+
+
+def _ensure_landsat_columnar(collection_file):
+    columns = {
+        'WRS_PATH': ('WRS_PATH', 'uint8'),
+        'WRS_ROW': ('WRS_ROW', 'uint8'),
+        'SENSOR_ID': ('SENSOR_ID', 'code'),
+        'ACQ_DATE': ('DATE_ACQUIRED', 'date'),
+        'CLOUD_COVER': ('CLOUD_COVER', 'float32'),
+        'BASE_URL': ('BASE_URL', 'string'),
+    }
+    sort_keys = ['WRS_PATH', 'WRS_ROW', 'SENSOR_ID', 'ACQ_DATE']
+    return ensure_columnar_catalog(collection_file, columns, sort_keys)
+
+
+def get_landsat_image(url, outputdir, overwrite=False, sat='TM', workers=1,
+                      verify=False, bands=None):
+    """
+    Download a Landsat image file.
+
+    Args:
+        url (str): the http url of the scene directory
+        outputdir (str): where to create the scene directory
+        overwrite (bool): download files that already exist
+        sat (str): the sensor, which determines the band files
+        workers (int): number of band files downloaded at the same time
+        verify (bool): check the files against the checksums of the remote
+            files and record the results, see :mod:`fels.verify`
+        bands (List[str] | None): only download these bands, e.g.
+            ``['B4', 'B5', 'BQA']``, and the metadata files. Defaults to all
+            bands.
+    """
+    start_time = time.time()
+    jobs = [job for _, job in plan_landsat_image(url, outputdir, overwrite,
+                                                 sat, verify=verify,
+                                                 bands=bands)]
+    results = run_jobs(jobs, workers=workers)
+    finalize_landsat_image(url, outputdir, results, bands=bands)
+    print('Downloaded scene {} in {:.1f}s'.format(
+        os.path.basename(url), time.time() - start_time))
+
+
+def plan_landsat_image(url, outputdir, overwrite=False, sat='TM',
+                       verify=False, bands=None):
+    """
+    Create the directory of a Landsat image and return the jobs that download
+    its band files, without running them.
+
+    Images that the ledger of ``outputdir`` lists as complete, with at least
+    the requested bands, have no jobs, see :mod:`fels.ledger`.
+
+    Args:
+        url (str): the http url of the scene directory
+        outputdir (str): where to create the scene directory
+        overwrite (bool): download files that already exist
+        sat (str): the sensor, which determines the band files
+        verify (bool): check the files against the checksums of the remote
+            files and record the results
+        bands (List[str] | None): see :func:`get_landsat_image`
+
+    Returns:
+        List[Tuple[str, Callable]]: the url and download job of each file
+    """
     img = os.path.basename(url)
     if sat == 'TM':
         possible_bands = ['B1.TIF', 'B2.TIF', 'B3.TIF', 'B4.TIF', 'B5.TIF',
@@ -188,34 +402,122 @@ def get_landsat_image(url, outputdir, overwrite=False, sat='TM'):
                           'B6.TIF', 'B6_VCID_1.TIF', 'B6_VCID_2.TIF', 'B7.TIF',
                           'B8.TIF', 'B9.TIF', 'ANG.txt', 'BQA.TIF', 'MTL.txt']
 
+    if bands is not None:
+        wanted = set(normalize_bands(bands))
+        possible_bands = [band for band in possible_bands
+                          if _file_band(band) in wanted | {None}]
+
     target_path = os.path.join(outputdir, img)
+    if (not overwrite and product_status(outputdir, img) == COMPLETE and
+            os.path.isdir(target_path) and
+            bands_cover(product_bands(outputdir, img),
+                        None if bands is None else normalize_bands(bands))):
+        print(img, 'was downloaded before and --overwrite option was not used. Skipping image download')
+        return []
 
     os.makedirs(target_path, exist_ok=True)
-    for band in possible_bands:
-        complete_url = url + '/' + img + '_' + band
-        target_file = os.path.join(target_path, img + '_' + band)
-        if os.path.exists(target_file) and not overwrite:
+    start_product(outputdir, img, url)
+    return [
+        (url + '/' + img + '_' + band,
+         functools.partial(_download_landsat_band, url, img, band,
+                           target_path, overwrite, verify))
+        for band in possible_bands]
+
+
+def finalize_landsat_image(url, outputdir, results, bands=None):
+    """
+    Record a Landsat image as complete in the ledger if none of the jobs of
+    its plan failed.
+
+    Args:
+        url (str): the http url of the scene directory
+        outputdir (str): the output directory
+        results (List[Exception | None]): the result of each job in the plan
+        bands (List[str] | None): the bands of the plan, if not all
+
+    Returns:
+        bool: True if the image is complete
+    """
+    flush_checksums(os.path.join(outputdir, os.path.basename(url)))
+    if any(error is not None for error in results):
+        return False
+    if results:
+        complete_product(outputdir, os.path.basename(url),
+                         bands=None if bands is None else normalize_bands(bands))
+    return True
+
+
+def normalize_bands(bands):
+    """
+    Convert band names to the form used in the Landsat file names.
+
+    Example:
+        >>> from fels.landsat import *  # NOQA
+        >>> normalize_bands(['b4', 'B05', '10', 'bqa', 'B6_vcid_1'])
+        ['B4', 'B5', 'B10', 'BQA', 'B6_VCID_1']
+    """
+    normalized = []
+    for band in bands:
+        band = band.strip().upper().lstrip('B')
+        if band[:1].isdigit():
+            band = band.lstrip('0') or '0'
+        normalized.append('B' + band)
+    return normalized
+
+
+def _file_band(band_file):
+    """
+    Return the band of a scene file suffix, or None for metadata files.
+
+    Example:
+        >>> from fels.landsat import _file_band
+        >>> _file_band('B6_VCID_1.TIF'), _file_band('BQA.TIF'), _file_band('MTL.txt')
+        ('B6_VCID_1', 'BQA', None)
+    """
+    name, ext = os.path.splitext(band_file)
+    return name if ext == '.TIF' else None
+
+
+def _download_landsat_band(url, img, band, target_path, overwrite=False,
+                           verify=False):
+    complete_url = url + '/' + img + '_' + band
+    target_file = os.path.join(target_path, img + '_' + band)
+    outputdir = os.path.dirname(target_path)
+    if os.path.exists(target_file) and not overwrite:
+        if not verify or check_existing_file(complete_url, target_path,
+                                             target_file):
             print(target_file, 'exists and --overwrite option was not used. Skipping image download')
-            continue
-        try:
-            content = urlopen(complete_url, timeout=600)
-        except HTTPError:
-            print('Could not find', band, 'band image file.')
-            continue
-        except URLError:
-            print('Timeout, Restart=======>')
-            time.sleep(10)
-            get_landsat_image(url, outputdir, overwrite, sat)
+            record_file(outputdir, target_file, img, complete_url)
             return
-        with open(target_file, 'wb') as f:
-            try:
-                shutil.copyfileobj(content, f)
-            except socket.timeout:
-                print('Socket Timeout, Restart=======>')
-                time.sleep(10)
-                get_landsat_image(url, outputdir, overwrite, sat)
-                return
-            print('Downloaded', target_file)
+        print(target_file, 'does not match the remote file, downloading it again')
+    elif not overwrite and is_missing_file(outputdir, target_file):
+        # Not every scene has every band
+        return
+    try:
+        if is_metadata_url(complete_url) and not verify:
+            download_cached(complete_url, target_file)
+            info = {'attempts': 1}
+        else:
+            info = download_file(complete_url, target_file, verify=verify)
+    except HTTPError as error:
+        if is_retryable(error):
+            print('Failed to download', complete_url, error)
+            return error
+        print('Could not find', band, 'band image file.')
+        if error.code in (404, 410):
+            record_missing_file(outputdir, target_file, img, complete_url)
+        return
+    except TRANSIENT_ERRORS + (ChecksumError,) as error:
+        print('Failed to download', complete_url, repr(error))
+        return error
+    if verify:
+        record_checksum(target_path, target_file, complete_url,
+                        info['expected'], info['verified'])
+    record_file(outputdir, target_file, img, complete_url)
+    if info['attempts'] > 1:
+        print('Downloaded', target_file, 'after', info['attempts'], 'attempts')
+    else:
+        print('Downloaded', target_file)
 
 
 def landsatdir_to_date(string, processing=False):
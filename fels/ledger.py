@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+"""
+A record of the downloads in an output directory.
+
+Each output directory gets a small sqlite database, ``.fels_ledger.sqlite``,
+with a row for every downloaded file and every product (a Landsat scene
+directory or a Sentinel-2 SAFE product). A product is marked complete only
+after all of its files were downloaded, so a later run can skip it with one
+indexed lookup, and a product that an earlier run left incomplete is
+resumed instead of being skipped because its directory exists.
+
+Files that the manifest of a product lists, but that the bucket does not
+have, are recorded as missing, so later runs do not request them again.
+
+Paths are stored relative to the output directory, so it can be moved.
+"""
+from __future__ import absolute_import, division, print_function
+import atexit
+import os
+import sqlite3
+import threading
+import time
+import ubelt
+
+
+# Name of the ledger database of an output directory
+LEDGER_FNAME = '.fels_ledger.sqlite'
+
+# Value of the bands column of products downloaded with all bands
+ALL_BANDS = '*'
+
+# Product states
+INCOMPLETE = 'incomplete'
+COMPLETE = 'complete'
+REJECTED = 'rejected'
+PARTIAL = 'partial'
+
+# State of a file that the server does not have
+MISSING = 'missing'
+
+LEDGER_CREATE_CMD = ubelt.codeblock(
+    '''
+    CREATE TABLE IF NOT EXISTS products (
+        name TEXT PRIMARY KEY,
+        url TEXT,
+        path TEXT,
+        status TEXT NOT NULL,
+        num_files INTEGER,
+        size INTEGER,
+        started REAL,
+        completed REAL,
+        bands TEXT
+    );
+    CREATE TABLE IF NOT EXISTS files (
+        path TEXT PRIMARY KEY,
+        product TEXT NOT NULL,
+        url TEXT,
+        size INTEGER NOT NULL,
+        mtime REAL,
+        completed REAL NOT NULL,
+        status TEXT
+    );
+    CREATE INDEX IF NOT EXISTS files_product ON files (product);
+    ''')
+
+# Connections by ledger path. They are shared by the download threads, which
+# take turns through _LEDGER_LOCK.
+_LEDGER_CONNECTIONS = {}
+_LEDGER_LOCK = threading.RLock()
+
+
+def connect_ledger(outputdir):
+    """
+    Open the ledger of an output directory, creating it if needed.
+
+    Args:
+        outputdir (str): the output directory
+
+    Returns:
+        sqlite3.Connection: a connection in autocommit mode. Use it while
+        holding ``_LEDGER_LOCK``.
+    """
+    fpath = os.path.abspath(os.path.join(outputdir, LEDGER_FNAME))
+    with _LEDGER_LOCK:
+        conn = _LEDGER_CONNECTIONS.get(fpath)
+        if conn is None:
+            os.makedirs(outputdir, exist_ok=True)
+            conn = sqlite3.connect(fpath, timeout=30, isolation_level=None,
+                                   check_same_thread=False)
+            conn.executescript(LEDGER_CREATE_CMD)
+            columns = [row[1] for row in
+                       conn.execute('PRAGMA table_info(products)')]
+            if 'bands' not in columns:
+                # Ledgers written before downloads could select bands
+                conn.execute('ALTER TABLE products ADD COLUMN bands TEXT')
+            columns = [row[1] for row in
+                       conn.execute('PRAGMA table_info(files)')]
+            if 'status' not in columns:
+                # Ledgers written before missing files were recorded
+                conn.execute('ALTER TABLE files ADD COLUMN status TEXT')
+            _LEDGER_CONNECTIONS[fpath] = conn
+    return conn
+
+
+def product_status(outputdir, name):
+    """
+    Look up the state of a product.
+
+    Returns:
+        str | None: ``'complete'``, ``'incomplete'``, ``'rejected'``,
+        ``'partial'``, or None if the product is not in the ledger
+
+    Example:
+        >>> from fels.ledger import *  # NOQA
+        >>> import tempfile
+        >>> outputdir = tempfile.mkdtemp()
+        >>> print(product_status(outputdir, 'LC08_L1TP_034032_20170301'))
+        None
+        >>> start_product(outputdir, 'LC08_L1TP_034032_20170301')
+        >>> product_status(outputdir, 'LC08_L1TP_034032_20170301')
+        'incomplete'
+        >>> complete_product(outputdir, 'LC08_L1TP_034032_20170301')
+        >>> product_status(outputdir, 'LC08_L1TP_034032_20170301')
+        'complete'
+    """
+    with _LEDGER_LOCK:
+        row = connect_ledger(outputdir).execute(
+            'SELECT status FROM products WHERE name = ?', (name,)).fetchone()
+    return None if row is None else row[0]
+
+
+def product_path(outputdir, name):
+    """
+    Return the directory of a product that is in the ledger.
+
+    Returns:
+        str | None: the path, or None if the product is not in the ledger
+    """
+    with _LEDGER_LOCK:
+        row = connect_ledger(outputdir).execute(
+            'SELECT path FROM products WHERE name = ?', (name,)).fetchone()
+    if row is None:
+        return None
+    return os.path.join(outputdir, *row[0].split('/'))
+
+
+def product_bands(outputdir, name):
+    """
+    Return the bands that were downloaded of a complete product.
+
+    Returns:
+        List[str] | None: the bands, or None if all bands were downloaded
+    """
+    with _LEDGER_LOCK:
+        row = connect_ledger(outputdir).execute(
+            'SELECT bands FROM products WHERE name = ?', (name,)).fetchone()
+    # Products completed before bands were recorded have all bands
+    if row is None or row[0] is None or row[0] == ALL_BANDS:
+        return None
+    return row[0].split(',')
+
+
+def bands_cover(have, want):
+    """
+    Check if downloaded bands include the wanted bands. None means all.
+
+    Example:
+        >>> from fels.ledger import *  # NOQA
+        >>> bands_cover(None, ['B4'])
+        True
+        >>> bands_cover(['B4', 'B5'], ['B4'])
+        True
+        >>> bands_cover(['B4'], None)
+        False
+    """
+    if have is None:
+        return True
+    if want is None:
+        return False
+    return set(want) <= set(have)
+
+
+def start_product(outputdir, name, url=None, num_files=None):
+    """
+    Mark a product as incomplete before its files are downloaded.
+
+    Args:
+        outputdir (str): the output directory
+        name (str): the product name, i.e. the basename of its url
+        url (str | None): where the product is downloaded from
+        num_files (int | None): number of files of the product, if known
+    """
+    _set_product(outputdir, name, INCOMPLETE, url=url, num_files=num_files)
+
+
+def reject_product(outputdir, name, url=None, status=REJECTED):
+    """
+    Mark a product that is not downloaded, and forget its files.
+
+    Args:
+        outputdir (str): the output directory
+        name (str): the product name
+        url (str | None): where the product would be downloaded from
+        status (str): why the product is rejected: ``'rejected'`` for old
+            format products or ``'partial'`` for partial tiles
+    """
+    with _LEDGER_LOCK:
+        connect_ledger(outputdir).execute(
+            'DELETE FROM files WHERE product = ?', (name,))
+        _set_product(outputdir, name, status, url=url)
+
+
+def complete_product(outputdir, name, path=None, bands=None):
+    """
+    Mark a product as complete once all of its files were downloaded.
+
+    Args:
+        outputdir (str): the output directory
+        name (str): the product name
+        path (str | None): the directory of the product, if it is not
+            ``outputdir/name``
+        bands (List[str] | None): the bands that were downloaded, if not
+            all. They are added to the bands that an earlier run completed.
+    """
+    if path is None:
+        path = os.path.join(outputdir, name)
+    rel_path = os.path.relpath(path, outputdir).replace(os.sep, '/')
+    with _LEDGER_LOCK:
+        conn = connect_ledger(outputdir)
+        num_files, size = conn.execute(
+            'SELECT count(*), sum(size) FROM files '
+            'WHERE product = ? AND status IS NULL', (name,)).fetchone()
+        row = conn.execute('SELECT bands FROM products WHERE name = ?',
+                           (name,)).fetchone()
+        done = None if row is None else row[0]
+        if bands is None or done == ALL_BANDS:
+            bands = ALL_BANDS
+        else:
+            if done is not None:
+                bands = set(bands) | set(done.split(','))
+            bands = ','.join(sorted(bands))
+        _set_product(outputdir, name, COMPLETE, path=rel_path,
+                     num_files=num_files, size=size or 0,
+                     completed=time.time(), bands=bands)
+
+
+def forget_product(outputdir, name):
+    """
+    Remove a product and its files from the ledger, e.g. after they were
+    deleted.
+    """
+    with _LEDGER_LOCK:
+        conn = connect_ledger(outputdir)
+        conn.execute('BEGIN')
+        conn.execute('DELETE FROM files WHERE product = ?', (name,))
+        conn.execute('DELETE FROM products WHERE name = ?', (name,))
+        conn.execute('COMMIT')
+
+
+def reopen_product(outputdir, path):
+    """
+    Mark the product in a directory as incomplete again, e.g. because one of
+    its files is damaged, so the next run resumes it.
+
+    Args:
+        outputdir (str): the output directory
+        path (str): the directory of the product
+
+    Returns:
+        bool: True if the directory belongs to a product in the ledger
+    """
+    rel_path = os.path.relpath(path, outputdir).replace(os.sep, '/')
+    with _LEDGER_LOCK:
+        cur = connect_ledger(outputdir).execute(
+            'UPDATE products SET status = ?, completed = NULL WHERE path = ?',
+            (INCOMPLETE, rel_path))
+    return cur.rowcount > 0
+
+
+def record_file(outputdir, fpath, product, url=None):
+    """
+    Record a file that was downloaded completely.
+
+    Args:
+        outputdir (str): the output directory
+        fpath (str): the downloaded file inside of ``outputdir``
+        product (str): the name of the product the file belongs to
+        url (str | None): where the file was downloaded from
+    """
+    stat = os.stat(fpath)
+    rel_path = os.path.relpath(fpath, outputdir).replace(os.sep, '/')
+    with _LEDGER_LOCK:
+        connect_ledger(outputdir).execute(
+            'INSERT OR REPLACE INTO files '
+            '(path, product, url, size, mtime, completed) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (rel_path, product, url, stat.st_size, stat.st_mtime, time.time()))
+
+
+def ledger_files(outputdir):
+    """
+    List the downloaded files of the ledger of an output directory. Missing
+    files are not listed.
+
+    Returns:
+        List[Tuple[str, str | None, str]]: the path, the url and the
+        product directory of each file
+    """
+    with _LEDGER_LOCK:
+        rows = connect_ledger(outputdir).execute(
+            'SELECT files.path, files.url, files.product, products.path '
+            'FROM files JOIN products ON files.product = products.name '
+            'WHERE files.status IS NULL ORDER BY files.path').fetchall()
+    found = []
+    for rel_path, url, name, product_rel_path in rows:
+        # Files keep the path they were downloaded to when their product
+        # directory is renamed afterwards
+        if rel_path.startswith(name + '/') and product_rel_path != name:
+            rel_path = product_rel_path + rel_path[len(name):]
+        found.append((os.path.join(outputdir, *rel_path.split('/')), url,
+                      os.path.join(outputdir, *product_rel_path.split('/'))))
+    return found
+
+
+def record_missing_file(outputdir, fpath, product, url=None):
+    """
+    Record a file of a product that the server does not have, e.g. because
+    the answer was a 404.
+
+    Args:
+        outputdir (str): the output directory
+        fpath (str): where the file would be written inside of ``outputdir``
+        product (str): the name of the product the file belongs to
+        url (str | None): where the file was requested
+
+    Example:
+        >>> from fels.ledger import *  # NOQA
+        >>> import tempfile
+        >>> outputdir = tempfile.mkdtemp()
+        >>> fpath = os.path.join(outputdir, 'S2A.SAFE', 'HTML', 'banner.png')
+        >>> is_missing_file(outputdir, fpath)
+        False
+        >>> record_missing_file(outputdir, fpath, 'S2A.SAFE')
+        >>> is_missing_file(outputdir, fpath)
+        True
+    """
+    rel_path = os.path.relpath(fpath, outputdir).replace(os.sep, '/')
+    with _LEDGER_LOCK:
+        connect_ledger(outputdir).execute(
+            'INSERT OR REPLACE INTO files '
+            '(path, product, url, size, mtime, completed, status) '
+            'VALUES (?, ?, ?, 0, NULL, ?, ?)',
+            (rel_path, product, url, time.time(), MISSING))
+
+
+def is_missing_file(outputdir, fpath):
+    """
+    Check if an earlier run found that the server does not have a file.
+    """
+    rel_path = os.path.relpath(fpath, outputdir).replace(os.sep, '/')
+    with _LEDGER_LOCK:
+        row = connect_ledger(outputdir).execute(
+            'SELECT status FROM files WHERE path = ?', (rel_path,)).fetchone()
+    return row is not None and row[0] == MISSING
+
+
+def _set_product(outputdir, name, status, url=None, path=None,
+                 num_files=None, size=None, completed=None, bands=None):
+    # Values that are not given keep what an earlier run recorded
+    if path is None:
+        path = name
+    with _LEDGER_LOCK:
+        connect_ledger(outputdir).execute(
+            'INSERT INTO products '
+            '(name, url, path, status, num_files, size, started, completed, '
+            'bands) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (name) DO UPDATE SET '
+            'url = coalesce(excluded.url, url), path = excluded.path, '
+            'status = excluded.status, '
+            'num_files = coalesce(excluded.num_files, num_files), '
+            'size = excluded.size, completed = excluded.completed, '
+            'bands = coalesce(excluded.bands, bands)',
+            (name, url, path, status, num_files, size, time.time(), completed,
+             bands))
+
+
+@atexit.register
+def _close_ledgers():
+    with _LEDGER_LOCK:
+        for conn in _LEDGER_CONNECTIONS.values():
+            conn.close()
+        _LEDGER_CONNECTIONS.clear()
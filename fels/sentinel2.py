@@ -1,34 +1,62 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function
-import csv
 import datetime
-import dateutil
+import functools
 import glob
-import numpy as np
 import os
+import re
 import shutil
 import sys
+import time
 import ubelt
 import xml.etree.ElementTree as ET
-from tempfile import NamedTemporaryFile
 try:
-    from urllib2 import urlopen
     from urllib2 import HTTPError
 except ImportError:
-    from urllib.request import urlopen, HTTPError
+    from urllib.request import HTTPError
 
+from fels.cache import download_cached, fetch_cached, is_metadata_url
+from fels.columnar import ensure_columnar_catalog
+from fels.download import (
+    download_file, is_retryable, run_jobs, TRANSIENT_ERRORS)
 from fels.utils import (
-    sort_url_list, download_metadata_file, ensure_sqlite_csv_conn)
+    sort_url_list, download_metadata_file, ensure_sqlite_csv_conn,
+    iter_catalog_chunks, catalog_dates, isodate_to_int, gs_to_http_url, sql_order_clause,
+    sqlite_temp_table)
+from fels.ledger import (
+    bands_cover, complete_product, is_missing_file, product_bands,
+    product_path, product_status, record_file, record_missing_file,
+    reject_product, start_product, COMPLETE, PARTIAL, REJECTED)
+from fels.verify import (
+    ChecksumError, check_existing_file, flush_checksums, record_checksum)
 
 
 SENTINEL2_METADATA_URL = 'http://storage.googleapis.com/gcp-public-data-sentinel-2/index.csv.gz'
 
+# Approximate number of pixels read at a time by check_full_tile
+FULL_TILE_STRIP_PIXELS = 2 ** 22
 
-def ensure_sentinel2_metadata(outputdir=None):
-    return download_metadata_file(SENTINEL2_METADATA_URL, outputdir, 'Sentinel')
+# The band of a file name, e.g. T13TDE_20170301T175000_B04.jp2 or
+# MSK_DETFOO_B8A.gml
+_FILE_BAND_PATTERN = re.compile(r'_(B\d\d|B8A|TCI)\.\w+$')
 
 
-def query_sentinel2_catalogue(collection_file, cc_limit, date_start, date_end, tile, latest=False, use_csv=False):
+def ensure_sentinel2_metadata(outputdir=None, unzip=False, refresh=False):
+    """
+    Download the Sentinel catalogue if needed and return its path.
+
+    Args:
+        outputdir (str | None): where to store the catalogue
+        unzip (bool): if True, keep an uncompressed csv on disk. Otherwise
+            the gzipped catalogue is streamed directly into the sqlite cache.
+        refresh (bool): if True, download a new copy of the catalogue.
+    """
+    return download_metadata_file(
+        SENTINEL2_METADATA_URL, outputdir, 'Sentinel', unzip=unzip, refresh=refresh)
+
+
+def query_sentinel2_catalogue(collection_file, cc_limit, date_start, date_end, tile, latest=False, use_csv=False,
+                              use_columnar=False):
     """
     Query the Sentinel-2 index catalogue and retrieve urls for the best images
     found.
@@ -67,7 +95,11 @@ def query_sentinel2_catalogue(collection_file, cc_limit, date_start, date_end, t
     print('Searching for Sentinel-2 images in catalog...')
     if use_csv:
         return _query_sentinel2_with_csv(collection_file, cc_limit, date_start,
-                                         date_end, tile, latest=latest)
+                                         date_end, [tile], latest=latest)[tile]
+    elif use_columnar:
+        return _query_sentinel2_with_columnar(collection_file, cc_limit,
+                                              date_start, date_end, [tile],
+                                              latest=latest)[tile]
     else:
         # Generally SQL is faster
         return _query_sentinel2_with_sqlite(collection_file, cc_limit,
@@ -76,26 +108,81 @@ def query_sentinel2_catalogue(collection_file, cc_limit, date_start, date_end, t
 
 
 def _query_sentinel2_with_csv(collection_file, cc_limit, date_start, date_end,
-                              tile, latest=False):
-    cc_values = []
-    all_urls = []
-    all_acqdates = []
-    with open(collection_file) as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in ubelt.ProgIter(reader, desc='searching S2'):
-            year_acq = int(row['SENSING_TIME'][0:4])
-            month_acq = int(row['SENSING_TIME'][5:7])
-            day_acq = int(row['SENSING_TIME'][8:10])
-            acqdate = datetime.datetime(year_acq, month_acq, day_acq)
-            if row['MGRS_TILE'] == tile and float(row['CLOUD_COVER']) <= cc_limit \
-                    and date_start < acqdate < date_end:
-                all_urls.append(row['BASE_URL'])
-                cc_values.append(float(row['CLOUD_COVER']))
-                all_acqdates.append(acqdate)
-
-    if latest and all_urls:
-        return [sort_url_list(cc_values, all_acqdates, all_urls).pop()]
-    return sort_url_list(cc_values, all_acqdates, all_urls)
+                              tiles, latest=False):
+    """
+    Scan the csv once for all tiles and return the urls found for each tile.
+
+    Only the csv lines that mention one of the tiles are parsed, and those
+    are filtered with vectorized comparisons.
+    """
+    import numpy as np
+    date_start = np.datetime64(date_start)
+    date_end = np.datetime64(date_end)
+    dtypes = {'MGRS_TILE': str, 'SENSING_TIME': str, 'CLOUD_COVER': float,
+              'BASE_URL': str}
+    found = {tile: [] for tile in tiles}
+    # MGRS_TILE is a middle column, so matching lines contain ",<tile>,"
+    tokens = [',{},'.format(tile) for tile in tiles]
+    for chunk in iter_catalog_chunks(collection_file, dtypes, tokens=tokens,
+                                     desc='searching S2'):
+        chunk = chunk[chunk['MGRS_TILE'].isin(list(found))]
+        if len(chunk) == 0:
+            continue
+        acqdates = catalog_dates(chunk['SENSING_TIME'])
+        flags = ((chunk['CLOUD_COVER'].values <= cc_limit) &
+                 (acqdates > date_start) & (acqdates < date_end))
+        chunk = chunk[flags].assign(ACQ_DATE=acqdates[flags])
+        for tile, group in chunk.groupby('MGRS_TILE'):
+            found[tile].append(group)
+
+    scene_urls = {}
+    for tile, groups in found.items():
+        cc_values, all_acqdates, all_urls = [], [], []
+        for group in groups:
+            cc_values.extend(group['CLOUD_COVER'].tolist())
+            all_acqdates.extend(group['ACQ_DATE'].tolist())
+            all_urls.extend(group['BASE_URL'].tolist())
+        urls = sort_url_list(cc_values, all_acqdates, all_urls)
+        scene_urls[tile] = urls[-1:] if latest else urls
+    return scene_urls
+
+
+def query_sentinel2_catalogue_batch(collection_file, cc_limit, date_start,
+                                    date_end, tiles, latest=False,
+                                    use_csv=False, use_columnar=False):
+    """
+    Query the Sentinel-2 index catalogue for several tiles at once.
+
+    This is equivalent to calling :func:`query_sentinel2_catalogue` for each
+    tile, but answers all tiles with a single catalogue query.
+
+    Args:
+        tiles (List[str]): MGRS tiles, e.g. ['13TDE', '52SDG']
+
+    Returns:
+        Dict[str, List[str]]: the urls found for each tile
+
+    Example:
+        >>> from fels.sentinel2 import *  # NOQA
+        >>> collection_file = ensure_sentinel2_metadata()
+        >>> scene_urls = query_sentinel2_catalogue_batch(
+        >>>     collection_file, 30, '2018-01-01', '2018-06-30',
+        >>>     ['13TDE', '13TDF'], latest=True)
+        >>> print('scene_urls = {}'.format(ubelt.repr2(scene_urls, nl=1)))
+    """
+    print('Searching for Sentinel-2 images of {} tiles in catalog...'.format(
+        len(tiles)))
+    if use_csv:
+        return _query_sentinel2_with_csv(collection_file, cc_limit, date_start,
+                                         date_end, tiles, latest=latest)
+    elif use_columnar:
+        return _query_sentinel2_with_columnar(collection_file, cc_limit,
+                                              date_start, date_end, tiles,
+                                              latest=latest)
+    else:
+        return _query_sentinel2_with_sqlite_batch(
+            collection_file, cc_limit, date_start, date_end, tiles,
+            latest=latest)
 
 
 def _query_sentinel2_with_sqlite(collection_file, cc_limit, date_start, date_end, tile, latest=False):
@@ -106,139 +193,575 @@ def _query_sentinel2_with_sqlite(collection_file, cc_limit, date_start, date_end
         # times detailed in the docs
         result = cur.execute(
             '''
-            SELECT BASE_URL, CLOUD_COVER, SENSING_TIME from sentinel2 WHERE
+            SELECT BASE_URL from sentinel2 WHERE
 
-            MGRS_TILE=? AND CLOUD_COVER <= ?
-            and
-            date(SENSING_TIME) BETWEEN date(?) AND date(?)
-            ''', (
+            MGRS_TILE=? AND ACQ_DATE BETWEEN ? AND ? AND CLOUD_COVER <= ?
+            {order_clause}
+            '''.format(order_clause=sql_order_clause(latest)), (
                 tile,
+                isodate_to_int(date_start),
+                isodate_to_int(date_end),
                 cc_limit,
-                date_start,
-                date_end,
             ))
-        cc_values = []
-        all_urls = []
-        all_acqdates = []
-        for found in result:
-            all_urls.append(found[0])
-            cc_values.append(found[1])
-            all_acqdates.append(dateutil.parser.isoparse(found[2]))
+        urls = [gs_to_http_url(found[0]) for found in result]
     finally:
         cur.close()
+    return urls
+
 
-    if latest and all_urls:
-        return [sort_url_list(cc_values, all_acqdates, all_urls).pop()]
-    return sort_url_list(cc_values, all_acqdates, all_urls)
+def _query_sentinel2_with_sqlite_batch(collection_file, cc_limit, date_start,
+                                       date_end, tiles, latest=False):
+    conn = _ensure_sentinel2_sqlite_conn(collection_file)
+    cur = conn.cursor()
+    scene_urls = {tile: [] for tile in tiles}
+    params = (isodate_to_int(date_start), isodate_to_int(date_end), cc_limit)
+    if latest:
+        # A correlated subquery per tile only visits the latest row of each
+        query = '''
+            SELECT q.MGRS_TILE, (
+                SELECT BASE_URL from sentinel2 WHERE
+
+                MGRS_TILE=q.MGRS_TILE AND ACQ_DATE BETWEEN ? AND ?
+                AND CLOUD_COVER <= ?
+                {order_clause}
+            ) FROM temp.query_tiles AS q
+            '''
+    else:
+        query = '''
+            SELECT s.MGRS_TILE, s.BASE_URL
+            FROM temp.query_tiles AS q JOIN sentinel2 AS s
+            ON s.MGRS_TILE=q.MGRS_TILE WHERE
+
+            ACQ_DATE BETWEEN ? AND ? AND CLOUD_COVER <= ?
+            {order_clause}
+            '''
+    query = query.format(order_clause=sql_order_clause(latest))
+    try:
+        with sqlite_temp_table(cur, 'query_tiles', ['MGRS_TILE TEXT'],
+                               [(tile,) for tile in scene_urls]):
+            for tile, url in cur.execute(query, params):
+                if url is not None:
+                    scene_urls[tile].append(gs_to_http_url(url))
+    finally:
+        cur.close()
+    return scene_urls
 
 
 def _ensure_sentinel2_sqlite_conn(collection_file):
     tablename = 'sentinel2'
     fields = ['SENSING_TIME', 'CLOUD_COVER', 'BASE_URL', 'MGRS_TILE']
-    index_cols = ['MGRS_TILE']
+    # Covers the tile / date range / cloud cover filter and the result
+    # column of every query, in the order of sql_order_clause, so a tile is
+    # answered from one index range without a sort or table lookups
+    index_cols = [['MGRS_TILE', 'ACQ_DATE', 'CLOUD_COVER DESC', 'BASE_URL']]
     table_create_cmd = ubelt.codeblock(
         '''
         CREATE TABLE sentinel2 (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            id INTEGER PRIMARY KEY,
             SENSING_TIME TEXT NOT NULL,
             MGRS_TILE TEXT NOT NULL,
             BASE_URL TEXT NOT NULL,
-            CLOUD_COVER REAL NOT NULL
+            CLOUD_COVER REAL NOT NULL,
+            ACQ_DATE INTEGER NOT NULL
         );
         ''')
     conn = ensure_sqlite_csv_conn(
         collection_file, fields, table_create_cmd, tablename,
-        index_cols=index_cols, overwrite=False)
+        index_cols=index_cols, overwrite=False, date_field='SENSING_TIME')
     return conn
 
 
-def get_sentinel2_image(url, outputdir, overwrite=False, partial=False, noinspire=False, reject_old=False):
+def _query_sentinel2_with_columnar(collection_file, cc_limit, date_start,
+                                   date_end, tiles, latest=False):
+    catalog = _ensure_sentinel2_columnar(collection_file)
+    scene_urls = {}
+    for tile in tiles:
+        urls = catalog.search({'MGRS_TILE': tile}, date_start, date_end,
+                              cc_limit, latest=latest)
+        scene_urls[tile] = [gs_to_http_url(url) for url in urls]
+    return scene_urls
+
+
+def _ensure_sentinel2_columnar(collection_file):
+    columns = {
+        'MGRS_TILE': ('MGRS_TILE', 'code'),
+        'ACQ_DATE': ('SENSING_TIME', 'date'),
+        'CLOUD_COVER': ('CLOUD_COVER', 'float32'),
+        'BASE_URL': ('BASE_URL', 'string'),
+    }
+    sort_keys = ['MGRS_TILE', 'ACQ_DATE']
+    return ensure_columnar_catalog(collection_file, columns, sort_keys)
+
+
+def get_sentinel2_image(url, outputdir, overwrite=False, partial=False, noinspire=False, reject_old=False,
+                        workers=1, verify=False, partial_thresh=0.0,
+                        partial_overviews=False, bands=None):
     """
     Collect the entire dir structure of the image files from the
     manifest.safe file and build the same structure in the output
     location.
 
+    With ``partial``, only the B01 band is downloaded first, and the rest of
+    the image only if the tile is full, see :func:`plan_sentinel2_image`.
+
+    Args:
+        workers (int): number of files downloaded at the same time
+        verify (bool): check the files against the checksums of the remote
+            files and record the results, see :mod:`fels.verify`
+        partial_thresh (float): with ``partial``, the fraction of no-data
+            pixels above which a tile is partial, see :func:`check_full_tile`
+        partial_overviews (bool): with ``partial``, check an overview of the
+            band instead of the full resolution band
+        bands (List[str] | None): only download the files of these bands,
+            e.g. ``['B04', 'B08']``, and the files that do not belong to a
+            band, such as the metadata. Defaults to all bands.
+
     Returns:
         True if image was downloaded
         False if partial=False and image was not fully downloaded
+            or if some of its files failed to download. Files that the
+            bucket does not have are reported, but do not fail the image.
             or if reject_old=True and it is old-format
             or if noinspire=False and INSPIRE file is missing
     """
+    plan = plan_sentinel2_image(url, outputdir, overwrite, reject_old,
+                                verify=verify, partial=partial,
+                                partial_thresh=partial_thresh,
+                                partial_overviews=partial_overviews,
+                                bands=bands)
+    start_time = time.time()
+    results = run_jobs([job for _, job in plan['jobs']], workers=workers)
+    if plan['jobs']:
+        print('Downloaded {} in {:.1f}s'.format(
+            os.path.basename(url), time.time() - start_time))
+    return finalize_sentinel2_image(plan, results, partial, noinspire,
+                                    reject_old, partial_thresh=partial_thresh,
+                                    partial_overviews=partial_overviews)
+
+
+def plan_sentinel2_image(url, outputdir, overwrite=False, reject_old=False,
+                         verify=False, partial=False, partial_thresh=0.0,
+                         partial_overviews=False, bands=None):
+    """
+    Fetch the manifest of a Sentinel-2 image, create its directories and
+    return the jobs that download its files, without running them.
+
+    Images that the ledger of ``outputdir`` lists as complete, with at least
+    the requested bands, are not downloaded again. Incomplete images, and image directories from before
+    the ledger, are resumed: only their missing files are downloaded. See
+    :mod:`fels.ledger`.
+
+    With ``partial``, the B01 band is downloaded and checked right away, and
+    partial tiles are removed before the rest of their files is downloaded.
+    The decision is recorded in the ledger, so later runs with ``partial``
+    skip the tile without any request.
+
+    Args:
+        url (str): the http url of the SAFE product
+        outputdir (str): where to create the product directory
+        overwrite (bool): download the product even if it exists
+        reject_old (bool): skip old-format products
+        verify (bool): check the files against the checksums of the remote
+            files and record the results
+        partial (bool): skip partial tiles
+        partial_thresh (float): see :func:`get_sentinel2_image`
+        partial_overviews (bool): see :func:`get_sentinel2_image`
+        bands (List[str] | None): see :func:`get_sentinel2_image`. With
+            ``partial``, B01 is always downloaded, as it is used for the
+            check.
+
+    Returns:
+        Dict: the plan. Its ``'jobs'`` are the url and download job of each
+        file. Pass the plan and the job results to
+        :func:`finalize_sentinel2_image`.
+    """
     img = os.path.basename(url)
     target_path = os.path.join(outputdir, img)
     target_manifest = os.path.join(target_path, 'manifest.safe')
+    if bands is not None:
+        bands = normalize_bands(bands)
+        if partial and 'B01' not in bands:
+            bands.append('B01')
+    plan = {
+        'url': url,
+        'target_path': target_path,
+        'outputdir': outputdir,
+        'bands': bands,
+        'download': False,
+        'rejected': False,
+        'tile_checked': False,
+        'jobs': [],
+    }
+    status = None if overwrite else product_status(outputdir, img)
+    if status == COMPLETE:
+        # The directory may have been renamed after the INSPIRE title
+        done_path = product_path(outputdir, img)
+        if not os.path.isdir(done_path):
+            print('{} was removed, downloading it again'.format(done_path))
+        elif bands_cover(product_bands(outputdir, img), bands):
+            plan['target_path'] = done_path
+            return plan
+        else:
+            # Download the missing bands next to the ones we have
+            target_path = plan['target_path'] = done_path
+            target_manifest = os.path.join(target_path, 'manifest.safe')
+    elif (status == REJECTED and reject_old) or (status == PARTIAL and partial):
+        print('Skipping {} image {}, as decided by an earlier run'.format(
+            'old-format' if status == REJECTED else 'partial tile', img))
+        plan['rejected'] = True
+        return plan
+
+    manifest = fetch_cached(url + '/manifest.safe')
+
+    # check contents of manifest before downloading the rest
+    if reject_old and not _manifest_is_new(manifest.decode('utf-8')):
+        reject_product(outputdir, img, url)
+        plan['rejected'] = True
+        return plan
+
+    os.makedirs(target_path, exist_ok=True)
+    with open(target_manifest, 'wb') as f:
+        f.write(manifest)
+    rel_paths = _manifest_rel_paths(target_manifest, bands=bands)
+    start_product(outputdir, img, url, num_files=len(rel_paths))
+    jobs = _sentinel2_file_jobs(url, target_path, rel_paths, verify=verify,
+                                overwrite=overwrite, outputdir=outputdir)
+
+    if partial:
+        # Check the small B01 band before downloading gigabytes of the rest
+        # Products without the band are reported by finalize_sentinel2_image
+        band_idx = _tile_band_index(img, rel_paths, 'B01')
+        if band_idx is not None and jobs[band_idx][1]() is None:
+            # Downloaded, the other jobs do not fetch it again
+            jobs.pop(band_idx)
+            band_fpath = os.path.join(target_path,
+                                      *rel_paths[band_idx].split('/')[1:])
+            tile_chk = check_full_tile(band_fpath, nodata_thresh=partial_thresh,
+                                       use_overviews=partial_overviews)
+            if tile_chk == 'Partial':
+                print('Skipping partial tile image {}'.format(img))
+                shutil.rmtree(target_path)
+                reject_product(outputdir, img, url, status=PARTIAL)
+                plan['rejected'] = True
+                return plan
+            plan['tile_checked'] = True
+
+    plan['download'] = True
+    plan['jobs'] = jobs
+    return plan
+
+
+def finalize_sentinel2_image(plan, results, partial=False, noinspire=False,
+                             reject_old=False, partial_thresh=0.0,
+                             partial_overviews=False):
+    """
+    Check and rename a Sentinel-2 image after the jobs of its plan ran.
+
+    Args:
+        plan (Dict): from :func:`plan_sentinel2_image`
+        results (List[Exception | None]): the result of each job in the plan
+        partial_thresh (float): see :func:`get_sentinel2_image`
+        partial_overviews (bool): see :func:`get_sentinel2_image`
+
+    Returns:
+        bool: see :func:`get_sentinel2_image`
+    """
+    if plan['rejected']:
+        return False
+    target_path = plan['target_path']
+    target_manifest = os.path.join(target_path, 'manifest.safe')
+    name = os.path.basename(plan['url'])
+
+    # Before the directory is renamed or removed
+    flush_checksums(target_path)
 
     return_status = True
-    if not os.path.exists(target_path) or overwrite:
-
-        manifest_url = url + '/manifest.safe'
-
-        if reject_old:
-            # check contents of manifest before downloading the rest
-            content = urlopen(manifest_url)
-            with NamedTemporaryFile() as f:
-                shutil.copyfileobj(content, f)
-                if not is_new(f.name):
-                    return False
-
-        os.makedirs(target_path, exist_ok=True)
-        content = urlopen(manifest_url)
-        with open(target_manifest, 'wb') as f:
-            shutil.copyfileobj(content, f)
-        with open(target_manifest, 'r') as manifest_file:
-            manifest_lines = manifest_file.read().split()
-        for line in manifest_lines:
-            if 'href' in line:
-                rel_path = line[line.find('href=".') + 7:]
-                rel_path = rel_path[:rel_path.find('"')]
-                abs_path = os.path.join(target_path, *rel_path.split('/')[1:])
-                if not os.path.exists(os.path.dirname(abs_path)):
-                    os.makedirs(os.path.dirname(abs_path))
-                try:
-                    ubelt.download(url + rel_path, fpath=abs_path)
-                except HTTPError as error:
-                    print('Error downloading {} [{}]'.format(url + rel_path, error))
-                    continue
-        granule = os.path.dirname(os.path.dirname(get_S2_image_bands(target_path, 'B01')))
+    complete = False
+    if plan['download']:
+        errors = {file_url: error
+                  for (file_url, _), error in zip(plan['jobs'], results)
+                  if error is not None}
+        # Manifests can list files that the bucket does not have. Those are
+        # reported, the other failures leave the product incomplete, to be
+        # resumed later.
+        failed = {file_url: error for file_url, error in errors.items()
+                  if is_retryable(error)}
+        for file_url, error in errors.items():
+            if file_url not in failed:
+                print('Error downloading {} [{}]'.format(file_url, error))
+        complete = not failed
+        if failed:
+            print('Failed to download {} of {} files of {}'.format(
+                len(failed), len(plan['jobs']), os.path.basename(target_path)))
+            for file_url, error in failed.items():
+                print('Error downloading {} [{}]'.format(file_url, error))
+            return_status = False
+        granule = _tile_granule_dir(target_path)
         for extra_dir in ('AUX_DATA', 'HTML'):
             if not os.path.exists(os.path.join(target_path, extra_dir)):
                 os.makedirs(os.path.join(target_path, extra_dir))
             if not os.path.exists(os.path.join(granule, extra_dir)):
                 os.makedirs(os.path.join(granule, extra_dir))
-        if not manifest_lines:
+        if not plan['jobs']:
             print()
     elif reject_old and not is_new(target_manifest):
-        print(f'Warning: old-format image {outputdir} exists')
+        print(f'Warning: old-format image {plan["outputdir"]} exists')
         return_status = False
 
-    if partial:
-        tile_chk = check_full_tile(get_S2_image_bands(target_path, 'B01'))
+    band_fpath = None
+    if partial and not plan['tile_checked']:
+        band_fpath = _find_S2_image_band(target_path, 'B01')
+        if band_fpath is None:
+            print('{} has no B01 band, not checking if the tile is '
+                  'partial'.format(name))
+    if band_fpath is not None:
+        tile_chk = check_full_tile(band_fpath, nodata_thresh=partial_thresh,
+                                   use_overviews=partial_overviews)
         if tile_chk == 'Partial':
             print('Removing partial tile image files...')
             shutil.rmtree(target_path)
-            return_status = False
+            reject_product(plan['outputdir'], name, plan['url'],
+                           status=PARTIAL)
+            return False
     if not noinspire:
         inspire_file = os.path.join(target_path, 'INSPIRE.xml')
         if os.path.isfile(inspire_file):
             inspire_path = get_S2_INSPIRE_title(inspire_file)
             if os.path.basename(target_path) != inspire_path:
                 os.rename(target_path, inspire_path)
+                target_path = inspire_path
         else:
             print(f"File {inspire_file} could not be found.")
             return_status = False
 
+    if complete:
+        complete_product(plan['outputdir'], name, path=target_path,
+                         bands=plan.get('bands'))
     return return_status
 
 
+def download_sentinel2_files(url, target_path, rel_paths, workers=1,
+                             verify=False, overwrite=False):
+    """
+    Download the files of a SAFE product.
+
+    All directories are created before the downloads start.
+
+    Args:
+        url (str): the http url of the product
+        target_path (str): the local product directory
+        rel_paths (List[str]): paths from the manifest, e.g. '/INSPIRE.xml',
+            see :func:`_manifest_rel_paths`
+        workers (int): number of files downloaded at the same time
+        verify (bool): check the files against the checksums of the remote
+            files and record the results
+        overwrite (bool): download files that already exist
+
+    Returns:
+        Dict[str, Exception]: the error of each file that failed to download
+    """
+    jobs = _sentinel2_file_jobs(url, target_path, rel_paths, verify=verify,
+                                overwrite=overwrite)
+    results = run_jobs([job for _, job in jobs], workers=workers)
+    flush_checksums(target_path)
+    return {file_url: error for (file_url, _), error in zip(jobs, results)
+            if error is not None}
+
+
+def _sentinel2_file_jobs(url, target_path, rel_paths, verify=False,
+                         overwrite=False, outputdir=None):
+    # The downloads are recorded in the ledger of the output directory, by
+    # product name. The directory of a complete product can be renamed.
+    if outputdir is None:
+        outputdir = os.path.dirname(target_path)
+    name = os.path.basename(url)
+    abs_paths = [os.path.join(target_path, *rel_path.split('/')[1:])
+                 for rel_path in rel_paths]
+    for dpath in sorted(set(map(os.path.dirname, abs_paths))):
+        os.makedirs(dpath, exist_ok=True)
+    return [(url + rel_path,
+             functools.partial(_download_sentinel2_file, url + rel_path,
+                               abs_path, target_path, outputdir, name,
+                               verify, overwrite))
+            for rel_path, abs_path in zip(rel_paths, abs_paths)]
+
+
+def _download_sentinel2_file(file_url, abs_path, target_path, outputdir,
+                             name, verify=False, overwrite=False):
+    if os.path.exists(abs_path) and not overwrite:
+        # Left by an earlier run. Files only get their name once complete,
+        # but can be damaged since.
+        if not verify or check_existing_file(file_url, target_path, abs_path):
+            record_file(outputdir, abs_path, name, file_url)
+            return
+        print(abs_path, 'does not match the remote file, downloading it again')
+    elif not overwrite and is_missing_file(outputdir, abs_path):
+        # An earlier run found that the bucket does not have it
+        return
+    try:
+        if is_metadata_url(file_url) and not verify:
+            download_cached(file_url, abs_path)
+            info = None
+        else:
+            info = download_file(file_url, abs_path, verify=verify)
+    except (HTTPError, ChecksumError) + TRANSIENT_ERRORS as error:
+        if isinstance(error, HTTPError) and error.code in (404, 410):
+            record_missing_file(outputdir, abs_path, name, file_url)
+        return error
+    if verify:
+        record_checksum(target_path, abs_path, file_url, info['expected'],
+                        info['verified'])
+    record_file(outputdir, abs_path, name, file_url)
+
+
+def _tile_band_index(img, rel_paths, band):
+    """
+    Return the index of the image file of a band in the manifest paths of a
+    product, or None if it has none. Old-format products have several
+    granules; the one of the product tile is used, like
+    :func:`get_S2_image_bands` does.
+    """
+    tile = img.split('_')[5]
+    candidates = [idx for idx, rel_path in enumerate(rel_paths)
+                  if '/IMG_DATA/' in rel_path and
+                  rel_path.endswith(band + '.jp2')]
+    for idx in candidates:
+        granule = rel_paths[idx].split('/GRANULE/')[-1].split('/')[0]
+        if granule.find(tile) > 0:
+            return idx
+    return candidates[0] if candidates else None
+
+
+def manifest_data_objects(manifest):
+    """
+    Parse the data objects, i.e. the files, of a SAFE product from its
+    manifest.
+
+    Args:
+        manifest (bytes | str): the content of a manifest.safe file
+
+    Returns:
+        List[Dict]: the ``id``, relative ``href`` and ``size`` (or None) of
+        each file
+
+    Example:
+        >>> from fels.sentinel2 import *  # NOQA
+        >>> manifest = ubelt.codeblock(
+        >>>     '''
+        >>>     <xfdu:XFDU xmlns:xfdu="urn:ccsds:schema:xfdu:1">
+        >>>       <dataObjectSection>
+        >>>         <dataObject ID="S2_Level-1C_Product_Metadata">
+        >>>           <byteStream mimeType="text/xml" size="51000">
+        >>>             <fileLocation locatorType="URL" href="./MTD_MSIL1C.xml"/>
+        >>>           </byteStream>
+        >>>         </dataObject>
+        >>>       </dataObjectSection>
+        >>>     </xfdu:XFDU>
+        >>>     ''')
+        >>> manifest_data_objects(manifest)
+        [{'id': 'S2_Level-1C_Product_Metadata', 'href': './MTD_MSIL1C.xml', 'size': 51000}]
+    """
+    root = ET.fromstring(manifest)
+    data_objects = []
+    for data_object in root.iter():
+        if _local_tag(data_object) != 'dataObject':
+            continue
+        size = None
+        for elem in data_object.iter():
+            tag = _local_tag(elem)
+            if tag == 'byteStream' and elem.get('size'):
+                size = int(elem.get('size'))
+            elif tag == 'fileLocation' and elem.get('href'):
+                data_objects.append({'id': data_object.get('ID'),
+                                     'href': elem.get('href'),
+                                     'size': size})
+    return data_objects
+
+
+def _local_tag(elem):
+    return elem.tag.rsplit('}', 1)[-1]
+
+
+def _manifest_rel_paths(manifest_fpath, bands=None):
+    """
+    Return the path of each file listed in a manifest.safe file, relative
+    to the product, e.g. ``'/INSPIRE.xml'``.
+
+    Args:
+        manifest_fpath (str): the manifest file
+        bands (List[str] | None): only list the files of these bands, and
+            the files that do not belong to a band. Defaults to all bands.
+    """
+    with open(manifest_fpath, 'rb') as manifest_file:
+        data_objects = manifest_data_objects(manifest_file.read())
+    rel_paths = [obj['href'][1:] if obj['href'].startswith('./')
+                 else '/' + obj['href'] for obj in data_objects]
+    if bands is not None:
+        wanted = set(normalize_bands(bands))
+        rel_paths = [rel_path for rel_path in rel_paths
+                     if _file_band(rel_path) in wanted | {None}]
+    return rel_paths
+
+
+def normalize_bands(bands):
+    """
+    Convert band names to the form used in the Sentinel-2 file names.
+
+    Example:
+        >>> from fels.sentinel2 import *  # NOQA
+        >>> normalize_bands(['b4', 'B08', '8a', 'TCI'])
+        ['B04', 'B08', 'B8A', 'TCI']
+    """
+    normalized = []
+    for band in bands:
+        band = band.strip().upper()
+        if band != 'TCI':
+            band = 'B' + band.lstrip('B').zfill(2)
+        normalized.append(band)
+    return normalized
+
+
+def _file_band(rel_path):
+    """
+    Return the band a product file belongs to, or None for files of the
+    whole product, such as metadata and the B00 masks.
+
+    Example:
+        >>> _file_band('./GRANULE/L1C_T13TDE/IMG_DATA/T13TDE_20170301T175000_B8A.jp2')
+        'B8A'
+        >>> _file_band('./GRANULE/L1C_T13TDE/QI_DATA/MSK_DETFOO_B01.gml')
+        'B01'
+        >>> print(_file_band('./GRANULE/L1C_T13TDE/QI_DATA/MSK_CLOUDS_B00.gml'))
+        None
+    """
+    match = _FILE_BAND_PATTERN.search(os.path.basename(rel_path))
+    if match is None or match.group(1) == 'B00':
+        return None
+    return match.group(1)
+
+
 def get_S2_image_bands(image_path, band):
+    list_files = os.path.join(_tile_granule_dir(image_path), 'IMG_DATA')
+    files = glob.glob(list_files + '/*.jp2')
+    match_band = [x for x in files if x.find(band) > 0][0]
+    return match_band
+
+
+def _find_S2_image_band(image_path, band):
+    # Like get_S2_image_bands, but None if the product has no such file
+    try:
+        return get_S2_image_bands(image_path, band)
+    except (IndexError, OSError):
+        return None
+
+
+def _tile_granule_dir(image_path):
+    # The granule of the product tile; old-format products have several
     image_name = os.path.basename(image_path)
     tile = image_name.split('_')[5]
     list_dirs = os.listdir(os.path.join(image_path, 'GRANULE'))
     match = [x for x in list_dirs if x.find(tile) > 0][0]
-    list_files = os.path.join(image_path, 'GRANULE', match, 'IMG_DATA')
-    files = glob.glob(list_files + '/*.jp2')
-    match_band = [x for x in files if x.find(band) > 0][0]
-    return match_band
+    return os.path.join(image_path, 'GRANULE', match)
 
 
 def get_S2_INSPIRE_title(image_inspire_xml):
@@ -249,7 +772,32 @@ def get_S2_INSPIRE_title(image_inspire_xml):
     return s2_file_inspire_title
 
 
-def check_full_tile(image):
+def check_full_tile(image, nodata_thresh=0.0, nodata=0, use_overviews=False,
+                    min_overview_size=256):
+    """
+    Check if a Sentinel-2 tile is only partially covered by the swath, i.e.
+    if its band image has no-data pixels.
+
+    The band is read in strips of whole GDAL blocks that are counted with
+    numpy, so only one strip is in memory, and the check stops as soon as
+    the no-data fraction is over the threshold.
+
+    Args:
+        image (str): path of a band image, see :func:`get_S2_image_bands`
+        nodata_thresh (float): the tile is partial if more than this fraction
+            of its pixels are no-data. The default flags any no-data pixel.
+        nodata (int): the no-data pixel value
+        use_overviews (bool): count the pixels of the smallest overview that
+            is at least ``min_overview_size`` pixels wide and high, if the
+            image has overviews. JPEG2000 images have one per resolution
+            level. This is much faster, but no-data areas smaller than an
+            overview pixel can be missed.
+        min_overview_size (int): see ``use_overviews``
+
+    Returns:
+        str | None: 'Partial' if the tile is partial, otherwise None
+    """
+    import numpy as np
     try:
         # NOTE: gdal can have a large import time overhead, (depending on how it
         # is compiled), and only is used in one specific case. Executing it as
@@ -263,35 +811,37 @@ def check_full_tile(image):
     if gdalData is None:
         sys.exit("ERROR: can't open raster")
 
-    # get width and heights of the raster
-    xsize = gdalData.RasterXSize
-    ysize = gdalData.RasterYSize
-
-    # process the raster
-    band_i = gdalData.GetRasterBand(1)
-    raster = band_i.ReadAsArray()
-
-    # create dictionary for unique values count
-    count = {}
-
-    # count unique values for the given band
-    for col in range(xsize):
-        for row in range(ysize):
-            cell_value = raster[row, col]
-
-            # check if cell_value is NaN
-            if cell_value == 0:
-                # add cell_value to dictionary
-                if cell_value in count:
-                    count[cell_value] += 1
-                else:
-                    count[cell_value] = 1
-                break
-    for key in sorted(count.keys()):
-        if count[key] is not None:
+    band = gdalData.GetRasterBand(1)
+    if use_overviews:
+        band = _smallest_overview(band, min_overview_size)
+    xsize, ysize = band.XSize, band.YSize
+    max_nodata = nodata_thresh * xsize * ysize
+
+    # Strips span the full width and a whole number of block rows
+    block_ysize = band.GetBlockSize()[1]
+    strip_ysize = block_ysize * max(1, FULL_TILE_STRIP_PIXELS // (xsize * block_ysize))
+    num_nodata = 0
+    for yoff in range(0, ysize, strip_ysize):
+        strip = band.ReadAsArray(0, yoff, xsize, min(strip_ysize, ysize - yoff))
+        num_nodata += int(np.count_nonzero(strip == nodata))
+        if num_nodata > max_nodata:
             return 'Partial'
 
 
+def _smallest_overview(band, min_size):
+    """
+    Return the smallest overview of a band that is at least ``min_size``
+    pixels wide and high, or the band itself if there is none.
+    """
+    best = band
+    for idx in range(band.GetOverviewCount()):
+        overview = band.GetOverview(idx)
+        if (min_size <= overview.XSize < best.XSize and
+                min_size <= overview.YSize):
+            best = overview
+    return best
+
+
 def is_new(safedir_or_manifest):
     """
     Check if a S2 scene is in the new (after Nov 2016) format.
@@ -316,13 +866,17 @@ def is_new(safedir_or_manifest):
     elif os.path.isfile(safedir_or_manifest):
         manifest = safedir_or_manifest
         with open(manifest, 'r') as f:
-            lines = f.read().split()
-        return len([line for line in lines if 'MTD_TL.xml' in line]) == 1
+            return _manifest_is_new(f.read())
 
     else:
         raise ValueError(f'{safedir_or_manifest} is not a safedir or manifest')
 
 
+def _manifest_is_new(manifest_text):
+    lines = manifest_text.split()
+    return len([line for line in lines if 'MTD_TL.xml' in line]) == 1
+
+
 def _dedupe(safedirs, to_return=None):
     """
     Remove old-format scenes from a list of Google Cloud S2 safedirs
@@ -340,6 +894,7 @@ def _dedupe(safedirs, to_return=None):
         to_return: a list of other products (eg urls) indexed to safedirs.
             if provided, dedupe this as well.
     """
+    import numpy as np
     _safedirs = np.array(sorted(safedirs))
     datetimes = [safedir_to_datetime(s) for s in _safedirs]
     # prods = [safedir_to_datetime(s, product=True) for s in _safedirs]
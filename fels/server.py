@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""
+A long-lived local fels process that answers queries with warm state.
+
+``fels serve`` starts an HTTP server on localhost. It keeps what a single
+``fels`` run would load again every time in memory: the imports of the geo
+stack, the footprint indexes, the sqlite connections of the catalogue
+caches, the memory-mapped columnar catalogues and the metadata cache.
+``fels --server ...`` sends its options to the server, which runs them like
+a local ``fels`` would, in the working directory of the client, and streams
+the output back.
+
+Runs are executed one at a time. The server accepts the same requests as
+the command line from any local user, so it only listens on the loopback
+interface unless told otherwise.
+
+The address is given by the ``FELS_SERVER_ADDRESS`` environment variable,
+``127.0.0.1:8950`` by default.
+"""
+from __future__ import absolute_import, division, print_function
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import sys
+import threading
+import traceback
+try:
+    from urllib2 import urlopen, Request, URLError
+except ImportError:
+    from urllib.request import urlopen, Request
+    from urllib.error import URLError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+DEFAULT_SERVER_ADDRESS = os.environ.get('FELS_SERVER_ADDRESS',
+                                        '127.0.0.1:8950')
+
+# Seconds to wait for a server to answer if it is running
+SERVER_PING_TIMEOUT = 1.0
+
+# Only one run changes the working directory and sys.stdout at a time
+_RUN_LOCK = threading.Lock()
+
+
+def parse_address(address=None):
+    """
+    Split a ``host:port`` server address.
+
+    Example:
+        >>> from fels.server import *  # NOQA
+        >>> parse_address('localhost:9000')
+        ('localhost', 9000)
+    """
+    if address is None:
+        address = DEFAULT_SERVER_ADDRESS
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+class _StreamWriter(io.TextIOBase):
+    # Sends the text written to stdout or stderr during a run to the client,
+    # one JSON message per line. The run continues if the client is gone.
+
+    def __init__(self, send, name):
+        self._send = send
+        self._name = name
+        self._buffer = ''
+        self._lock = threading.Lock()
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        with self._lock:
+            self._buffer += text
+            if '\n' in text or '\r' in text:
+                self._flush()
+        return len(text)
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._buffer:
+            self._send({self._name: self._buffer})
+            self._buffer = ''
+
+
+class FelsRequestHandler(BaseHTTPRequestHandler):
+    """
+    ``GET /status`` describes the server, ``POST /run`` runs the options of
+    a ``fels`` command.
+    """
+
+    def do_GET(self):
+        if self.path != '/status':
+            self.send_error(404)
+            return
+        import fels
+        from fels.footprints import GLOBAL_FOOTPRINT_INDEXES
+        from fels.utils import GLOBAL_SQLITE_CONNECTIONS
+        status = {
+            'version': fels.__version__,
+            'pid': os.getpid(),
+            'busy': _RUN_LOCK.locked(),
+            'footprint_indexes': sorted(GLOBAL_FOOTPRINT_INDEXES),
+            'sqlite_connections': len(GLOBAL_SQLITE_CONNECTIONS),
+        }
+        body = json.dumps(status).encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path != '/run':
+            self.send_error(404)
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length).decode('utf8'))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+
+        connected = [True]
+
+        def _send(message):
+            if not connected[0]:
+                return
+            try:
+                self.wfile.write(json.dumps(message).encode('utf8') + b'\n')
+                self.wfile.flush()
+            except (IOError, OSError):
+                connected[0] = False
+
+        _send(run_request(request, _send))
+
+    def log_message(self, format, *args):
+        # Runs print their own output, the requests are not logged
+        pass
+
+
+def run_request(request, send):
+    """
+    Run the options of a request like a local ``fels`` would.
+
+    Args:
+        request (dict): ``options``, the attributes of the options of
+            :func:`fels.fels.get_parser`, ``cwd``, the working directory of
+            the client, and ``cli``, if true run like the command line,
+            which prints the urls with ``--list``, else return the results
+            like :func:`fels.run_fels`
+        send (Callable[[dict], None]): receives the output as
+            ``{'stdout': text}`` and ``{'stderr': text}`` messages
+
+    Returns:
+        dict: ``{'exit': code}`` for command line runs, else
+        ``{'result': urls_or_dates}``, or ``{'error': traceback, 'exit': 1}``
+        if the run failed
+    """
+    from fels.fels import _run_cli, _run_fels
+    options = argparse.Namespace(**request['options'])
+    stdout = _StreamWriter(send, 'stdout')
+    stderr = _StreamWriter(send, 'stderr')
+    with _RUN_LOCK:
+        prev_cwd = os.getcwd()
+        try:
+            with contextlib.redirect_stdout(stdout), \
+                    contextlib.redirect_stderr(stderr):
+                try:
+                    os.chdir(request['cwd'])
+                    if request.get('cli', False):
+                        code = _run_cli(options)
+                        reply = {'exit': code or 0}
+                    else:
+                        result = _run_fels(options)
+                        reply = {'result': [
+                            item.isoformat() if isinstance(item, datetime.date)
+                            else item for item in result]}
+                except SystemExit as ex:
+                    reply = {'exit': ex.code or 0}
+                except Exception:
+                    traceback.print_exc()
+                    reply = {'error': traceback.format_exc(), 'exit': 1}
+                finally:
+                    stdout.flush()
+                    stderr.flush()
+        finally:
+            os.chdir(prev_cwd)
+    return reply
+
+
+def make_server(address=None):
+    """
+    Create the server. Call its ``serve_forever`` method to run it.
+
+    Args:
+        address (str | None): ``host:port`` to listen on, defaults to
+            :data:`DEFAULT_SERVER_ADDRESS`. Port 0 picks a free port.
+
+    Returns:
+        http.server.ThreadingHTTPServer
+    """
+    server = ThreadingHTTPServer(parse_address(address), FelsRequestHandler)
+    server.daemon_threads = True
+    return server
+
+
+def serve_main(argv=None):
+    """
+    Entrypoint of ``fels serve``.
+    """
+    parser = argparse.ArgumentParser(
+        prog='fels serve',
+        description='Run a local fels server that keeps the catalogs and footprints loaded. Send it commands with "fels --server ...".')
+    parser.add_argument('--address', help='host:port to listen on. Defaults to the FELS_SERVER_ADDRESS environment variable or 127.0.0.1:8950. Anyone who can connect can download files as this user.', default=None)
+    options = parser.parse_args(argv)
+    server = make_server(options.address)
+    _warm_up()
+    host, port = server.server_address[0:2]
+    print('Serving fels on http://{}:{}'.format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+def _warm_up():
+    # Load what every geometry query needs before the first request
+    import importlib
+    for name in ['numpy', 'shapely.geometry', 'shapely.wkt']:
+        importlib.import_module(name)
+    from fels.footprints import ensure_footprint_index
+    for sat in ['S2', 'LANDSAT']:
+        try:
+            ensure_footprint_index(sat)
+        except Exception as ex:
+            print('Footprints of {} are loaded on first use: {!r}'.format(
+                sat, ex))
+
+
+def server_status(address=None, timeout=SERVER_PING_TIMEOUT):
+    """
+    Ask a server for its status.
+
+    Returns:
+        dict | None: the status, or None if no server is running at the
+        address
+    """
+    host, port = parse_address(address)
+    try:
+        with urlopen('http://{}:{}/status'.format(host, port),
+                     timeout=timeout) as response:
+            return json.loads(response.read().decode('utf8'))
+    except (URLError, IOError, OSError, ValueError):
+        return None
+
+
+def request_run(options, cli=False, address=None):
+    """
+    Run options on a server and copy its output to stdout and stderr.
+
+    Args:
+        options (argparse.Namespace): the options of
+            :func:`fels.fels.get_parser`
+        cli (bool): run like the command line instead of like
+            :func:`fels.run_fels`
+        address (str | None): the address of the server
+
+    Returns:
+        dict: the last message of the server, see :func:`run_request`
+    """
+    host, port = parse_address(address)
+    options = dict(vars(options), server=False)
+    payload = json.dumps({'options': options, 'cwd': os.getcwd(),
+                          'cli': cli}).encode('utf8')
+    request = Request('http://{}:{}/run'.format(host, port), data=payload,
+                      headers={'Content-Type': 'application/json'})
+    reply = None
+    with urlopen(request) as response:
+        for line in response:
+            message = json.loads(line.decode('utf8'))
+            if 'stdout' in message:
+                sys.stdout.write(message['stdout'])
+                sys.stdout.flush()
+            elif 'stderr' in message:
+                sys.stderr.write(message['stderr'])
+                sys.stderr.flush()
+            else:
+                reply = message
+    if reply is None:
+        raise IOError('The fels server closed the connection during the run')
+    return reply
+
+
+def forward_cli(options, address=None):
+    """
+    Run the options of a ``fels`` command on a server, if one is running.
+
+    Returns:
+        int | None: the exit code of the run, or None if no server is
+        running at the address
+    """
+    if server_status(address) is None:
+        return None
+    return request_run(options, cli=True, address=address).get('exit', 0)
+
+
+def run_fels_on_server(*args, **kwargs):
+    """
+    Like :func:`fels.run_fels`, but runs on a server.
+
+    Args:
+        *args: see :func:`fels.run_fels`
+        address (str | None): the address of the server
+        **kwargs: see :func:`fels.run_fels`
+
+    Returns:
+        List[str] | List[datetime.date]: the urls, or the dates with
+        ``dates=True``
+    """
+    from fels.fels import _get_options
+    address = kwargs.pop('address', None)
+    options = _get_options(*args, **kwargs)
+    reply = request_run(options, address=address)
+    if 'error' in reply:
+        raise RuntimeError('fels server run failed:\n' + reply['error'])
+    if 'result' not in reply:
+        raise SystemExit(reply.get('exit', 1))
+    result = reply['result']
+    if options.dates:
+        result = [datetime.date(*map(int, item[0:10].split('-')))
+                  for item in result]
+    return result
@@ -1,11 +1,19 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function
 import atexit
+import contextlib
+import datetime
 import gzip
+import hashlib
+import io
+import itertools
+import operator
 import os
 import shutil
 import sqlite3
+import time
 import ubelt
+from fels.download import download_file
 
 
 # Set the default output dir to the XDG or System cache dir
@@ -16,21 +24,79 @@ if not FELS_DEFAULT_OUTPUTDIR:
 
 GLOBAL_SQLITE_CONNECTIONS = {}
 
+INGEST_STATE_CREATE_CMD = ubelt.codeblock(
+    '''
+    CREATE TABLE fels_ingest_state (
+        source_offset INTEGER NOT NULL,
+        source_sha1 TEXT NOT NULL,
+        num_rows INTEGER NOT NULL
+    );
+    ''')
 
-def download_metadata_file(url, outputdir, program):
-    """Download and unzip the catalogue files."""
+# Version of the layout of the sqlite catalogue caches. Caches of older
+# versions listed in SQLITE_LEGACY_VERSIONS are migrated when found.
+SQLITE_CACHE_VERSION = 'v002'
+SQLITE_LEGACY_VERSIONS = ['v001']
+
+# Name of the integer YYYYMMDD acquisition date column added to the caches
+CACHE_DATE_FIELD = 'ACQ_DATE'
+
+# SQL expression converting an ISO date or datetime to an integer YYYYMMDD
+_SQL_ISODATE_TO_INT = "CAST(replace(substr({}, 1, 10), '-', '') AS INTEGER)"
+
+# Number of rows handed to each executemany call when building a sqlite cache
+SQLITE_INGEST_BATCH_SIZE = 100000
+
+# Settings used while bulk-loading a sqlite cache. The cache is written to a
+# temporary file and can always be rebuilt from the csv, so durability is
+# traded for ingest speed.
+SQLITE_INGEST_PRAGMAS = [
+    'PRAGMA journal_mode = OFF',
+    'PRAGMA synchronous = OFF',
+    'PRAGMA locking_mode = EXCLUSIVE',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -262144',  # 256 MiB
+]
+
+# Number of csv bytes held in memory at a time by the direct csv queries.
+CSV_SCAN_BLOCKSIZE = 2 ** 24
+
+
+def download_metadata_file(url, outputdir, program, unzip=True, refresh=False):
+    """
+    Download and unzip the catalogue files.
+
+    Args:
+        url (str): location of the gzipped catalogue
+        outputdir (str | None): where to store the catalogue
+        program (str): name used for the local file, e.g. 'Landsat'
+        unzip (bool): if True, decompress the catalogue to a csv file and
+            remove the archive. Otherwise the gzipped file is kept as the
+            only on-disk copy and is decompressed on the fly when it is read
+            (see :func:`open_catalog_file`).
+        refresh (bool): if True, download the catalogue again even if a
+            local copy exists. The sqlite cache is then updated with only
+            the appended rows (see :func:`ensure_sqlite_csv_conn`).
+
+    Returns:
+        str: path to the csv or csv.gz catalogue file
+    """
     if outputdir is None:
         outputdir = FELS_DEFAULT_OUTPUTDIR
     zipped_index_path = os.path.join(outputdir, 'index_' + program + '.csv.gz')
     index_path = os.path.join(outputdir, 'index_' + program + '.csv')
-    if not os.path.isfile(index_path):
-        if not os.path.isfile(zipped_index_path):
-            if not os.path.exists(os.path.dirname(zipped_index_path)):
-                os.makedirs(os.path.dirname(zipped_index_path))
-            print('Downloading Metadata file...')
-            print('url = {!r}'.format(url))
-            print('outputdir = {!r}'.format(outputdir))
-            ubelt.download(url, fpath=zipped_index_path, chunksize=int(2 ** 22))
+    have_index = os.path.isfile(index_path)
+    if refresh or not (have_index or os.path.isfile(zipped_index_path)):
+        if not os.path.exists(os.path.dirname(zipped_index_path)):
+            os.makedirs(os.path.dirname(zipped_index_path))
+        print('Downloading Metadata file...')
+        print('url = {!r}'.format(url))
+        print('outputdir = {!r}'.format(outputdir))
+        # Failed attempts are retried and resume from the .part file
+        download_file(url, zipped_index_path, chunksize=int(2 ** 22))
+    if os.path.isfile(zipped_index_path):
+        if not unzip:
+            return zipped_index_path
         print('Unzipping Metadata file...')
         with gzip.open(zipped_index_path) as gzip_index, open(index_path, 'wb') as f:
             shutil.copyfileobj(gzip_index, f)
@@ -38,143 +104,733 @@ def download_metadata_file(url, outputdir, program):
     return index_path
 
 
+def open_catalog_file(collection_file, mode='rt'):
+    """
+    Open a catalogue csv file for reading, transparently decompressing it if
+    it is gzipped.
+
+    Args:
+        collection_file (str): path to a csv or csv.gz file
+        mode (str): either 'rt' for text or 'rb' for bytes
+
+    Example:
+        >>> from fels.utils import *  # NOQA
+        >>> dpath = ubelt.ensure_app_cache_dir('fels', 'tests')
+        >>> fpath = os.path.join(dpath, 'demo_catalog.csv.gz')
+        >>> with gzip.open(fpath, 'wt') as file:
+        >>>     _ = file.write('A,B\\n1,2\\n')
+        >>> with open_catalog_file(fpath) as file:
+        >>>     print(file.read().split())
+        ['A,B', '1,2']
+    """
+    if collection_file.endswith('.gz'):
+        return gzip.open(collection_file, mode)
+    return open(collection_file, mode)
+
+
+def iter_catalog_chunks(collection_file, dtypes, tokens=None,
+                        blocksize=CSV_SCAN_BLOCKSIZE, desc='searching'):
+    """
+    Read only the requested columns of a catalogue csv in chunks of rows.
+
+    The csv is read in blocks of raw bytes. When ``tokens`` are given, the
+    lines of a block that do not contain any of them are dropped with fast
+    substring searches before the remaining lines are parsed, which makes
+    queries for a few scenes much faster than parsing the whole catalogue.
+
+    Args:
+        collection_file (str): path to a csv or csv.gz file
+        dtypes (Dict[str, type]): the columns to read and their types
+        tokens (List[str] | None): if specified, only lines containing one
+            of these strings are parsed. Every row the caller is interested
+            in must contain one of them.
+        blocksize (int): approximate number of bytes in each chunk
+        desc (str): progress message
+
+    Yields:
+        pandas.DataFrame: the next chunk of rows
+
+    Example:
+        >>> from fels.utils import *  # NOQA
+        >>> dpath = ubelt.ensure_app_cache_dir('fels', 'tests')
+        >>> fpath = os.path.join(dpath, 'demo_chunks.csv')
+        >>> with open(fpath, 'w') as file:
+        >>>     _ = file.write('A,B,C\\n1,x,2.5\\n2,y,3.5\\n3,z,4.5\\n')
+        >>> chunks = list(iter_catalog_chunks(fpath, {'B': str, 'C': float}, blocksize=8))
+        >>> print([chunk['B'].tolist() for chunk in chunks])
+        [['x'], ['y'], ['z']]
+        >>> chunks = list(iter_catalog_chunks(fpath, {'B': str, 'C': float}, tokens=[',z,', ',x,']))
+        >>> print([chunk['B'].tolist() for chunk in chunks])
+        [['x', 'z']]
+    """
+    import pandas as pd
+
+    def _parse(lines):
+        return pd.read_csv(io.BytesIO(header + lines), usecols=list(dtypes),
+                           dtype=dtypes, na_filter=False, engine='c')
+
+    if tokens is not None:
+        tokens = [token.encode('utf8') for token in tokens]
+    with open_catalog_file(collection_file, mode='rb') as file:
+        header = file.readline()
+        remainder = b''
+        for block in ubelt.ProgIter(iter(lambda: file.read(blocksize), b''),
+                                    desc=desc, verbose=1):
+            # The line split between the previous block and this one is
+            # handled on its own to avoid copying the whole block.
+            first = block.find(b'\n') + 1
+            if first == 0:
+                remainder += block
+                continue
+            stop = block.rfind(b'\n') + 1
+            head = remainder + block[:first]
+            remainder = block[stop:]
+            if tokens is None:
+                lines = head + block[first:stop]
+            else:
+                lines = (_grep_lines(head, tokens) +
+                         _grep_lines(block, tokens, first, stop))
+            if lines:
+                yield _parse(lines)
+        if remainder:
+            lines = remainder + b'\n'
+            if tokens is not None:
+                lines = _grep_lines(lines, tokens)
+            if lines:
+                yield _parse(lines)
+
+
+def _grep_lines(text, tokens, start=0, stop=None):
+    """
+    Return the lines of ``text[start:stop]`` that contain any of the
+    ``tokens``, in their original order. The text must consist of complete
+    lines.
+
+    Example:
+        >>> from fels.utils import *  # NOQA
+        >>> _grep_lines(b'a,1\\nb,2\\nc,1\\n', [b'c', b',1'])
+        b'a,1\\nc,1\\n'
+    """
+    if stop is None:
+        stop = len(text)
+    spans = set()
+    for token in tokens:
+        pos = text.find(token, start, stop)
+        while pos != -1:
+            line_start = text.rfind(b'\n', start, pos) + 1 or start
+            line_stop = text.find(b'\n', pos, stop) + 1
+            spans.add((line_start, line_stop))
+            pos = text.find(token, line_stop, stop)
+    return b''.join(text[a:b] for a, b in sorted(spans))
+
+
+def catalog_dates(values):
+    """
+    Vectorized conversion of ISO date or datetime strings to dates.
+
+    Args:
+        values (pandas.Series | List[str]): ISO dates or datetimes
+
+    Returns:
+        ndarray: the dates as ``datetime64[D]``. Unparsable values are NaT.
+
+    Example:
+        >>> from fels.utils import *  # NOQA
+        >>> catalog_dates(['2016-10-15T10:24:02.026Z', '2017-01-02'])
+        array(['2016-10-15', '2017-01-02'], dtype='datetime64[D]')
+        >>> print(catalog_dates(['2017-01-02', '', '2017-02-30', 'unknown']))
+        ['2017-01-02' 'NaT' 'NaT' 'NaT']
+    """
+    import numpy as np
+    # Truncating to 10 characters drops the time of a datetime
+    values = np.asarray(values, dtype='U10')
+    try:
+        return values.astype('datetime64[D]')
+    except ValueError:
+        # Only catalogues with bad rows pay for the slower parsing
+        import pandas as pd
+        dates = pd.to_datetime(pd.Series(values), format='%Y-%m-%d',
+                               errors='coerce')
+        return dates.values.astype('datetime64[D]')
+
+
+def isodate_to_int(date):
+    """
+    Convert a date to the integer YYYYMMDD form used by the sqlite caches.
+
+    Args:
+        date (str | datetime.date | datetime.datetime): an ISO date or datetime
+
+    Example:
+        >>> from fels.utils import *  # NOQA
+        >>> isodate_to_int('2016-10-15T10:24:02.026Z')
+        20161015
+        >>> isodate_to_int(datetime.date(2016, 1, 2))
+        20160102
+    """
+    if isinstance(date, datetime.date):
+        date = date.isoformat()
+    return int(date[0:4] + date[5:7] + date[8:10])
+
+
 def sort_url_list(cc_values, all_acqdates, all_urls):
-    """Sort the url list by increasing cc_values and acqdate."""
-    cc_values = sorted(cc_values)
-    all_acqdates = sorted(all_acqdates, reverse=True)
-    all_urls = [x for (y, z, x) in sorted(zip(cc_values, all_acqdates, all_urls))]
-    urls = []
-    for url in all_urls:
-        urls.append('http://storage.googleapis.com/' + url.replace('gs://', ''))
-    return urls
+    """
+    Sort the url list by increasing acqdate. Scenes with the same acqdate are
+    sorted by decreasing cc_values, so the last url is the latest and least
+    cloudy scene. This is the same order as :func:`sql_order_clause`.
+
+    Example:
+        >>> from fels.utils import *  # NOQA
+        >>> cc_values = [10.0, 50.0, 5.0]
+        >>> all_acqdates = [datetime.date(2017, 1, 1), datetime.date(2016, 1, 1), datetime.date(2017, 1, 1)]
+        >>> all_urls = ['gs://b/x', 'gs://b/y', 'gs://b/z']
+        >>> sort_url_list(cc_values, all_acqdates, all_urls)
+        ['http://storage.googleapis.com/b/y', 'http://storage.googleapis.com/b/x', 'http://storage.googleapis.com/b/z']
+    """
+    order = sorted(range(len(all_urls)),
+                   key=lambda idx: (all_acqdates[idx], -cc_values[idx]))
+    return [gs_to_http_url(all_urls[idx]) for idx in order]
+
+
+def gs_to_http_url(url):
+    """
+    Convert a gs:// catalogue url to its public http location.
+    """
+    return 'http://storage.googleapis.com/' + url.replace('gs://', '')
+
+
+def sql_order_clause(latest=False):
+    """
+    The ORDER BY clause for catalogue cache queries.
+
+    Results are sorted by acquisition date, and scenes acquired on the same
+    day by decreasing cloud cover, which is the order of the catalogue
+    indexes. With ``latest`` the order is reversed and limited to a single
+    row, which sqlite answers from the end of the index range without
+    visiting the other matches. Batch queries over several scenes still sort
+    their matches.
+    """
+    if latest:
+        return 'ORDER BY {} DESC, CLOUD_COVER LIMIT 1'.format(CACHE_DATE_FIELD)
+    return 'ORDER BY {}, CLOUD_COVER DESC'.format(CACHE_DATE_FIELD)
+
+
+@contextlib.contextmanager
+def sqlite_temp_table(cur, name, columns, rows):
+    """
+    Context manager that fills a temporary table, which is used to join a
+    batch of query keys against a catalogue table in a single query.
+
+    Args:
+        cur (sqlite3.Cursor): cursor of the catalogue connection
+        name (str): name of the temporary table
+        columns (List[str]): column definitions
+        rows (Iterable[tuple]): the rows to insert
+
+    Example:
+        >>> from fels.utils import *  # NOQA
+        >>> cur = sqlite3.connect(':memory:').cursor()
+        >>> with sqlite_temp_table(cur, 'keys', ['k TEXT'], [('a',), ('b',)]):
+        >>>     print(cur.execute('SELECT count(*) FROM temp.keys').fetchone())
+        (2,)
+    """
+    cur.execute('CREATE TEMP TABLE {} ({})'.format(name, ', '.join(columns)))
+    try:
+        cur.executemany('INSERT INTO temp.{} VALUES ({})'.format(
+            name, ','.join('?' * len(columns))), rows)
+        yield name
+    finally:
+        cur.execute('DROP TABLE temp.{}'.format(name))
+        # Do not hold a transaction open on the shared connection
+        cur.connection.commit()
 
 
 def ensure_sqlite_csv_conn(collection_file, fields, table_create_cmd,
                            tablename='unnamed_table1', index_cols=[],
-                           overwrite=False):
+                           overwrite=False, date_field=None,
+                           batch_size=SQLITE_INGEST_BATCH_SIZE):
     """
     Returns a connection to a cache of a csv file
+
+    The csv file may be gzipped, in which case it is decompressed and
+    ingested in a single streaming pass. The cache is shared between the
+    plain and gzipped versions of the same catalogue.
+
+    The cache is (re)built with a bulk-load: rows are inserted with batched
+    ``executemany`` calls inside a single transaction using the
+    :data:`SQLITE_INGEST_PRAGMAS`, and the index is only created once all
+    rows are loaded. The database is written to a temporary file and moved
+    into place when complete, so an interrupted build never leaves a
+    truncated cache behind.
+
+    The cache records how many bytes of the csv it has ingested and a hash
+    of those bytes. When the csv is modified, the cache is updated in place
+    with only the new rows if the previously ingested bytes are unchanged
+    (i.e. the catalogue has only been appended to). Any other change causes
+    a full rebuild.
+
+    Args:
+        collection_file (str): path to the csv or csv.gz catalogue
+        fields (List[str]): csv columns to store in the cache
+        table_create_cmd (str): SQL to create the table
+        tablename (str): name of the table
+        index_cols (List[str] | List[List[str]]): the columns of one index
+            (a column may be followed by DESC),
+            or a list of column lists to create multiple indexes
+        date_field (str | None): if specified, the ISO date / datetime in
+            this csv column is also stored as an integer YYYYMMDD in the
+            :data:`CACHE_DATE_FIELD` column, which must be part of
+            ``table_create_cmd``. This allows date ranges to be answered
+            by an index.
+
+    Caches from :data:`SQLITE_LEGACY_VERSIONS` that store the same fields
+    are migrated to the current layout instead of being rebuilt.
     """
-    sql_fpath = collection_file + '.v001.sqlite'
+    basepath = _catalog_basepath(collection_file)
+    sql_fpath = basepath + '.' + SQLITE_CACHE_VERSION + '.sqlite'
+    if index_cols and isinstance(index_cols[0], str):
+        index_cols = [index_cols]
+
+    stamp_dpath = ubelt.ensuredir((os.path.dirname(collection_file), '.stamps'))
+    base_name = os.path.basename(sql_fpath)
+
+    stamp = ubelt.CacheStamp(base_name, dpath=stamp_dpath, depends=[
+        fields, table_create_cmd, tablename, index_cols, date_field], verbose=3
+    )
+
+    if not os.path.exists(sql_fpath):
+        for version in SQLITE_LEGACY_VERSIONS:
+            legacy_fpath = basepath + '.' + version + '.sqlite'
+            if os.path.exists(legacy_fpath):
+                if sql_fpath in GLOBAL_SQLITE_CONNECTIONS:
+                    GLOBAL_SQLITE_CONNECTIONS.pop(sql_fpath).close()
+                if legacy_fpath in GLOBAL_SQLITE_CONNECTIONS:
+                    GLOBAL_SQLITE_CONNECTIONS.pop(legacy_fpath).close()
+                if _migrate_sqlite_cache(legacy_fpath, sql_fpath, fields,
+                                         table_create_cmd, tablename,
+                                         index_cols, date_field):
+                    stamp.renew()
+                break
+
     overwrite = False
+    update = False
     if os.path.exists(sql_fpath):
         sql_stat = os.stat(sql_fpath)
         col_stat = os.stat(collection_file)
         # CSV file has a newer modified time, we have to update
         if col_stat.st_mtime > sql_stat.st_mtime:
-            overwrite = True
+            update = True
     else:
         overwrite = True
 
-    stamp_dpath = ubelt.ensuredir((os.path.dirname(collection_file), '.stamps'))
-    base_name = os.path.basename(collection_file)
-
-    stamp = ubelt.CacheStamp(base_name, dpath=stamp_dpath, depends=[
-        fields, table_create_cmd, tablename], verbose=3
-    )
     if stamp.expired():
         overwrite = True
 
+    if sql_fpath in GLOBAL_SQLITE_CONNECTIONS and (overwrite or update):
+        GLOBAL_SQLITE_CONNECTIONS.pop(sql_fpath).close()
+
+    if update and not overwrite:
+        print('Checking if the sql cache can be updated incrementally')
+        if not _append_sqlite_cache(sql_fpath, collection_file, fields,
+                                    tablename, date_field=date_field,
+                                    batch_size=batch_size):
+            print('The csv file was not only appended to')
+            overwrite = True
+
     if overwrite:
         # Update the SQL cache if the CSV file was modified.
         print('Computing (or recomputing) an sql cache')
-
         ubelt.delete(sql_fpath, verbose=3)
-        print('Initial connection to sql_fpath = {!r}'.format(sql_fpath))
-        conn = sqlite3.connect(sql_fpath)
-        cur = conn.cursor()
-        try:
-            print('(SQL) >')
-            print(table_create_cmd)
-            cur.execute(table_create_cmd)
-
-            keypart = ','.join(fields)
-            valpart = ','.join('?' * len(fields))
-            insert_statement = ubelt.codeblock(
-                '''
-                INSERT INTO {tablename}({keypart})
-                VALUES({valpart})
-                ''').format(keypart=keypart, valpart=valpart,
-                            tablename=tablename)
-
-            if index_cols:
-                index_cols_str = ', '.join(index_cols)
-                indexname = 'noname_index'
-                # TODO: Can we make an efficient date index with sqlite?
-                create_index_cmd = ubelt.codeblock(
-                    '''
-                    CREATE INDEX {indexname} ON {tablename} ({index_cols_str});
-                    ''').format(
-                        index_cols_str=index_cols_str, tablename=tablename,
-                        indexname=indexname)
-                print('(SQL) >')
-                print(create_index_cmd)
-                _ = cur.execute(create_index_cmd)
-
-            import tqdm
-            print('convert to sqlite collection_file = {!r}'.format(collection_file))
-            with open(collection_file, 'r') as csvfile:
-
-                # Read the total number of bytes in the CSV file
-                csvfile.seek(0, 2)
-                total_nbytes = csvfile.tell()
-
-                # Read the header information
-                csvfile.seek(0)
-                header = csvfile.readline()
-                header_nbytes = csvfile.tell()
-
-                # Approximate the number of lines in the file
-                # Measure the bytes in the first N lines and take the average
-                num_lines_to_measure = 100
-                csvfile.seek(0, 2)
-                content_nbytes = total_nbytes - header_nbytes
-                csvfile.seek(header_nbytes)
-                for _ in range(num_lines_to_measure):
-                    csvfile.readline()
-                first_content_bytes = csvfile.tell() - header_nbytes
-                appprox_bytes_per_line = first_content_bytes / num_lines_to_measure
-                approx_num_rows = int(content_nbytes / appprox_bytes_per_line)
-
-                # Select the indexes of the columns we want
-                csv_fields = header.strip().split(',')
-                field_to_idx = {field: idx for idx, field in enumerate(csv_fields)}
-                col_indexes = [field_to_idx[k] for k in fields]
-
-                prog = tqdm.tqdm(
-                    iter(csvfile),
-                    desc='insert csv rows into sqlite cache',
-                    total=approx_num_rows, mininterval=1, maxinterval=15,
-                    position=0, leave=True,
-                )
-                # Note: Manual iteration is 1.5x faster than DictReader
-                for line in prog:
-                    cols = line[:-1].split(',')
-                    # Select the values to insert into the SQLite database
-                    # Note: if this fails with an index error, its possible
-                    # the CSV file was not fully downloaded
-                    vals = [cols[idx] for idx in col_indexes]
-                    cur.execute(insert_statement, vals)
-
-            conn.commit()
-        except Exception:
-            raise
-        else:
-            GLOBAL_SQLITE_CONNECTIONS[sql_fpath] = conn
-            stamp.renew()
-        finally:
-            cur.close()
+        _build_sqlite_cache(sql_fpath, collection_file, fields,
+                            table_create_cmd, tablename, index_cols,
+                            date_field=date_field, batch_size=batch_size)
+        stamp.renew()
 
     # cache SQLite connections
     if sql_fpath in GLOBAL_SQLITE_CONNECTIONS:
         conn = GLOBAL_SQLITE_CONNECTIONS[sql_fpath]
     else:
-        conn = sqlite3.connect(sql_fpath)
+        # The connection is reused by the request threads of ``fels serve``,
+        # which run one query at a time
+        conn = sqlite3.connect(sql_fpath, check_same_thread=False)
         GLOBAL_SQLITE_CONNECTIONS[sql_fpath] = conn
 
     return conn
 
 
+def _build_sqlite_cache(sql_fpath, collection_file, fields, table_create_cmd,
+                        tablename, index_cols, date_field=None,
+                        batch_size=SQLITE_INGEST_BATCH_SIZE):
+    """
+    Bulk-load the entire csv into a new sqlite database.
+    """
+    tmp_fpath = sql_fpath + '.tmp'
+    ubelt.delete(tmp_fpath)
+    print('Initial connection to tmp_fpath = {!r}'.format(tmp_fpath))
+    # Transactions are managed explicitly during the bulk load
+    conn = sqlite3.connect(tmp_fpath, isolation_level=None)
+    cur = conn.cursor()
+    try:
+        for pragma in SQLITE_INGEST_PRAGMAS:
+            cur.execute(pragma)
+
+        print('(SQL) >')
+        print(table_create_cmd)
+        cur.execute(table_create_cmd)
+        cur.execute(INGEST_STATE_CREATE_CMD)
+
+        print('convert to sqlite collection_file = {!r}'.format(collection_file))
+        with open_catalog_file(collection_file, 'rb') as csvfile:
+            reader = _HashedLineReader(csvfile)
+            header = reader.readline()
+            # Select the indexes of the columns we want
+            csv_fields = header.strip().split(',')
+            field_to_idx = {field: idx for idx, field in enumerate(csv_fields)}
+            col_indexes = [field_to_idx[k] for k in fields]
+            date_index = None if date_field is None else field_to_idx[date_field]
+            cur.execute('BEGIN')
+            num_rows = _bulk_insert_csv_lines(
+                cur, tablename, fields, col_indexes, iter(reader),
+                approx_num_rows=_approx_num_lines(collection_file, reader.offset),
+                date_index=date_index, batch_size=batch_size)
+            cur.execute(
+                'INSERT INTO fels_ingest_state VALUES (?, ?, ?)',
+                (reader.offset, reader.hexdigest(), num_rows))
+            cur.execute('COMMIT')
+
+        # Building the indexes once over the loaded table is much cheaper than
+        # maintaining them for every inserted row.
+        _create_sqlite_indexes(cur, tablename, index_cols)
+    except Exception:
+        cur.close()
+        conn.close()
+        ubelt.delete(tmp_fpath)
+        raise
+    else:
+        cur.close()
+        # Close the ingest connection so the ingest-time pragmas (e.g. the
+        # exclusive lock) do not leak into the cached query connection.
+        conn.close()
+        os.replace(tmp_fpath, sql_fpath)
+
+
+def _append_sqlite_cache(sql_fpath, collection_file, fields, tablename,
+                         date_field=None,
+                         batch_size=SQLITE_INGEST_BATCH_SIZE):
+    """
+    Ingest only the rows that were appended to the csv since the cache was
+    built.
+
+    Returns:
+        bool: False if the cache cannot be updated incrementally, because it
+            has no ingest state or because the previously ingested part of
+            the csv has changed.
+    """
+    conn = sqlite3.connect(sql_fpath, isolation_level=None)
+    cur = conn.cursor()
+    try:
+        try:
+            state = cur.execute(
+                'SELECT source_offset, source_sha1, num_rows '
+                'FROM fels_ingest_state').fetchone()
+        except sqlite3.OperationalError:
+            state = None
+        if state is None:
+            return False
+        prev_offset, prev_sha1, prev_num_rows = state
+
+        with open_catalog_file(collection_file, 'rb') as csvfile:
+            reader = _HashedLineReader(csvfile)
+            header = reader.readline()
+            nbytes = reader.skip(prev_offset - reader.offset)
+            if reader.offset != prev_offset or reader.hexdigest() != prev_sha1:
+                return False
+            print('Verified {} previously ingested bytes'.format(nbytes))
+            csv_fields = header.strip().split(',')
+            field_to_idx = {field: idx for idx, field in enumerate(csv_fields)}
+            col_indexes = [field_to_idx[k] for k in fields]
+            date_index = None if date_field is None else field_to_idx[date_field]
+            cur.execute('BEGIN')
+            num_rows = _bulk_insert_csv_lines(
+                cur, tablename, fields, col_indexes, iter(reader),
+                approx_num_rows=_approx_num_lines(collection_file, reader.offset),
+                date_index=date_index, batch_size=batch_size)
+            cur.execute(
+                'UPDATE fels_ingest_state SET source_offset=?, '
+                'source_sha1=?, num_rows=?',
+                (reader.offset, reader.hexdigest(), prev_num_rows + num_rows))
+            cur.execute('COMMIT')
+    finally:
+        cur.close()
+        conn.close()
+    # Mark the cache as up to date even if there were no new rows
+    os.utime(sql_fpath)
+    return True
+
+
+def _migrate_sqlite_cache(legacy_fpath, sql_fpath, fields, table_create_cmd,
+                          tablename, index_cols, date_field=None):
+    """
+    Convert a cache with an older layout into the current layout without
+    re-reading the csv. The legacy cache is removed on success.
+
+    Returns:
+        bool: False if the legacy cache could not be migrated
+    """
+    print('Migrating sql cache {!r} to {!r}'.format(legacy_fpath, sql_fpath))
+    tmp_fpath = sql_fpath + '.tmp'
+    ubelt.delete(tmp_fpath)
+    conn = sqlite3.connect(tmp_fpath, isolation_level=None)
+    cur = conn.cursor()
+    try:
+        for pragma in SQLITE_INGEST_PRAGMAS:
+            cur.execute(pragma)
+        cur.execute(table_create_cmd)
+        cur.execute(INGEST_STATE_CREATE_CMD)
+        cur.execute('ATTACH DATABASE ? AS legacy', (legacy_fpath,))
+        cur.execute('BEGIN')
+        keys = list(fields)
+        values = list(fields)
+        if date_field is not None:
+            keys.append(CACHE_DATE_FIELD)
+            values.append(_SQL_ISODATE_TO_INT.format(date_field))
+        cur.execute(
+            'INSERT INTO main.{tablename}({keys}) '
+            'SELECT {values} FROM legacy.{tablename}'.format(
+                tablename=tablename, keys=','.join(keys),
+                values=','.join(values)))
+        has_state = cur.execute(
+            "SELECT count(*) FROM legacy.sqlite_master "
+            "WHERE type='table' AND name='fels_ingest_state'").fetchone()[0]
+        if has_state:
+            cur.execute('INSERT INTO main.fels_ingest_state '
+                        'SELECT * FROM legacy.fels_ingest_state')
+        cur.execute('COMMIT')
+        cur.execute('DETACH DATABASE legacy')
+        _create_sqlite_indexes(cur, tablename, index_cols)
+    except sqlite3.Error as ex:
+        print('Unable to migrate the sql cache: {!r}'.format(ex))
+        cur.close()
+        conn.close()
+        ubelt.delete(tmp_fpath)
+        return False
+    cur.close()
+    conn.close()
+    # Keep the modification time so a newer csv is still detected
+    legacy_stat = os.stat(legacy_fpath)
+    os.utime(tmp_fpath, (legacy_stat.st_atime, legacy_stat.st_mtime))
+    os.replace(tmp_fpath, sql_fpath)
+    ubelt.delete(legacy_fpath, verbose=3)
+    return True
+
+
+def _create_sqlite_indexes(cur, tablename, index_cols):
+    """
+    Create one index for each list of columns in ``index_cols``. A column
+    may be followed by ``DESC``.
+    """
+    for cols in index_cols:
+        indexname = '_'.join([tablename] + [col.split()[0] for col in cols] +
+                             ['index'])
+        create_index_cmd = ubelt.codeblock(
+            '''
+            CREATE INDEX {indexname} ON {tablename} ({index_cols_str});
+            ''').format(
+                index_cols_str=', '.join(cols), tablename=tablename,
+                indexname=indexname)
+        print('(SQL) >')
+        print(create_index_cmd)
+        cur.execute(create_index_cmd)
+
+
+class _HashedLineReader(object):
+    """
+    Iterates over the lines of a binary file while keeping track of how many
+    bytes have been consumed and a sha1 hash of those bytes.
+
+    Example:
+        >>> from fels.utils import _HashedLineReader
+        >>> import io
+        >>> reader = _HashedLineReader(io.BytesIO(b'a,b\\n1,2\\n3,4'), blocksize=3)
+        >>> reader.readline()
+        'a,b\\n'
+        >>> list(reader)
+        ['1,2', '3,4']
+        >>> reader.offset
+        11
+        >>> reader = _HashedLineReader(io.BytesIO(b'a,b\\n1,2\\n3,4\\n5,6\\n'))
+        >>> reader.skip(8)
+        8
+        >>> list(reader)
+        ['3,4', '5,6']
+        >>> prefix = _HashedLineReader(io.BytesIO(b'a,b\\n1,2\\nX'))
+        >>> prefix.skip(100)
+        9
+    """
+
+    def __init__(self, file, blocksize=2 ** 22):
+        self.file = file
+        self.blocksize = blocksize
+        self.offset = 0
+        self._hasher = hashlib.sha1()
+
+    def hexdigest(self):
+        return self._hasher.hexdigest()
+
+    def readline(self):
+        line = self.file.readline()
+        self._hasher.update(line)
+        self.offset += len(line)
+        return line.decode('utf8')
+
+    def skip(self, nbytes):
+        """
+        Consume (and hash) up to ``nbytes`` bytes. Returns the number of
+        bytes that were actually available.
+        """
+        remain = nbytes
+        while remain > 0:
+            block = self.file.read(min(remain, self.blocksize))
+            if not block:
+                break
+            self._hasher.update(block)
+            self.offset += len(block)
+            remain -= len(block)
+        return nbytes - remain
+
+    def __iter__(self):
+        remainder = b''
+        while True:
+            block = self.file.read(self.blocksize)
+            if not block:
+                break
+            self._hasher.update(block)
+            self.offset += len(block)
+            data = remainder + block
+            cut = data.rfind(b'\n') + 1
+            remainder = data[cut:]
+            for line in data[:cut].decode('utf8').split('\n'):
+                if line:
+                    yield line
+        if remainder:
+            # The last line does not need to end with a newline
+            yield remainder.decode('utf8')
+
+
+def _catalog_basepath(collection_file):
+    """
+    The path of a catalogue file without any compression extension.
+    """
+    if collection_file.endswith('.gz'):
+        return collection_file[:-3]
+    return collection_file
+
+
+def _approx_num_lines(collection_file, offset=0, sample_nbytes=2 ** 16):
+    """
+    Approximate the number of lines after ``offset`` in a catalogue file by
+    measuring the average number of bytes per line in a sample. Returns None
+    for gzipped files, where this would require decompressing the data.
+    """
+    if collection_file.endswith('.gz'):
+        return None
+    total_nbytes = os.path.getsize(collection_file)
+    with open(collection_file, 'rb') as file:
+        file.seek(offset)
+        sample = file.read(sample_nbytes)
+    num_sample_lines = sample.count(b'\n')
+    if not num_sample_lines:
+        return None
+    return int((total_nbytes - offset) * num_sample_lines / len(sample))
+
+
+def _bulk_insert_csv_lines(cur, tablename, fields, col_indexes, lines,
+                           approx_num_rows=None, date_index=None,
+                           batch_size=SQLITE_INGEST_BATCH_SIZE):
+    """
+    Insert the selected columns of raw csv lines with batched executemany
+    calls and report the ingest rate.
+
+    Args:
+        cur (sqlite3.Cursor): cursor with an open transaction
+        tablename (str): table to insert into
+        fields (List[str]): names of the columns to insert
+        col_indexes (List[int]): index of each field in a csv line
+        lines (Iterable[str]): raw csv lines (without the header)
+        approx_num_rows (int | None): used for progress reporting
+        date_index (int | None): index of a csv column with an ISO date that
+            is additionally inserted as YYYYMMDD into the
+            :data:`CACHE_DATE_FIELD` column
+        batch_size (int): number of rows per executemany call
+
+    Returns:
+        int: the number of inserted rows
+
+    Example:
+        >>> from fels.utils import *  # NOQA
+        >>> conn = sqlite3.connect(':memory:')
+        >>> cur = conn.cursor()
+        >>> _ = cur.execute('CREATE TABLE t (a TEXT, c REAL)')
+        >>> lines = ['x{},y,{}'.format(i, i) for i in range(25)]
+        >>> _bulk_insert_csv_lines(cur, 't', ['a', 'c'], [0, 2], lines, batch_size=10)
+        25
+        >>> cur.execute('SELECT count(*), sum(c) FROM t').fetchone()
+        (25, 300.0)
+        >>> _ = cur.execute('CREATE TABLE d (t TEXT, ACQ_DATE INTEGER)')
+        >>> lines = ['2016-10-15T10:24:02.026Z,a', '2017-01-02,b']
+        >>> _ = _bulk_insert_csv_lines(cur, 'd', ['t'], [0], lines, date_index=0)
+        >>> cur.execute('SELECT ACQ_DATE FROM d').fetchall()
+        [(20161015,), (20170102,)]
+    """
+    import tqdm
+    keys = list(fields)
+    values = ['?'] * len(fields)
+    if date_index is not None:
+        # The date conversion is done by sqlite, which is faster than python
+        keys.append(CACHE_DATE_FIELD)
+        values.append(_SQL_ISODATE_TO_INT.format('?'))
+        col_indexes = list(col_indexes) + [date_index]
+    keypart = ','.join(keys)
+    valpart = ','.join(values)
+    insert_statement = ubelt.codeblock(
+        '''
+        INSERT INTO {tablename}({keypart})
+        VALUES({valpart})
+        ''').format(keypart=keypart, valpart=valpart,
+                    tablename=tablename)
+
+    # Select the values to insert into the SQLite database
+    # Note: if this fails with an index error, its possible
+    # the CSV file was not fully downloaded
+    select_cols = operator.itemgetter(*col_indexes)
+    if len(col_indexes) == 1:
+        _select_one = select_cols
+        select_cols = lambda cols: (_select_one(cols),)  # NOQA
+
+    prog = tqdm.tqdm(
+        desc='insert csv rows into sqlite cache',
+        total=approx_num_rows, mininterval=1, maxinterval=15,
+        position=0, leave=True,
+    )
+    num_rows = 0
+    start_time = time.perf_counter()
+    lines = iter(lines)
+    with prog:
+        while True:
+            batch = [select_cols(line.rstrip('\r\n').split(','))
+                     for line in itertools.islice(lines, batch_size)]
+            if not batch:
+                break
+            cur.executemany(insert_statement, batch)
+            num_rows += len(batch)
+            prog.update(len(batch))
+    elapsed = time.perf_counter() - start_time
+    rate = num_rows / elapsed if elapsed > 0 else float('inf')
+    print('Inserted {} rows in {:.2f}s ({:,.0f} rows/sec)'.format(
+        num_rows, elapsed, rate))
+    return num_rows
+
+
 @atexit.register
 def _close_global_conns():
     for conn in GLOBAL_SQLITE_CONNECTIONS.values():
@@ -0,0 +1,420 @@
+# -*- coding: utf-8 -*-
+"""
+Integrity checks of downloaded files against the size and checksums that
+Google Cloud Storage reports for each object.
+
+GCS sends an ``x-goog-hash`` header with the base64 encoded MD5 and CRC32C
+of the object, and ``x-goog-stored-content-length`` with its size. These
+are recorded next to the downloaded files, in a ``.fels_checksums.json``
+file in each image directory, so the files can be checked again later
+without network access, see :func:`verify_tree` and ``fels verify``.
+The records of an image are collected in memory while its files download
+and written once, by :func:`flush_checksums`, when the image is finalized.
+
+CRC32C is only checked if the optional ``google-crc32c`` or ``crc32c``
+package is installed.
+"""
+from __future__ import absolute_import, division, print_function
+import argparse
+import atexit
+import base64
+import functools
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from fels.ledger import reopen_product, LEDGER_FNAME
+
+try:
+    import google_crc32c as _crc32c_module
+except ImportError:
+    try:
+        import crc32c as _crc32c_module
+    except ImportError:
+        _crc32c_module = None
+
+
+# Name of the file that holds the checksums of an image directory
+CHECKSUMS_FNAME = '.fels_checksums.json'
+
+# Serializes updates of the checksum records by concurrent downloads
+_CHECKSUMS_LOCK = threading.Lock()
+
+# Records that are not written yet, by image directory
+_PENDING_CHECKSUMS = {}
+
+
+class ChecksumError(IOError):
+    """
+    A downloaded file does not match the size or checksum of the object.
+    """
+
+
+def expected_from_headers(headers):
+    """
+    Read the size and checksums of an object from its response headers.
+
+    Args:
+        headers (Mapping[str, str]): http response headers
+
+    Returns:
+        Dict[str, object]: with keys ``size``, ``md5`` and ``crc32c``. Values
+        the server did not send are None.
+
+    Example:
+        >>> from fels.verify import *  # NOQA
+        >>> import email.message
+        >>> headers = email.message.Message()
+        >>> headers['x-goog-hash'] = 'crc32c=n03x6A=='
+        >>> headers['x-goog-hash'] = 'md5=Ojk9c3dhfxgoKVVHYwFbHQ=='
+        >>> headers['x-goog-stored-content-length'] = '5'
+        >>> expected_from_headers(headers)
+        {'size': 5, 'md5': 'Ojk9c3dhfxgoKVVHYwFbHQ==', 'crc32c': 'n03x6A=='}
+    """
+    expected = {'size': None, 'md5': None, 'crc32c': None}
+    get_all = getattr(headers, 'get_all', None)
+    values = get_all('x-goog-hash') if get_all else [headers.get('x-goog-hash')]
+    for value in values or []:
+        for part in (value or '').split(','):
+            key, _, digest = part.strip().partition('=')
+            if key in ('md5', 'crc32c') and digest:
+                expected[key] = digest
+    size = headers.get('x-goog-stored-content-length')
+    if size is not None:
+        expected['size'] = int(size)
+    return expected
+
+
+def file_digests(fpath, blocksize=2 ** 22):
+    """
+    Compute the size and base64 MD5 / CRC32C of a local file, in the format
+    of the ``x-goog-hash`` header.
+
+    Example:
+        >>> from fels.verify import *  # NOQA
+        >>> import tempfile
+        >>> with tempfile.NamedTemporaryFile() as file:
+        >>>     _ = file.write(b'hello')
+        >>>     file.flush()
+        >>>     digests = file_digests(file.name)
+        >>> digests['size'], digests['md5']
+        (5, 'XUFAKrxLKna5cZ2REBfFkg==')
+    """
+    md5 = hashlib.md5()
+    crc = _crc32c_module.Checksum() if _crc32c_module is not None and hasattr(
+        _crc32c_module, 'Checksum') else None
+    crc_value = 0
+    size = 0
+    with open(fpath, 'rb') as file:
+        for block in iter(functools.partial(file.read, blocksize), b''):
+            size += len(block)
+            md5.update(block)
+            if crc is not None:
+                crc.update(block)
+            elif _crc32c_module is not None:
+                crc_value = _crc32c_module.crc32c(block, crc_value)
+    digests = {
+        'size': size,
+        'md5': base64.b64encode(md5.digest()).decode('ascii'),
+        'crc32c': None,
+    }
+    if crc is not None:
+        digests['crc32c'] = base64.b64encode(crc.digest()).decode('ascii')
+    elif _crc32c_module is not None:
+        digests['crc32c'] = base64.b64encode(
+            crc_value.to_bytes(4, 'big')).decode('ascii')
+    return digests
+
+
+def check_file(fpath, expected):
+    """
+    Compare a local file with the expected size and checksums.
+
+    Args:
+        fpath (str): the local file
+        expected (Dict[str, object]): see :func:`expected_from_headers`
+
+    Returns:
+        bool | None: True if all known values match, None if nothing is
+        known about the object to compare against.
+
+    Raises:
+        ChecksumError: if a value does not match
+    """
+    comparable = ['size', 'md5']
+    if _crc32c_module is not None:
+        comparable.append('crc32c')
+    keys = [key for key in comparable if expected.get(key) is not None]
+    if not keys:
+        return None
+    if keys == ['size']:
+        got = {'size': os.path.getsize(fpath)}
+    else:
+        got = file_digests(fpath)
+    for key in keys:
+        if got[key] != expected[key]:
+            raise ChecksumError('{} has {} {}, expected {}'.format(
+                fpath, key, got[key], expected[key]))
+    return True
+
+
+def load_checksums(dpath):
+    """
+    Read the checksum records of an image directory, including the ones that
+    are not written yet.
+
+    Returns:
+        Dict[str, Dict]: a record for each file, by path relative to dpath
+    """
+    with _CHECKSUMS_LOCK:
+        return dict(_checksum_records(dpath))
+
+
+def _checksum_records(dpath):
+    # The records of a directory, kept pending after the first lookup. Use
+    # while holding _CHECKSUMS_LOCK.
+    records = _PENDING_CHECKSUMS.get(os.path.abspath(dpath))
+    if records is not None:
+        return records
+    fpath = os.path.join(dpath, CHECKSUMS_FNAME)
+    if not os.path.exists(fpath):
+        return {}
+    with open(fpath, 'r') as file:
+        return json.load(file)
+
+
+def record_checksum(dpath, fpath, url, expected, verified):
+    """
+    Store the expected checksums of a downloaded file and the outcome of its
+    verification with the records of its image directory. The records are
+    written by :func:`flush_checksums`.
+
+    Args:
+        dpath (str): the image directory
+        fpath (str): the downloaded file inside of ``dpath``
+        url (str): where the file was downloaded from
+        expected (Dict[str, object]): see :func:`expected_from_headers`
+        verified (bool | None): the result of :func:`check_file`
+    """
+    record = dict(expected)
+    record['url'] = url
+    record['verified'] = verified
+    stat = os.stat(fpath)
+    record['mtime'] = stat.st_mtime
+    record['checked'] = time.time()
+    key = os.path.relpath(fpath, dpath).replace(os.sep, '/')
+    with _CHECKSUMS_LOCK:
+        records = _checksum_records(dpath)
+        records[key] = record
+        _PENDING_CHECKSUMS[os.path.abspath(dpath)] = records
+
+
+def flush_checksums(dpath=None):
+    """
+    Write the pending checksum records of an image directory, or of all
+    directories, to their checksum files.
+
+    Call this once the files of an image are downloaded, before the
+    directory is renamed or removed.
+
+    Example:
+        >>> from fels.verify import *  # NOQA
+        >>> import tempfile
+        >>> dpath = tempfile.mkdtemp()
+        >>> fpath = os.path.join(dpath, 'B1.TIF')
+        >>> with open(fpath, 'wb') as file:
+        >>>     _ = file.write(b'hello')
+        >>> record_checksum(dpath, fpath, 'gs://b/B1.TIF', {'size': 5}, True)
+        >>> os.path.exists(os.path.join(dpath, CHECKSUMS_FNAME))
+        False
+        >>> is_trusted(dpath, fpath)
+        True
+        >>> flush_checksums(dpath)
+        >>> os.path.exists(os.path.join(dpath, CHECKSUMS_FNAME))
+        True
+        >>> sorted(load_checksums(dpath))
+        ['B1.TIF']
+    """
+    with _CHECKSUMS_LOCK:
+        if dpath is None:
+            dpaths = list(_PENDING_CHECKSUMS)
+        else:
+            dpaths = [os.path.abspath(dpath)]
+        for key in dpaths:
+            records = _PENDING_CHECKSUMS.pop(key, None)
+            if records is not None and os.path.isdir(key):
+                _write_checksums(key, records)
+
+
+def is_trusted(dpath, fpath):
+    """
+    Check if a file was verified and has not changed since.
+    """
+    key = os.path.relpath(fpath, dpath).replace(os.sep, '/')
+    with _CHECKSUMS_LOCK:
+        record = _checksum_records(dpath).get(key)
+    if not record or not record.get('verified'):
+        return False
+    stat = os.stat(fpath)
+    return (record.get('size') in (None, stat.st_size) and
+            stat.st_mtime == record.get('mtime'))
+
+
+def check_existing_file(file_url, dpath, fpath):
+    """
+    Check a file from an earlier run against the size and checksums of the
+    remote file, and record the result.
+
+    Files that were verified before and did not change since are trusted
+    without a request. If the remote file cannot be reached, the file is
+    kept.
+
+    Args:
+        file_url (str): where the file was downloaded from
+        dpath (str): the image directory
+        fpath (str): the file inside of ``dpath``
+
+    Returns:
+        bool: False if the file must be downloaded again
+    """
+    from fels.download import TRANSIENT_ERRORS
+    if is_trusted(dpath, fpath):
+        return True
+    try:
+        problem = _check_remote(dpath, fpath, file_url)
+    except TRANSIENT_ERRORS as error:
+        print('Could not verify', fpath, repr(error))
+        return True
+    if problem is not None:
+        print(problem)
+        return False
+    return True
+
+
+def _check_remote(dpath, fpath, file_url):
+    # Compare a file with the headers of the remote file and record the
+    # result. Returns the problem, or None if the file is ok.
+    from fels.download import fetch_headers
+    expected = expected_from_headers(fetch_headers(file_url))
+    try:
+        verified = check_file(fpath, expected)
+    except ChecksumError as error:
+        record_checksum(dpath, fpath, file_url, expected, False)
+        return str(error)
+    record_checksum(dpath, fpath, file_url, expected, verified)
+    return None
+
+
+def _write_checksums(dpath, records):
+    # Replace the file at once, so readers never see a partial file
+    fd, tmp_fpath = tempfile.mkstemp(dir=dpath, prefix=CHECKSUMS_FNAME,
+                                     suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as file:
+            json.dump(records, file, indent=1, sort_keys=True)
+        os.replace(tmp_fpath, os.path.join(dpath, CHECKSUMS_FNAME))
+    except BaseException:
+        os.remove(tmp_fpath)
+        raise
+
+
+# Records of images that were not finalized, e.g. after an error
+atexit.register(flush_checksums)
+
+
+def verify_tree(outputdir, workers=1):
+    """
+    Check all recorded files in an output directory again.
+
+    Every image directory with a checksum file is checked: each file it
+    lists must exist and match its recorded size and checksums. Files that
+    the ledger of an output directory lists (see :mod:`fels.ledger`), but
+    that have no checksum record, e.g. because they were downloaded without
+    ``--verify``, are compared with the headers of the remote file. The
+    results are recorded, so unchanged files are trusted by later
+    downloads, and images with bad files are marked incomplete in their
+    ledger, so the next download run fetches those files again.
+
+    Args:
+        outputdir (str): a directory with downloaded images
+        workers (int): number of files checked at the same time
+
+    Returns:
+        Dict[str, str]: the problem with each bad file, by path
+    """
+    from fels.download import run_jobs
+    from fels.ledger import ledger_files
+    jobs = []
+    image_dirs = {}
+    for root, dnames, fnames in os.walk(outputdir):
+        if CHECKSUMS_FNAME not in fnames:
+            continue
+        for key, record in sorted(load_checksums(root).items()):
+            fpath = os.path.join(root, *key.split('/'))
+            image_dirs[fpath] = root
+            jobs.append(functools.partial(_verify_recorded, root, fpath, record))
+    for root, dnames, fnames in os.walk(outputdir):
+        if LEDGER_FNAME not in fnames:
+            continue
+        for fpath, url, dpath in ledger_files(root):
+            if fpath not in image_dirs and url is not None:
+                image_dirs[fpath] = dpath
+                jobs.append(functools.partial(_verify_remote, dpath, fpath,
+                                              url))
+    print('Verifying {} files in {}'.format(len(jobs), outputdir))
+    problems = {}
+    for fpath, problem in run_jobs(jobs, workers=workers):
+        if problem is not None:
+            problems[fpath] = problem
+    flush_checksums()
+    for dpath in sorted({image_dirs[fpath] for fpath in problems}):
+        ledger_dpath = os.path.dirname(dpath)
+        if os.path.exists(os.path.join(ledger_dpath, LEDGER_FNAME)):
+            reopen_product(ledger_dpath, dpath)
+    print('{} of {} files are ok'.format(len(jobs) - len(problems), len(jobs)))
+    return problems
+
+
+def _verify_recorded(dpath, fpath, record):
+    if not os.path.exists(fpath):
+        return fpath, 'missing'
+    try:
+        verified = check_file(fpath, record)
+    except ChecksumError as error:
+        record_checksum(dpath, fpath, record.get('url'), record, False)
+        return fpath, str(error)
+    record_checksum(dpath, fpath, record.get('url'), record, verified)
+    return fpath, None
+
+
+def _verify_remote(dpath, fpath, url):
+    from fels.download import TRANSIENT_ERRORS
+    if not os.path.exists(fpath):
+        return fpath, 'missing'
+    try:
+        return fpath, _check_remote(dpath, fpath, url)
+    except TRANSIENT_ERRORS as error:
+        # Not known to be bad
+        print('Could not verify', fpath, repr(error))
+        return fpath, None
+
+
+def verify_main(argv=None):
+    """
+    Entrypoint of ``fels verify``.
+
+    Returns:
+        int: 0 if all files are ok, otherwise 1
+    """
+    parser = argparse.ArgumentParser(
+        prog='fels verify',
+        description='Check downloaded images against the sizes and checksums recorded when they were downloaded with --verify. Files of the download ledger without a record are checked against the remote files.')
+    parser.add_argument('outputdir', help='Directory with the downloaded images')
+    parser.add_argument('--workers', type=int, help='Number of files checked at the same time', default=1)
+    options = parser.parse_args(argv)
+    problems = verify_tree(options.outputdir, workers=options.workers)
+    for fpath, problem in sorted(problems.items()):
+        print('FAILED {}: {}'.format(fpath, problem))
+    return 1 if problems else 0
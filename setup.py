@@ -1,4 +1,6 @@
 from setuptools import setup
+from setuptools.command.build_py import build_py
+import subprocess
 import sys
 import os
 
@@ -118,6 +120,23 @@ def parse_requirements(fname='requirements.txt', with_version=False):
     packages = list(gen_packages_items())
     return packages
 
+class BuildPyWithFootprints(build_py):
+    """
+    Build the footprint indexes into fels/data/footprints before the package
+    data is copied, see :mod:`fels.footprints`. This needs the runtime
+    dependencies and the shapefiles; without them the indexes are built in
+    the fels cache directory the first time they are needed.
+    """
+    def run(self):
+        try:
+            subprocess.check_call([sys.executable, '-m', 'fels.footprints'],
+                                  cwd=os.path.dirname(os.path.abspath(__file__)))
+        except (subprocess.CalledProcessError, OSError) as ex:
+            print('Not shipping footprint indexes, they are built on first '
+                  'use: {!r}'.format(ex))
+        build_py.run(self)
+
+
 tag = parse_version('fels/__init__.py')
 
 with open("README.md", "r") as fh:
@@ -136,8 +155,9 @@ setup(
     license='GPL',
     zip_safe=False,  # TODO: we can grab fels data with a ubelt cache
     packages=['fels'],
-    package_data={'': ['data/*']},
+    package_data={'': ['data/*', 'data/footprints/*/*']},
     include_package_data=True,
+    cmdclass={'build_py': BuildPyWithFootprints},
     install_requires=parse_requirements('requirements/runtime.txt'),
     extras_require={
         'all': parse_requirements('requirements.txt'),
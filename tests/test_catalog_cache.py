@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+"""
+Test the catalog caches against small synthetic index files that mimic the
+layout of the Google Cloud Landsat and Sentinel-2 ``index.csv`` files.
+"""
+import datetime
+import gzip
+import os
+import random
+import sqlite3
+from fels import landsat
+from fels import sentinel2
+from fels import utils
+
+
+SENTINEL2_HEADER = [
+    'GRANULE_ID', 'PRODUCT_ID', 'DATATAKE_IDENTIFIER', 'MGRS_TILE',
+    'SENSING_TIME', 'TOTAL_SIZE', 'CLOUD_COVER', 'GEOMETRIC_QUALITY_FLAG',
+    'GENERATION_TIME', 'NORTH_LAT', 'SOUTH_LAT', 'WEST_LON', 'EAST_LON',
+    'BASE_URL']
+
+LANDSAT_HEADER = [
+    'SCENE_ID', 'PRODUCT_ID', 'SPACECRAFT_ID', 'SENSOR_ID', 'DATE_ACQUIRED',
+    'COLLECTION_NUMBER', 'COLLECTION_CATEGORY', 'SENSING_TIME', 'DATA_TYPE',
+    'WRS_PATH', 'WRS_ROW', 'CLOUD_COVER', 'NORTH_LAT', 'SOUTH_LAT',
+    'WEST_LON', 'EAST_LON', 'TOTAL_SIZE', 'BASE_URL']
+
+
+def _sentinel2_rows(num, seed=0):
+    rng = random.Random(seed)
+    tiles = ['13TDE', '13TDF', '52SDG', '37CET']
+    base = datetime.datetime(2016, 1, 1)
+    for idx in range(num):
+        tile = rng.choice(tiles)
+        dt = base + datetime.timedelta(days=rng.randint(0, 1500),
+                                       seconds=rng.randint(0, 86399))
+        stamp = dt.strftime('%Y%m%dT%H%M%S')
+        name = 'S2A_MSIL1C_{}_N0206_R098_T{}_{}{:04d}.SAFE'.format(
+            stamp, tile, stamp[:-4], idx % 10000)
+        url = 'gs://gcp-public-data-sentinel-2/tiles/{}/{}/{}/{}'.format(
+            tile[0:2], tile[2], tile[3:5], name)
+        yield {
+            'GRANULE_ID': 'L1C_T{}_{}'.format(tile, idx),
+            'PRODUCT_ID': name[:-5],
+            'DATATAKE_IDENTIFIER': 'GS2A_{}'.format(stamp),
+            'MGRS_TILE': tile,
+            'SENSING_TIME': dt.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z',
+            'TOTAL_SIZE': str(rng.randint(10 ** 6, 10 ** 9)),
+            'CLOUD_COVER': '{:.4f}'.format(rng.uniform(0, 100)),
+            'GEOMETRIC_QUALITY_FLAG': 'PASSED',
+            'GENERATION_TIME': dt.isoformat() + 'Z',
+            'NORTH_LAT': '1', 'SOUTH_LAT': '0', 'WEST_LON': '0', 'EAST_LON': '1',
+            'BASE_URL': url,
+        }
+
+
+def _landsat_rows(num, seed=0):
+    rng = random.Random(seed)
+    pathrows = [(34, 32), (33, 32), (203, 31)]
+    sensors = [('LANDSAT_8', 'OLI_TIRS', 'LC08'), ('LANDSAT_7', 'ETM', 'LE07')]
+    base = datetime.date(2013, 1, 1)
+    for idx in range(num):
+        path, row = rng.choice(pathrows)
+        spacecraft, sensor, code = rng.choice(sensors)
+        day = base + datetime.timedelta(days=rng.randint(0, 2000))
+        name = '{}_L1TP_{:03d}{:03d}_{}_20170301_01_T1'.format(
+            code, path, row, day.strftime('%Y%m%d'))
+        url = 'gs://gcp-public-data-landsat/{}/01/{:03d}/{:03d}/{}'.format(
+            code, path, row, name)
+        yield {
+            'SCENE_ID': 'LC8{:03d}{:03d}{}'.format(path, row, idx),
+            'PRODUCT_ID': name,
+            'SPACECRAFT_ID': spacecraft,
+            'SENSOR_ID': sensor,
+            'DATE_ACQUIRED': day.isoformat(),
+            'COLLECTION_NUMBER': '01',
+            'COLLECTION_CATEGORY': 'T1',
+            'SENSING_TIME': day.isoformat() + 'T17:34:12.4460000Z',
+            'DATA_TYPE': 'L1TP',
+            'WRS_PATH': str(path),
+            'WRS_ROW': str(row),
+            'CLOUD_COVER': '{:.2f}'.format(rng.uniform(0, 100)),
+            'NORTH_LAT': '1', 'SOUTH_LAT': '0', 'WEST_LON': '0', 'EAST_LON': '1',
+            'TOTAL_SIZE': str(rng.randint(10 ** 6, 10 ** 9)),
+            'BASE_URL': url,
+        }
+
+
+def _write_catalog(fpath, header, rows):
+    opener = gzip.open if fpath.endswith('.gz') else open
+    with opener(fpath, 'wt') as file:
+        file.write(','.join(header) + '\n')
+        for row in rows:
+            file.write(','.join(row[k] for k in header) + '\n')
+    return fpath
+
+
+def _http(url):
+    return 'http://storage.googleapis.com/' + url.replace('gs://', '')
+
+
+def test_sqlite_cache_bulk_load(tmp_path):
+    rows = list(_sentinel2_rows(5000))
+    collection_file = _write_catalog(
+        str(tmp_path / 'index_Sentinel.csv'), SENTINEL2_HEADER, rows)
+    conn = sentinel2._ensure_sentinel2_sqlite_conn(collection_file)
+    assert conn.execute('SELECT count(*) FROM sentinel2').fetchone()[0] == len(rows)
+    indexes = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='sentinel2'").fetchall()
+    assert len(indexes) > 0
+    # The finished cache must be usable by other connections
+    other = sqlite3.connect(collection_file + '.v002.sqlite')
+    assert other.execute('SELECT count(*) FROM sentinel2').fetchone()[0] == len(rows)
+    other.close()
+    utils._close_global_conns()
+
+
+def test_sentinel2_sqlite_query(tmp_path):
+    rows = list(_sentinel2_rows(3000))
+    collection_file = _write_catalog(
+        str(tmp_path / 'index_Sentinel.csv'), SENTINEL2_HEADER, rows)
+    tile, start, end, cc_limit = '52SDG', '2017-01-01', '2018-06-30', 40
+    found = sorted((
+        r for r in rows
+        if r['MGRS_TILE'] == tile and float(r['CLOUD_COVER']) <= cc_limit and
+        start <= r['SENSING_TIME'][:10] <= end
+    ), key=lambda r: (r['SENSING_TIME'][:10], -float(r['CLOUD_COVER'])))
+    expected = [_http(r['BASE_URL']) for r in found]
+    got = sentinel2.query_sentinel2_catalogue(
+        collection_file, cc_limit, start, end, tile)
+    assert len(expected) > 0
+    assert got == expected
+    got = sentinel2.query_sentinel2_catalogue(
+        collection_file, cc_limit, start, end, tile, latest=True)
+    assert got == expected[-1:]
+    utils._close_global_conns()
+
+
+def test_landsat_sqlite_query(tmp_path):
+    rows = list(_landsat_rows(3000))
+    collection_file = _write_catalog(
+        str(tmp_path / 'index_Landsat.csv'), LANDSAT_HEADER, rows)
+    start, end, cc_limit = '2014-01-01', '2016-12-31', 50
+    found = sorted((
+        r for r in rows
+        if r['WRS_PATH'] == '34' and r['WRS_ROW'] == '32' and
+        r['SENSOR_ID'] == 'OLI_TIRS' and float(r['CLOUD_COVER']) <= cc_limit and
+        start <= r['DATE_ACQUIRED'] <= end
+    ), key=lambda r: (r['DATE_ACQUIRED'], -float(r['CLOUD_COVER'])))
+    expected = [_http(r['BASE_URL']) for r in found]
+    got = landsat.query_landsat_catalogue(
+        collection_file, cc_limit, start, end, '034', '032', 'OLI_TIRS')
+    assert len(expected) > 0
+    assert got == expected
+    got = landsat.query_landsat_catalogue(
+        collection_file, cc_limit, start, end, '034', '032', 'OLI_TIRS',
+        latest=True)
+    assert got == expected[-1:]
+    utils._close_global_conns()
+
+
+def test_sqlite_cache_streams_gzipped_catalog(tmp_path):
+    rows = list(_sentinel2_rows(2000))
+    zipped_fpath = _write_catalog(
+        str(tmp_path / 'index_Sentinel.csv.gz'), SENTINEL2_HEADER, rows)
+    # An existing archive is used as is and is not decompressed to disk
+    collection_file = utils.download_metadata_file(
+        'http://example.invalid/index.csv.gz', str(tmp_path), 'Sentinel',
+        unzip=False)
+    assert collection_file == zipped_fpath
+    got = sentinel2.query_sentinel2_catalogue(
+        collection_file, 100, '2010-01-01', '2030-01-01', '13TDE')
+    expected = {_http(r['BASE_URL']) for r in rows if r['MGRS_TILE'] == '13TDE'}
+    assert set(got) == expected
+    assert not os.path.exists(str(tmp_path / 'index_Sentinel.csv'))
+    assert os.path.exists(str(tmp_path / 'index_Sentinel.csv.v002.sqlite'))
+    utils._close_global_conns()
+
+
+def test_sqlite_cache_incremental_refresh(tmp_path):
+    rows = list(_sentinel2_rows(3000))
+    collection_file = str(tmp_path / 'index_Sentinel.csv.gz')
+    sql_fpath = str(tmp_path / 'index_Sentinel.csv.v002.sqlite')
+    _write_catalog(collection_file, SENTINEL2_HEADER, rows[:2000])
+    conn = sentinel2._ensure_sentinel2_sqlite_conn(collection_file)
+    # Mark the cache so we can tell if it gets rebuilt
+    conn.execute(
+        "INSERT INTO sentinel2(SENSING_TIME, MGRS_TILE, BASE_URL, CLOUD_COVER, ACQ_DATE) "
+        "VALUES ('2016-01-01', 'MARKER', 'gs://marker', 0, 20160101)")
+    conn.commit()
+    utils._close_global_conns()
+
+    def _touch_newer(fpath):
+        sql_mtime = os.stat(sql_fpath).st_mtime
+        os.utime(fpath, (sql_mtime + 10, sql_mtime + 10))
+
+    # Appending rows only ingests the new rows into the existing cache
+    _write_catalog(collection_file, SENTINEL2_HEADER, rows)
+    _touch_newer(collection_file)
+    conn = sentinel2._ensure_sentinel2_sqlite_conn(collection_file)
+    assert conn.execute('SELECT count(*) FROM sentinel2').fetchone()[0] == len(rows) + 1
+    assert conn.execute('SELECT num_rows FROM fels_ingest_state').fetchone()[0] == len(rows)
+    got = sentinel2.query_sentinel2_catalogue(
+        collection_file, 100, '2010-01-01', '2030-01-01', '52SDG')
+    assert set(got) == {_http(r['BASE_URL']) for r in rows if r['MGRS_TILE'] == '52SDG'}
+    utils._close_global_conns()
+
+    # Modifying existing rows forces a full rebuild
+    _write_catalog(collection_file, SENTINEL2_HEADER, rows[1:])
+    _touch_newer(collection_file)
+    conn = sentinel2._ensure_sentinel2_sqlite_conn(collection_file)
+    assert conn.execute('SELECT count(*) FROM sentinel2').fetchone()[0] == len(rows) - 1
+    utils._close_global_conns()
+
+
+def test_sqlite_queries_use_covering_index(tmp_path):
+    rows = list(_landsat_rows(500))
+    landsat_file = _write_catalog(
+        str(tmp_path / 'index_Landsat.csv'), LANDSAT_HEADER, rows)
+    rows = list(_sentinel2_rows(500))
+    sentinel2_file = _write_catalog(
+        str(tmp_path / 'index_Sentinel.csv'), SENTINEL2_HEADER, rows)
+    landsat_conn = landsat._ensure_landsat_sqlite_conn(landsat_file)
+    sentinel2_conn = sentinel2._ensure_sentinel2_sqlite_conn(sentinel2_file)
+    for latest in [False, True]:
+        # One range of the index answers the query, without a sort
+        plan = landsat_conn.execute(
+            'EXPLAIN QUERY PLAN SELECT BASE_URL FROM landsat WHERE '
+            'WRS_PATH=? AND WRS_ROW=? AND SENSOR_ID=? '
+            'AND ACQ_DATE BETWEEN ? AND ? AND CLOUD_COVER <= ? ' +
+            utils.sql_order_clause(latest),
+            (34, 32, 'OLI_TIRS', 20140101, 20150101, 50)).fetchall()
+        assert len(plan) == 1
+        assert 'COVERING INDEX' in plan[0][-1]
+        assert 'ACQ_DATE>? AND ACQ_DATE<?' in plan[0][-1]
+        plan = sentinel2_conn.execute(
+            'EXPLAIN QUERY PLAN SELECT BASE_URL FROM sentinel2 WHERE '
+            'MGRS_TILE=? AND ACQ_DATE BETWEEN ? AND ? AND CLOUD_COVER <= ? ' +
+            utils.sql_order_clause(latest),
+            ('52SDG', 20140101, 20150101, 50)).fetchall()
+        assert len(plan) == 1
+        assert 'COVERING INDEX' in plan[0][-1]
+        assert 'ACQ_DATE>? AND ACQ_DATE<?' in plan[0][-1]
+    utils._close_global_conns()
+
+
+def test_sqlite_cache_migrates_v001(tmp_path):
+    rows = list(_sentinel2_rows(1000))
+    collection_file = _write_catalog(
+        str(tmp_path / 'index_Sentinel.csv'), SENTINEL2_HEADER, rows)
+    # Build a cache with the v001 layout
+    legacy_fpath = str(tmp_path / 'index_Sentinel.csv.v001.sqlite')
+    legacy = sqlite3.connect(legacy_fpath)
+    legacy.execute(
+        'CREATE TABLE sentinel2 (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+        'SENSING_TIME TEXT NOT NULL, MGRS_TILE TEXT NOT NULL, '
+        'BASE_URL TEXT NOT NULL, CLOUD_COVER REAL NOT NULL)')
+    legacy.executemany(
+        'INSERT INTO sentinel2(SENSING_TIME, MGRS_TILE, BASE_URL, CLOUD_COVER) '
+        'VALUES (?, ?, ?, ?)',
+        [(r['SENSING_TIME'], r['MGRS_TILE'], r['BASE_URL'], r['CLOUD_COVER'])
+         for r in rows])
+    legacy.commit()
+    legacy.close()
+    os.utime(collection_file, (0, 0))
+
+    got = sentinel2.query_sentinel2_catalogue(
+        collection_file, 100, '2017-01-01', '2017-12-31', '37CET')
+    expected = {_http(r['BASE_URL']) for r in rows
+                if r['MGRS_TILE'] == '37CET' and r['SENSING_TIME'].startswith('2017')}
+    assert set(got) == expected
+    assert not os.path.exists(legacy_fpath)
+    assert os.path.exists(str(tmp_path / 'index_Sentinel.csv.v002.sqlite'))
+    utils._close_global_conns()
+
+
+def test_batch_queries_match_single_queries(tmp_path):
+    sentinel2_file = _write_catalog(
+        str(tmp_path / 'index_Sentinel.csv'), SENTINEL2_HEADER,
+        _sentinel2_rows(3000))
+    landsat_file = _write_catalog(
+        str(tmp_path / 'index_Landsat.csv'), LANDSAT_HEADER,
+        _landsat_rows(3000))
+    tiles = ['13TDE', '52SDG', '99XXX']
+    scenes = ['034032', (203, 31), '001001']
+    for latest in [False, True]:
+        for use_csv in [False, True]:
+            # The csv path has exclusive date bounds
+            start, end = '2016-06-01', '2018-01-01'
+            if use_csv:
+                start, end = [datetime.datetime.fromisoformat(d) for d in [start, end]]
+            batch = sentinel2.query_sentinel2_catalogue_batch(
+                sentinel2_file, 50, start, end, tiles, latest=latest,
+                use_csv=use_csv)
+            assert list(batch) == tiles
+            assert batch['99XXX'] == []
+            for tile in tiles:
+                assert batch[tile] == sentinel2.query_sentinel2_catalogue(
+                    sentinel2_file, 50, start, end, tile, latest=latest,
+                    use_csv=use_csv)
+            batch = landsat.query_landsat_catalogue_batch(
+                landsat_file, 50, start, end, scenes, 'OLI_TIRS',
+                latest=latest, use_csv=use_csv)
+            assert list(batch) == scenes
+            assert batch['001001'] == []
+            for scene in scenes:
+                path, row = landsat._scene_to_pathrow(scene)
+                assert batch[scene] == landsat.query_landsat_catalogue(
+                    landsat_file, 50, start, end, path, row, 'OLI_TIRS',
+                    latest=latest, use_csv=use_csv)
+            assert len(batch['034032']) > 0
+    utils._close_global_conns()
+
+
+def test_columnar_queries_match_sqlite(tmp_path):
+    sentinel2_file = _write_catalog(
+        str(tmp_path / 'index_Sentinel.csv.gz'), SENTINEL2_HEADER,
+        _sentinel2_rows(3000))
+    landsat_file = _write_catalog(
+        str(tmp_path / 'index_Landsat.csv'), LANDSAT_HEADER,
+        _landsat_rows(3000))
+    tiles = ['13TDE', '52SDG', '99XXX']
+    scenes = ['034032', (203, 31), '001001']
+    for latest in [False, True]:
+        for sensor in ['OLI_TIRS', 'ETM']:
+            expected = landsat.query_landsat_catalogue_batch(
+                landsat_file, 50, '2016-06-01', '2018-01-01', scenes, sensor,
+                latest=latest)
+            got = landsat.query_landsat_catalogue_batch(
+                landsat_file, 50, '2016-06-01', '2018-01-01', scenes, sensor,
+                latest=latest, use_columnar=True)
+            assert got == expected
+        expected = sentinel2.query_sentinel2_catalogue_batch(
+            sentinel2_file, 50, '2016-06-01', '2018-01-01', tiles,
+            latest=latest)
+        got = sentinel2.query_sentinel2_catalogue_batch(
+            sentinel2_file, 50, '2016-06-01', '2018-01-01', tiles,
+            latest=latest, use_columnar=True)
+        assert got == expected
+        assert len(got['13TDE']) > 0
+    assert os.path.isdir(str(tmp_path / 'index_Sentinel.csv.v001.columnar'))
+    utils._close_global_conns()
+
+
+def test_columnar_build_replaces_cache(tmp_path):
+    from fels import columnar
+    rows = list(_sentinel2_rows(500))
+    collection_file = _write_catalog(
+        str(tmp_path / 'index_Sentinel.csv'), SENTINEL2_HEADER, rows)
+    with open(collection_file, 'a') as file:
+        # A short row and a row with an empty cloud cover are skipped
+        file.write('L1C_T52SDG_short,S2A_short\n')
+        file.write(','.join(
+            '' if k == 'CLOUD_COVER' else v
+            for k, v in rows[0].items()) + '\n')
+    columns = {
+        'MGRS_TILE': ('MGRS_TILE', 'code'),
+        utils.CACHE_DATE_FIELD: ('SENSING_TIME', 'date'),
+        'CLOUD_COVER': ('CLOUD_COVER', 'float32'),
+        'BASE_URL': ('BASE_URL', 'string'),
+    }
+    dpath = str(tmp_path / 'columnar')
+    for _ in range(2):
+        columnar.build_columnar_catalog(collection_file, dpath, columns,
+                                        ['MGRS_TILE', utils.CACHE_DATE_FIELD])
+        assert sorted(os.listdir(str(tmp_path))) == [
+            'columnar', 'index_Sentinel.csv']
+    catalog = columnar.ColumnarCatalog(dpath)
+    assert catalog.num_rows == len(rows)
+    assert catalog.meta['vocabs']['MGRS_TILE'] == sorted(
+        {r['MGRS_TILE'] for r in rows})
+    found = catalog.search({'MGRS_TILE': '52SDG'}, '2016-01-01', '2020-12-31',
+                           100)
+    assert sorted(found) == sorted(
+        r['BASE_URL'] for r in rows if r['MGRS_TILE'] == '52SDG')
+
+
+def test_csv_query_is_exclusive(tmp_path):
+    rows = list(_sentinel2_rows(3000))
+    collection_file = _write_catalog(
+        str(tmp_path / 'index_Sentinel.csv.gz'), SENTINEL2_HEADER, rows)
+    tile, start, end, cc_limit = '52SDG', '2017-01-01', '2018-06-30', 40
+    found = sorted((
+        r for r in rows
+        if r['MGRS_TILE'] == tile and float(r['CLOUD_COVER']) <= cc_limit and
+        start < r['SENSING_TIME'][:10] < end
+    ), key=lambda r: (r['SENSING_TIME'][:10], -float(r['CLOUD_COVER'])))
+    expected = [_http(r['BASE_URL']) for r in found]
+    assert len(expected) > 0
+    for start_, end_ in [(start, end), (datetime.datetime.fromisoformat(start),
+                                        datetime.date.fromisoformat(end))]:
+        got = sentinel2.query_sentinel2_catalogue(
+            collection_file, cc_limit, start_, end_, tile, use_csv=True)
+        assert got == expected
+
+
+def test_malformed_dates_are_skipped(tmp_path):
+    rows = list(_sentinel2_rows(200))
+    bad = dict(rows[0], SENSING_TIME='not-a-date',
+               BASE_URL=rows[0]['BASE_URL'] + '_bad')
+    collection_file = _write_catalog(
+        str(tmp_path / 'index_Sentinel.csv'), SENTINEL2_HEADER, rows + [bad])
+    dates = utils.catalog_dates([r['SENSING_TIME'] for r in rows] + [''])
+    assert str(dates[-1]) == 'NaT'
+    tile = bad['MGRS_TILE']
+    expected = sentinel2.query_sentinel2_catalogue(
+        collection_file, 100, '2015-01-01', '2021-01-01', tile)
+    got = sentinel2.query_sentinel2_catalogue(
+        collection_file, 100, '2015-01-01', '2021-01-01', tile, use_csv=True)
+    assert got == expected
+    assert len(got) == sum(r['MGRS_TILE'] == tile for r in rows)
+    assert _http(bad['BASE_URL']) not in got
+    utils._close_global_conns()
+
+
+def test_csv_chunks_split_lines_across_blocks(tmp_path):
+    collection_file = _write_catalog(
+        str(tmp_path / 'index_Landsat.csv'), LANDSAT_HEADER,
+        _landsat_rows(500))
+    dtypes = {'SCENE_ID': str, 'WRS_PATH': int}
+    full = list(utils.iter_catalog_chunks(collection_file, dtypes))
+    expected = [s for c in full for s in c['SCENE_ID'].tolist()]
+    assert len(expected) == 500
+    for tokens in [None, [',34,32,', ',203,31,']]:
+        chunks = list(utils.iter_catalog_chunks(
+            collection_file, dtypes, tokens=tokens, blocksize=1000))
+        assert len(chunks) > 1
+        got = [s for c in chunks for s in c['SCENE_ID'].tolist()]
+        if tokens is not None:
+            keep = {s for c in full for s, p in zip(c['SCENE_ID'], c['WRS_PATH'])
+                    if p != 33}
+            expected = [s for s in expected if s in keep]
+        assert got == expected
@@ -0,0 +1,789 @@
+"""
+Download tests against a local http server.
+"""
+import base64
+import functools
+import hashlib
+import http.server
+import os
+import re
+import socket
+import threading
+import pytest
+from fels import cache
+from fels import download
+from fels import landsat
+from fels import ledger
+from fels import sentinel2
+from fels import utils
+from fels import verify
+
+
+class _RangeHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves the files of ``server.root`` and supports single Range requests,
+    with If-Range.
+    The first ``server.drops[path]`` responses for a path are cut off after
+    ``server.drop_after`` bytes of the body, and the first
+    ``server.corrupt[path]`` have their last byte changed. The GCS
+    ``x-goog-hash`` and ``x-goog-stored-content-length`` headers are sent
+    with the MD5 and size of the file, which is also the ETag.
+    """
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, self.headers.get('Range')))
+        fpath = os.path.join(str(server.root), self.path.lstrip('/'))
+        if not os.path.isfile(fpath):
+            self.send_error(404)
+            return
+        with open(fpath, 'rb') as file:
+            data = file.read()
+        etag = '"{}"'.format(hashlib.md5(data).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        start = 0
+        range_header = self.headers.get('Range')
+        if self.headers.get('If-Range') not in (None, etag):
+            # The client has data of another version of the file
+            range_header = None
+        if range_header:
+            start = int(re.match(r'bytes=(\d+)-', range_header).group(1))
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(len(data)))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        body = data[start:]
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('x-goog-hash', 'md5=' + base64.b64encode(
+            hashlib.md5(data).digest()).decode('ascii'))
+        self.send_header('x-goog-stored-content-length', str(len(data)))
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        if server.corrupt.get(self.path, 0) > 0:
+            server.corrupt[self.path] -= 1
+            body = body[:-1] + bytes([body[-1] ^ 1])
+        if server.drops.get(self.path, 0) > 0:
+            server.drops[self.path] -= 1
+            self.wfile.write(body[:server.drop_after])
+            self.wfile.flush()
+            self.connection.shutdown(socket.SHUT_RDWR)
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_server(tmp_path):
+    """
+    Serve the files of a temporary directory.
+    """
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _RangeHandler)
+    server.root = tmp_path / 'remote'
+    server.root.mkdir()
+    server.url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    server.drops = {}
+    server.corrupt = {}
+    server.drop_after = 1000
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def metadata_cache(tmp_path, monkeypatch):
+    """
+    Use an empty metadata cache in each test.
+    """
+    dpath = str(tmp_path / 'metadata_cache')
+    monkeypatch.setattr(cache, 'METADATA_CACHE_DPATH', dpath)
+    return dpath
+
+
+@pytest.fixture
+def no_retry_delay(monkeypatch):
+    monkeypatch.setattr(download.DEFAULT_RETRY_POLICY, 'base_delay', 0)
+
+
+@pytest.fixture
+def file_server(http_server):
+    """
+    Returns (root, base_url) of the served directory.
+    """
+    return http_server.root, http_server.url
+
+
+def _read_bytes(fpath):
+    with open(fpath, 'rb') as file:
+        return file.read()
+
+
+def _make_landsat_scene(root, img, bands):
+    scene_dpath = root / img
+    scene_dpath.mkdir()
+    data = {}
+    for idx, band in enumerate(bands):
+        data[band] = os.urandom(1000 * (idx + 1))
+        (scene_dpath / (img + '_' + band)).write_bytes(data[band])
+    return data
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_landsat_concurrent_download(file_server, tmp_path, workers):
+    root, base_url = file_server
+    img = 'LC08_L1TP_034032_20170301_20170316_01_T1'
+    # B9 and B10 are missing on the server and must be skipped
+    bands = ['B1.TIF', 'B2.TIF', 'B3.TIF', 'B4.TIF', 'B5.TIF', 'B6.TIF',
+             'B7.TIF', 'B8.TIF', 'B11.TIF', 'ANG.txt', 'BQA.TIF', 'MTL.txt']
+    data = _make_landsat_scene(root, img, bands)
+    outputdir = tmp_path / 'out'
+    outputdir.mkdir()
+    existing = outputdir / img / (img + '_B1.TIF')
+    existing.parent.mkdir()
+    existing.write_bytes(b'keep me')
+
+    landsat.get_landsat_image(base_url + '/' + img, str(outputdir),
+                              sat='OLI_TIRS', workers=workers)
+    got = sorted(os.listdir(str(outputdir / img)))
+    assert got == sorted(img + '_' + band for band in bands)
+    assert existing.read_bytes() == b'keep me'
+    for band in bands[1:]:
+        assert (outputdir / img / (img + '_' + band)).read_bytes() == data[band]
+
+
+def _make_sentinel2_product(root, safe, missing=(), bands=range(1, 13)):
+    granule = 'GRANULE/L1C_T13TDE_A008000_20170301T175000'
+    rel_paths = ['INSPIRE.xml', 'MTD_MSIL1C.xml',
+                 granule + '/MTD_TL.xml',
+                 granule + '/QI_DATA/MSK_CLOUDS_B00.gml']
+    rel_paths += [granule + '/IMG_DATA/T13TDE_20170301T175000_B{:02d}.jp2'.format(idx)
+                  for idx in bands]
+    product = root / safe
+    data = {}
+    for rel_path in rel_paths:
+        data[rel_path] = os.urandom(500)
+        if rel_path in missing:
+            continue
+        fpath = product / rel_path
+        fpath.parent.mkdir(parents=True, exist_ok=True)
+        fpath.write_bytes(data[rel_path])
+    manifest = ['<xfdu:XFDU xmlns:xfdu="urn:ccsds:schema:xfdu:1">',
+                '<dataObjectSection>']
+    for idx, rel_path in enumerate(rel_paths):
+        manifest += [
+            '<dataObject ID="Object_{}">'.format(idx),
+            '<byteStream mimeType="application/octet-stream" size="500">',
+            '<fileLocation locatorType="URL" href="./{}"/>'.format(rel_path),
+            '</byteStream>',
+            '</dataObject>']
+    manifest += ['</dataObjectSection>', '</xfdu:XFDU>']
+    (product / 'manifest.safe').write_text('\n'.join(manifest))
+    return data
+
+
+@pytest.mark.parametrize('workers', [1, 8])
+def test_sentinel2_concurrent_download(file_server, tmp_path, workers):
+    root, base_url = file_server
+    safe = 'S2A_MSIL1C_20170301T175000_N0204_R141_T13TDE_20170301T175000.SAFE'
+    data = _make_sentinel2_product(root, safe)
+    outputdir = tmp_path / 'out'
+    ok = sentinel2.get_sentinel2_image(base_url + '/' + safe, str(outputdir),
+                                       noinspire=True, workers=workers)
+    assert ok
+    for rel_path, content in data.items():
+        assert (outputdir / safe / rel_path).read_bytes() == content
+
+
+def test_sentinel2_download_collects_errors(file_server, tmp_path):
+    root, base_url = file_server
+    safe = 'S2A_MSIL1C_20170301T175000_N0204_R141_T13TDE_20170301T175000.SAFE'
+    missing = ['MTD_MSIL1C.xml']
+    _make_sentinel2_product(root, safe, missing=missing)
+    product_url = base_url + '/' + safe
+    rel_paths = sentinel2._manifest_rel_paths(str(root / safe / 'manifest.safe'))
+    errors = sentinel2.download_sentinel2_files(
+        product_url, str(tmp_path / safe), rel_paths, workers=4)
+    assert list(errors) == [product_url + '/MTD_MSIL1C.xml']
+    assert errors[product_url + '/MTD_MSIL1C.xml'].code == 404
+    # Files that the bucket does not have do not fail the product
+    outputdir = str(tmp_path / 'out')
+    ok = sentinel2.get_sentinel2_image(product_url, outputdir,
+                                       noinspire=True, workers=4)
+    assert ok
+    assert ledger.product_status(outputdir, safe) == ledger.COMPLETE
+
+
+def test_schedule_jobs_limits_and_interleaves():
+    import collections
+    import time
+    from fels.download import schedule_jobs
+    lock = threading.Lock()
+    running = collections.Counter()
+    peak = collections.Counter()
+    started = []
+
+    def job(host, name):
+        with lock:
+            started.append(name)
+            running[host] += 1
+            running['total'] += 1
+            peak[host] = max(peak[host], running[host])
+            peak['total'] = max(peak['total'], running['total'])
+        time.sleep(0.01)
+        with lock:
+            running[host] -= 1
+            running['total'] -= 1
+        return name
+
+    groups = {}
+    for scene in ['s1', 's2', 's3']:
+        groups[scene] = []
+        for idx in range(6):
+            host = 'h1' if idx % 2 else 'h2'
+            name = '{}-{}'.format(scene, idx)
+            url = 'http://{}/{}'.format(host, name)
+            groups[scene].append((url, functools.partial(job, host, name)))
+    results = schedule_jobs(groups, workers=4, max_per_host=2)
+    assert results == {scene: [job.args[1] for _, job in jobs]
+                       for scene, jobs in groups.items()}
+    assert peak['total'] <= 4
+    assert peak['h1'] <= 2 and peak['h2'] <= 2
+    # Every scene has started before any scene started its third file
+    first_scenes = {name.split('-')[0] for name in started[:2 * len(groups)]}
+    assert first_scenes == set(groups)
+
+
+def test_download_file_resumes_with_range(http_server, tmp_path):
+    data = os.urandom(5000)
+    (http_server.root / 'band.TIF').write_bytes(data)
+    http_server.drops['/band.TIF'] = 2
+    target_file = str(tmp_path / 'band.TIF')
+    url = http_server.url + '/band.TIF'
+
+    # A dropped connection keeps the partial data in a .part file only
+    with pytest.raises(download.TRANSIENT_ERRORS):
+        download.download_file(url, target_file,
+                               retry=download.RetryPolicy(max_attempts=1))
+    assert not os.path.exists(target_file)
+    assert os.path.getsize(target_file + '.part') == 1000
+
+    info = download.download_file(
+        url, target_file, retry=download.RetryPolicy(max_attempts=2, base_delay=0))
+    assert info['attempts'] == 2
+    assert _read_bytes(target_file) == data
+    assert not os.path.exists(target_file + '.part')
+    ranges = [r for _, r in http_server.requests]
+    assert ranges == [None, 'bytes=1000-', 'bytes=2000-']
+
+
+def test_download_file_resumes_same_version(http_server, tmp_path):
+    old, new = os.urandom(5000), os.urandom(5000)
+    (http_server.root / 'band.TIF').write_bytes(old)
+    http_server.drops['/band.TIF'] = 1
+    target_file = str(tmp_path / 'band.TIF')
+    url = http_server.url + '/band.TIF'
+    with pytest.raises(download.TRANSIENT_ERRORS):
+        download.download_file(url, target_file,
+                               retry=download.RetryPolicy(max_attempts=1))
+    # The ETag of the partial data is kept for the next run
+    assert os.path.exists(target_file + '.part.etag')
+
+    # The remote file changed before the next run, which starts over
+    (http_server.root / 'band.TIF').write_bytes(new)
+    download.download_file(url, target_file)
+    assert _read_bytes(target_file) == new
+    assert sorted(os.listdir(str(tmp_path))) == ['band.TIF', 'remote']
+
+
+def test_download_file_complete_part(http_server, tmp_path):
+    # Interrupted between finishing the .part file and renaming it
+    data = os.urandom(3000)
+    (http_server.root / 'MTL.txt').write_bytes(data)
+    target_file = str(tmp_path / 'MTL.txt')
+    with open(target_file + '.part', 'wb') as file:
+        file.write(data)
+    download.download_file(http_server.url + '/MTL.txt', target_file)
+    assert _read_bytes(target_file) == data
+
+    # A part file larger than the remote file is downloaded again
+    with open(target_file + '.part', 'wb') as file:
+        file.write(data + b'garbage')
+    os.remove(target_file)
+    download.download_file(http_server.url + '/MTL.txt', target_file)
+    assert _read_bytes(target_file) == data
+
+
+def test_landsat_download_resumes(http_server, tmp_path, no_retry_delay):
+    img = 'LC08_L1TP_034032_20170301_20170316_01_T1'
+    bands = ['B1.TIF', 'MTL.txt']
+    data = _make_landsat_scene(http_server.root, img, bands)
+    http_server.drops['/{}/{}_B1.TIF'.format(img, img)] = 1
+    http_server.drop_after = 500
+    outputdir = tmp_path / 'out'
+    landsat.get_landsat_image(http_server.url + '/' + img, str(outputdir),
+                              sat='OLI_TIRS', workers=2)
+    assert sorted(os.listdir(str(outputdir / img))) == sorted(
+        img + '_' + band for band in bands)
+    for band in bands:
+        assert (outputdir / img / (img + '_' + band)).read_bytes() == data[band]
+    assert ('/{}/{}_B1.TIF'.format(img, img), 'bytes=500-') in http_server.requests
+
+
+def test_sentinel2_download_resumes(http_server, tmp_path, no_retry_delay):
+    root, base_url = http_server.root, http_server.url
+    safe = 'S2A_MSIL1C_20170301T175000_N0204_R141_T13TDE_20170301T175000.SAFE'
+    data = _make_sentinel2_product(root, safe)
+    for rel_path in list(data)[:3]:
+        http_server.drops['/{}/{}'.format(safe, rel_path)] = 2
+    http_server.drop_after = 100
+    outputdir = tmp_path / 'out'
+    ok = sentinel2.get_sentinel2_image(base_url + '/' + safe, str(outputdir),
+                                       noinspire=True, workers=4)
+    assert ok
+    for rel_path, content in data.items():
+        assert (outputdir / safe / rel_path).read_bytes() == content
+
+
+def test_catalog_download_resumes(http_server, tmp_path, no_retry_delay):
+    data = os.urandom(20000)
+    (http_server.root / 'index.csv.gz').write_bytes(data)
+    http_server.drops['/index.csv.gz'] = 3
+    outputdir = tmp_path / 'catalogs'
+    fpath = utils.download_metadata_file(
+        http_server.url + '/index.csv.gz', str(outputdir), 'Landsat',
+        unzip=False)
+    assert _read_bytes(fpath) == data
+    assert os.listdir(str(outputdir)) == ['index_Landsat.csv.gz']
+
+
+def test_retry_policy_gives_up(http_server, tmp_path, no_retry_delay):
+    (http_server.root / 'B1.TIF').write_bytes(os.urandom(5000))
+    http_server.drops['/B1.TIF'] = 10
+    policy = download.RetryPolicy(max_attempts=3, base_delay=0)
+    with pytest.raises(download.TRANSIENT_ERRORS):
+        download.download_file(http_server.url + '/B1.TIF',
+                               str(tmp_path / 'B1.TIF'), retry=policy)
+    assert len(http_server.requests) == 3
+
+    # Permanent errors are not retried
+    http_server.requests[:] = []
+    with pytest.raises(download.HTTPError) as info:
+        download.download_file(http_server.url + '/missing.TIF',
+                               str(tmp_path / 'missing.TIF'), retry=policy)
+    assert info.value.code == 404
+    assert len(http_server.requests) == 1
+
+
+def test_retry_policy_backoff():
+    policy = download.RetryPolicy(base_delay=1, max_delay=30, jitter=0.5)
+    for retry in range(1, 10):
+        nominal = min(30, 2 ** (retry - 1))
+        for _ in range(20):
+            assert nominal / 2 <= policy.delay(retry) <= nominal
+
+
+def test_verified_download(http_server, tmp_path, no_retry_delay):
+    img = 'LC08_L1TP_034032_20170301_20170316_01_T1'
+    bands = ['B1.TIF', 'B2.TIF', 'MTL.txt']
+    data = _make_landsat_scene(http_server.root, img, bands)
+    # The first response is corrupt, the retry is fine
+    http_server.corrupt['/{}/{}_B2.TIF'.format(img, img)] = 1
+    outputdir = tmp_path / 'out'
+    landsat.get_landsat_image(http_server.url + '/' + img, str(outputdir),
+                              sat='OLI_TIRS', workers=2, verify=True)
+    scene_dpath = outputdir / img
+    for band in bands:
+        assert (scene_dpath / (img + '_' + band)).read_bytes() == data[band]
+    records = verify.load_checksums(str(scene_dpath))
+    assert sorted(records) == sorted(img + '_' + band for band in bands)
+    assert all(r['verified'] for r in records.values())
+    assert records[img + '_B1.TIF']['size'] == len(data['B1.TIF'])
+
+    # Verified files are trusted by the next run without any request
+    http_server.requests[:] = []
+    landsat.get_landsat_image(http_server.url + '/' + img, str(outputdir),
+                              sat='OLI_TIRS', verify=True)
+    assert [r for r in http_server.requests if r[0].endswith('_B1.TIF')] == []
+
+    # A truncated file is found by fels verify and downloaded again
+    b1 = scene_dpath / (img + '_B1.TIF')
+    b1.write_bytes(data['B1.TIF'][:100])
+    assert not verify.is_trusted(str(scene_dpath), str(b1))
+    from fels.fels import main
+    assert main(['verify', str(outputdir), '--workers', '2']) == 1
+    assert verify.load_checksums(str(scene_dpath))[b1.name]['verified'] is False
+    landsat.get_landsat_image(http_server.url + '/' + img, str(outputdir),
+                              sat='OLI_TIRS', verify=True)
+    assert b1.read_bytes() == data['B1.TIF']
+    assert main(['verify', str(outputdir)]) == 0
+
+
+def test_verify_unrecorded_existing_file(http_server, tmp_path):
+    img = 'LC08_L1TP_034032_20170301_20170316_01_T1'
+    data = _make_landsat_scene(http_server.root, img, ['MTL.txt'])
+    target = tmp_path / img / (img + '_MTL.txt')
+    target.parent.mkdir()
+    target.write_bytes(b'truncated')
+    landsat.get_landsat_image(http_server.url + '/' + img, str(tmp_path),
+                              sat='OLI_TIRS', verify=True)
+    assert target.read_bytes() == data['MTL.txt']
+    assert verify.is_trusted(str(target.parent), str(target))
+
+
+def test_sentinel2_verified_download(http_server, tmp_path, no_retry_delay,
+                                     monkeypatch):
+    root, base_url = http_server.root, http_server.url
+    safe = 'S2A_MSIL1C_20170301T175000_N0204_R141_T13TDE_20170301T175000.SAFE'
+    data = _make_sentinel2_product(root, safe)
+    http_server.corrupt['/{}/INSPIRE.xml'.format(safe)] = 1
+    outputdir = tmp_path / 'out'
+    writes = []
+    write_checksums = verify._write_checksums
+    monkeypatch.setattr(verify, '_write_checksums', lambda dpath, records: (
+        writes.append(dpath), write_checksums(dpath, records)))
+    ok = sentinel2.get_sentinel2_image(base_url + '/' + safe, str(outputdir),
+                                       noinspire=True, workers=4, verify=True)
+    assert ok
+    # The checksums of the product are written once, when it is finalized
+    assert writes == [str(outputdir / safe)]
+    assert [fname for fname in os.listdir(str(outputdir / safe))
+            if fname.startswith(verify.CHECKSUMS_FNAME)] == [
+                verify.CHECKSUMS_FNAME]
+    records = verify.load_checksums(str(outputdir / safe))
+    assert sorted(records) == sorted(data)
+    assert verify.verify_tree(str(outputdir), workers=4) == {}
+
+
+def test_sentinel2_verify_checks_existing_files(http_server, tmp_path):
+    root, base_url = http_server.root, http_server.url
+    safe = 'S2A_MSIL1C_20170301T175000_N0204_R141_T13TDE_20170301T175000.SAFE'
+    data = _make_sentinel2_product(root, safe)
+    outputdir = str(tmp_path / 'out')
+    product_url = base_url + '/' + safe
+    assert sentinel2.get_sentinel2_image(product_url, outputdir,
+                                         noinspire=True)
+    # A file of an unfinished run was damaged afterwards
+    b02 = [p for p in data if p.endswith('_B02.jp2')][0]
+    (tmp_path / 'out' / safe / b02).write_bytes(data[b02][:100])
+    ledger.reopen_product(outputdir, os.path.join(outputdir, safe))
+    assert sentinel2.get_sentinel2_image(product_url, outputdir,
+                                         noinspire=True, verify=True)
+    assert (tmp_path / 'out' / safe / b02).read_bytes() == data[b02]
+
+
+def test_verify_without_checksum_records(http_server, tmp_path):
+    img = 'LC08_L1TP_034032_20170301_20170316_01_T1'
+    bands = ['B1.TIF', 'B2.TIF', 'MTL.txt']
+    data = _make_landsat_scene(http_server.root, img, bands)
+    outputdir = tmp_path / 'out'
+    landsat.get_landsat_image(http_server.url + '/' + img, str(outputdir),
+                              sat='OLI_TIRS')
+    assert not (outputdir / img / verify.CHECKSUMS_FNAME).exists()
+    # The urls of the ledger give the expected values
+    b1 = outputdir / img / (img + '_B1.TIF')
+    b1.write_bytes(data['B1.TIF'][:100])
+    problems = verify.verify_tree(str(outputdir))
+    assert list(problems) == [str(b1)]
+    assert ledger.product_status(str(outputdir), img) == ledger.INCOMPLETE
+    records = verify.load_checksums(str(outputdir / img))
+    assert sorted(records) == sorted(img + '_' + band for band in bands)
+    assert records[b1.name]['verified'] is False
+
+
+def test_ledger_skips_complete_landsat_scene(http_server, tmp_path):
+    img = 'LC08_L1TP_034032_20170301_20170316_01_T1'
+    bands = ['B1.TIF', 'B2.TIF', 'MTL.txt']
+    data = _make_landsat_scene(http_server.root, img, bands)
+    url = http_server.url + '/' + img
+    outputdir = str(tmp_path)
+    landsat.get_landsat_image(url, outputdir, sat='OLI_TIRS')
+    assert ledger.product_status(outputdir, img) == ledger.COMPLETE
+    conn = ledger.connect_ledger(outputdir)
+    num_files, size = conn.execute(
+        'SELECT num_files, size FROM products WHERE name = ?', (img,)).fetchone()
+    assert num_files == len(bands)
+    assert size == sum(map(len, data.values()))
+
+    # A complete scene needs neither requests nor band files to be checked
+    http_server.requests[:] = []
+    assert landsat.plan_landsat_image(url, outputdir, sat='OLI_TIRS') == []
+    assert http_server.requests == []
+
+
+def test_ledger_resumes_incomplete_sentinel2_product(http_server, tmp_path,
+                                                     no_retry_delay):
+    root, base_url = http_server.root, http_server.url
+    safe = 'S2A_MSIL1C_20170301T175000_N0204_R141_T13TDE_20170301T175000.SAFE'
+    data = _make_sentinel2_product(root, safe)
+    product_url = base_url + '/' + safe
+    outputdir = str(tmp_path)
+    # Every attempt of the file is cut off
+    http_server.drop_after = 50
+    http_server.drops['/{}/MTD_MSIL1C.xml'.format(safe)] = (
+        download.DEFAULT_RETRY_POLICY.max_attempts)
+    assert not sentinel2.get_sentinel2_image(product_url, outputdir,
+                                             noinspire=True, workers=4)
+    assert ledger.product_status(outputdir, safe) == ledger.INCOMPLETE
+
+    # The directory exists, but the product is resumed with the failed
+    # file. The manifest comes from the metadata cache.
+    http_server.requests[:] = []
+    assert sentinel2.get_sentinel2_image(product_url, outputdir,
+                                         noinspire=True, workers=4)
+    # The download continues from the .part file
+    assert http_server.requests == [('/{}/MTD_MSIL1C.xml'.format(safe),
+                                     'bytes=250-')]
+    assert ledger.product_status(outputdir, safe) == ledger.COMPLETE
+    for rel_path, content in data.items():
+        assert (tmp_path / safe / rel_path).read_bytes() == content
+
+    http_server.requests[:] = []
+    assert sentinel2.get_sentinel2_image(product_url, outputdir,
+                                         noinspire=True, workers=4)
+    assert http_server.requests == []
+
+
+def test_download_scenes_survives_failed_plans(http_server, tmp_path):
+    from fels import fels as fels_cli
+    root, base_url = http_server.root, http_server.url
+    safe = 'S2A_MSIL1C_20170301T175000_N0204_R141_T13TDE_20170301T175000.SAFE'
+    gone = 'S2A_MSIL1C_20170302T175000_N0204_R141_T13TDE_20170302T175000.SAFE'
+    _make_sentinel2_product(root, safe)
+    outputdir = str(tmp_path / 'out')
+    options = fels_cli._get_options(
+        '13TDE', 'S2', '2017-01-01', '2017-12-31', output=outputdir,
+        noinspire=True, workers=4)
+    # The manifest of the second product cannot be fetched
+    urls = [base_url + '/' + gone, base_url + '/' + safe]
+    assert fels_cli._download_scenes(options, ['13TDE'], [urls]) == [urls[1:]]
+    assert ledger.product_status(outputdir, safe) == ledger.COMPLETE
+    assert ledger.product_status(outputdir, gone) is None
+
+
+def test_ledger_records_missing_sentinel2_files(http_server, tmp_path,
+                                                no_retry_delay):
+    root, base_url = http_server.root, http_server.url
+    safe = 'S2A_MSIL1C_20170301T175000_N0204_R141_T13TDE_20170301T175000.SAFE'
+    # The bucket never has the file that the manifest lists
+    data = _make_sentinel2_product(root, safe, missing=['MTD_MSIL1C.xml'])
+    product_url = base_url + '/' + safe
+    outputdir = str(tmp_path)
+    flaky = '/{}/INSPIRE.xml'.format(safe)
+    http_server.drop_after = 50
+    http_server.drops[flaky] = download.DEFAULT_RETRY_POLICY.max_attempts
+    assert not sentinel2.get_sentinel2_image(product_url, outputdir,
+                                             noinspire=True, workers=4)
+    assert ledger.product_status(outputdir, safe) == ledger.INCOMPLETE
+    assert ledger.is_missing_file(
+        outputdir, os.path.join(outputdir, safe, 'MTD_MSIL1C.xml'))
+
+    # The resumed run does not ask for the missing file again
+    http_server.requests[:] = []
+    assert sentinel2.get_sentinel2_image(product_url, outputdir,
+                                         noinspire=True, workers=4)
+    assert [path for path, _ in http_server.requests] == [flaky]
+    assert ledger.product_status(outputdir, safe) == ledger.COMPLETE
+    conn = ledger.connect_ledger(outputdir)
+    num_files, = conn.execute('SELECT num_files FROM products WHERE name = ?',
+                              (safe,)).fetchone()
+    assert num_files == len(data) - 1
+
+    http_server.requests[:] = []
+    assert sentinel2.get_sentinel2_image(product_url, outputdir,
+                                         noinspire=True, workers=4)
+    assert http_server.requests == []
+
+
+def test_sentinel2_partial_tile_precheck(http_server, tmp_path):
+    gdal = pytest.importorskip('osgeo.gdal')
+    import numpy as np
+    root, base_url = http_server.root, http_server.url
+    outputdir = str(tmp_path / 'out')
+    for name, value in [('partial', 0), ('full', 1)]:
+        safe = 'S2A_MSIL1C_20170301T175000_N0204_R141_T13TDE_2017030{}T175000.SAFE'.format(
+            1 if name == 'partial' else 2)
+        data = _make_sentinel2_product(root, safe)
+        b01 = [p for p in data if p.endswith('_B01.jp2')][0]
+        band = np.ones((64, 64), dtype=np.uint16)
+        band[:8, :8] = value
+        dset = gdal.GetDriverByName('GTiff').Create(
+            str(root / safe / b01), 64, 64, 1, gdal.GDT_UInt16)
+        dset.GetRasterBand(1).WriteArray(band)
+        dset = None
+
+        http_server.requests[:] = []
+        ok = sentinel2.get_sentinel2_image(base_url + '/' + safe, outputdir,
+                                           partial=True, noinspire=True,
+                                           workers=4)
+        requested = sorted(path for path, _ in http_server.requests)
+        if name == 'partial':
+            # Only the manifest and B01 were fetched, and nothing is kept
+            assert not ok
+            assert requested == ['/{}/{}'.format(safe, p)
+                                 for p in sorted([b01, 'manifest.safe'])]
+            assert not os.path.exists(os.path.join(outputdir, safe))
+            assert ledger.product_status(outputdir, safe) == ledger.PARTIAL
+            http_server.requests[:] = []
+            assert not sentinel2.get_sentinel2_image(
+                base_url + '/' + safe, outputdir, partial=True, noinspire=True)
+            assert http_server.requests == []
+        else:
+            assert ok
+            assert len(requested) == len(data) + 1
+            assert ledger.product_status(outputdir, safe) == ledger.COMPLETE
+
+
+def test_sentinel2_partial_tile_check_without_gdal(http_server, tmp_path,
+                                                   monkeypatch, capsys):
+    root, base_url = http_server.root, http_server.url
+    outputdir = str(tmp_path / 'out')
+    checked = []
+    monkeypatch.setattr(sentinel2, 'check_full_tile', lambda image, **kw: (
+        checked.append(os.path.basename(image)) or 'Full'))
+
+    # The band of the early check is not downloaded again with --overwrite
+    safe = 'S2A_MSIL1C_20170301T175000_N0204_R141_T13TDE_20170301T175000.SAFE'
+    data = _make_sentinel2_product(root, safe)
+    b01 = [p for p in data if p.endswith('_B01.jp2')][0]
+    for _ in range(2):
+        http_server.requests[:] = []
+        checked[:] = []
+        assert sentinel2.get_sentinel2_image(
+            base_url + '/' + safe, outputdir, partial=True, noinspire=True,
+            overwrite=True, workers=4)
+        requested = [path for path, _ in http_server.requests]
+        assert requested.count('/{}/{}'.format(safe, b01)) == 1
+        assert checked == [os.path.basename(b01)]
+
+    # Products without the band are kept without the check
+    safe = 'S2A_MSIL1C_20170301T175000_N0204_R141_T13TDE_20170302T175000.SAFE'
+    data = _make_sentinel2_product(root, safe, bands=range(2, 13))
+    checked[:] = []
+    assert sentinel2.get_sentinel2_image(
+        base_url + '/' + safe, outputdir, partial=True, noinspire=True)
+    assert checked == []
+    assert 'has no B01 band' in capsys.readouterr().out
+    assert ledger.product_status(outputdir, safe) == ledger.COMPLETE
+
+
+def test_metadata_cache(http_server, metadata_cache):
+    (http_server.root / 'manifest.safe').write_bytes(b'manifest')
+    url = http_server.url + '/manifest.safe'
+    assert cache.fetch_cached(url) == b'manifest'
+    assert cache.fetch_cached(url) == b'manifest'
+    assert http_server.requests == [('/manifest.safe', None)]
+
+    # Stale entries are revalidated with their ETag
+    http_server.requests[:] = []
+    assert cache.fetch_cached(url, max_age=0) == b'manifest'
+    (http_server.root / 'manifest.safe').write_bytes(b'changed')
+    assert cache.fetch_cached(url, max_age=0) == b'changed'
+    assert cache.fetch_cached(url) == b'changed'
+    assert len(http_server.requests) == 2
+    conn = cache._connect_cache()
+    assert conn.execute('SELECT etag FROM entries').fetchall() == [
+        ('"{}"'.format(hashlib.md5(b'changed').hexdigest()),)]
+
+
+def test_metadata_cache_evicts_least_recently_used(http_server, monkeypatch):
+    monkeypatch.setattr(cache, 'METADATA_CACHE_MAX_BYTES', 2500)
+    urls = []
+    for idx in range(4):
+        (http_server.root / 'f{}'.format(idx)).write_bytes(os.urandom(1000))
+        urls.append(http_server.url + '/f{}'.format(idx))
+    cache.fetch_cached(urls[0])
+    cache.fetch_cached(urls[1])
+    cache.fetch_cached(urls[0])
+    cache.fetch_cached(urls[2])
+    cache.fetch_cached(urls[3])
+    conn = cache._connect_cache()
+    cached = sorted(url for url, in conn.execute('SELECT url FROM entries'))
+    assert cached == [urls[2], urls[3]]
+    assert conn.execute('SELECT sum(size) FROM entries').fetchone() == (2000,)
+
+
+def test_sentinel2_metadata_from_cache(http_server, tmp_path):
+    root, base_url = http_server.root, http_server.url
+    safe = 'S2A_MSIL1C_20170301T175000_N0204_R141_T13TDE_20170301T175000.SAFE'
+    _make_sentinel2_product(root, safe)
+    product_url = base_url + '/' + safe
+    assert sentinel2.get_sentinel2_image(product_url, str(tmp_path / 'a'),
+                                         noinspire=True, reject_old=True)
+    http_server.requests[:] = []
+    assert sentinel2.get_sentinel2_image(product_url, str(tmp_path / 'b'),
+                                         noinspire=True, reject_old=True)
+    requested = [path for path, _ in http_server.requests]
+    assert '/{}/manifest.safe'.format(safe) not in requested
+    assert '/{}/INSPIRE.xml'.format(safe) not in requested
+    assert (tmp_path / 'b' / safe / 'INSPIRE.xml').exists()
+
+
+def test_landsat_band_subset(http_server, tmp_path):
+    img = 'LC08_L1TP_034032_20170301_20170316_01_T1'
+    bands = ['B1.TIF', 'B4.TIF', 'B5.TIF', 'BQA.TIF', 'ANG.txt', 'MTL.txt']
+    _make_landsat_scene(http_server.root, img, bands)
+    url = http_server.url + '/' + img
+    outputdir = str(tmp_path)
+    landsat.get_landsat_image(url, outputdir, sat='OLI_TIRS', bands=['b04'])
+    assert sorted(os.listdir(os.path.join(outputdir, img))) == sorted(
+        img + '_' + band for band in ['B4.TIF', 'ANG.txt', 'MTL.txt'])
+    assert ledger.product_bands(outputdir, img) == ['B4']
+
+    # Bands that were downloaded before need no requests
+    http_server.requests[:] = []
+    assert landsat.plan_landsat_image(url, outputdir, sat='OLI_TIRS',
+                                      bands=['B4']) == []
+    landsat.get_landsat_image(url, outputdir, sat='OLI_TIRS',
+                              bands=['B5', 'BQA'])
+    requested = sorted(path for path, _ in http_server.requests)
+    assert requested == ['/{}/{}_{}'.format(img, img, band)
+                         for band in ['B5.TIF', 'BQA.TIF']]
+    assert ledger.product_bands(outputdir, img) == ['B4', 'B5', 'BQA']
+    landsat.get_landsat_image(url, outputdir, sat='OLI_TIRS')
+    assert ledger.product_bands(outputdir, img) is None
+    assert len(os.listdir(os.path.join(outputdir, img))) == len(bands)
+
+
+def test_sentinel2_band_subset(http_server, tmp_path):
+    root, base_url = http_server.root, http_server.url
+    safe = 'S2A_MSIL1C_20170301T175000_N0204_R141_T13TDE_20170301T175000.SAFE'
+    data = _make_sentinel2_product(root, safe)
+    manifest = (root / safe / 'manifest.safe').read_bytes()
+    objects = sentinel2.manifest_data_objects(manifest)
+    assert [obj['href'] for obj in objects] == ['./' + p for p in data]
+    assert {obj['size'] for obj in objects} == {500}
+
+    outputdir = str(tmp_path)
+    assert sentinel2.get_sentinel2_image(base_url + '/' + safe, outputdir,
+                                         noinspire=True, bands=['B4', 'B8'])
+    downloaded = sorted(
+        os.path.relpath(os.path.join(dpath, fname), os.path.join(outputdir, safe))
+        for dpath, _, fnames in os.walk(os.path.join(outputdir, safe))
+        for fname in fnames)
+    expected = [p for p in data if not p.endswith('.jp2') or
+                p.endswith(('_B04.jp2', '_B08.jp2'))] + ['manifest.safe']
+    assert downloaded == sorted(expected)
+    assert ledger.product_bands(outputdir, safe) == ['B04', 'B08']
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Tests and benchmark of the partial tile check on synthetic band images.
+
+Run with ``pytest tests/test_full_tile.py -s`` to see the timings.
+"""
+import time
+import numpy as np
+import pytest
+from fels import sentinel2
+
+gdal = pytest.importorskip('osgeo.gdal')
+
+
+def _legacy_check_full_tile(image):
+    # The per-pixel loop that check_full_tile replaced, kept for comparison
+    gdalData = gdal.Open(image)
+    xsize = gdalData.RasterXSize
+    ysize = gdalData.RasterYSize
+    raster = gdalData.GetRasterBand(1).ReadAsArray()
+    count = {}
+    for col in range(xsize):
+        for row in range(ysize):
+            cell_value = raster[row, col]
+            if cell_value == 0:
+                if cell_value in count:
+                    count[cell_value] += 1
+                else:
+                    count[cell_value] = 1
+                break
+    for key in sorted(count.keys()):
+        if count[key] is not None:
+            return 'Partial'
+
+
+def _write_band(fpath, data, driver='GTiff', overviews=False):
+    ysize, xsize = data.shape
+    if driver == 'GTiff':
+        dset = gdal.GetDriverByName('GTiff').Create(
+            fpath, xsize, ysize, 1, gdal.GDT_UInt16,
+            options=['TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256'])
+        dset.GetRasterBand(1).WriteArray(data)
+        if overviews:
+            dset.BuildOverviews('NEAREST', [2, 4, 8])
+        dset = None
+    else:
+        mem = gdal.GetDriverByName('MEM').Create(
+            '', xsize, ysize, 1, gdal.GDT_UInt16)
+        mem.GetRasterBand(1).WriteArray(data)
+        jp2_driver = gdal.GetDriverByName(driver)
+        if jp2_driver is None:
+            pytest.skip('GDAL has no {} driver'.format(driver))
+        jp2_driver.CreateCopy(fpath, mem, options=['QUALITY=100',
+                                                   'REVERSIBLE=YES'])
+    return fpath
+
+
+def _synthetic_tiles(size=1024):
+    full = np.ones((size, size), dtype=np.uint16)
+    # The swath edge cuts off a corner of the tile
+    rows, cols = np.mgrid[:size, :size]
+    edge = full.copy()
+    edge[rows + cols < size // 2] = 0
+    single = full.copy()
+    single[size - 1, size - 1] = 0
+    return {'full': full, 'edge': edge, 'single': single}
+
+
+@pytest.mark.parametrize('driver', ['GTiff', 'JP2OpenJPEG'])
+def test_check_full_tile_matches_legacy(tmp_path, driver):
+    ext = '.tif' if driver == 'GTiff' else '.jp2'
+    for name, data in _synthetic_tiles().items():
+        fpath = _write_band(str(tmp_path / (name + ext)), data, driver)
+
+        start = time.perf_counter()
+        expected = _legacy_check_full_tile(fpath)
+        legacy_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        got = sentinel2.check_full_tile(fpath)
+        new_time = time.perf_counter() - start
+
+        print('{} {}: legacy {:.4f}s, block-wise {:.4f}s ({:.0f}x)'.format(
+            driver, name, legacy_time, new_time, legacy_time / new_time))
+        assert got == expected
+        assert got == (None if name == 'full' else 'Partial')
+
+
+def test_check_full_tile_threshold(tmp_path):
+    tiles = _synthetic_tiles()
+    fraction = np.mean(tiles['edge'] == 0)
+    fpath = _write_band(str(tmp_path / 'edge.tif'), tiles['edge'])
+    assert sentinel2.check_full_tile(fpath, nodata_thresh=fraction / 2) == 'Partial'
+    assert sentinel2.check_full_tile(fpath, nodata_thresh=fraction * 2) is None
+    fpath = _write_band(str(tmp_path / 'single.tif'), tiles['single'])
+    assert sentinel2.check_full_tile(fpath, nodata_thresh=0.01) is None
+
+
+def test_check_full_tile_overviews(tmp_path):
+    tiles = _synthetic_tiles()
+    fpath = _write_band(str(tmp_path / 'edge.tif'), tiles['edge'],
+                        overviews=True)
+    assert sentinel2.check_full_tile(fpath, use_overviews=True) == 'Partial'
+    fpath = _write_band(str(tmp_path / 'full.tif'), tiles['full'],
+                        overviews=True)
+    assert sentinel2.check_full_tile(fpath, use_overviews=True) is None
+    # The smallest overview that is at least 256 pixels is 1/4 of the size
+    band = gdal.Open(fpath).GetRasterBand(1)
+    assert sentinel2._smallest_overview(band, 256).XSize == 256
+    assert sentinel2._smallest_overview(band, 2048) is band
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Short fels invocations must not pay for the geo stack.
+
+The import time budget can be changed with the FELS_IMPORT_BUDGET
+environment variable (seconds).
+"""
+import json
+import os
+import subprocess
+import sys
+
+# Modules that are only imported on the code paths that need them
+HEAVY_MODULES = ['geopandas', 'numpy', 'pandas', 'pkg_resources', 'shapely',
+                 'osgeo']
+
+IMPORT_BUDGET = float(os.environ.get('FELS_IMPORT_BUDGET', 0.5))
+
+
+def _run_python(code):
+    output = subprocess.check_output([sys.executable, '-c', code],
+                                     stderr=subprocess.DEVNULL)
+    return json.loads(output.decode('utf8').strip().splitlines()[-1])
+
+
+def test_import_does_not_load_heavy_modules():
+    loaded = _run_python(
+        'import json, sys\n'
+        'import fels\n'
+        'print(json.dumps(sorted(m for m in {!r} if m in sys.modules)))'.format(
+            HEAVY_MODULES))
+    assert loaded == []
+
+
+def test_version_does_not_load_heavy_modules():
+    loaded = _run_python(
+        'import json, sys\n'
+        'from fels.fels import main\n'
+        'try:\n'
+        '    main(["--version"])\n'
+        'except SystemExit:\n'
+        '    pass\n'
+        'print(json.dumps(sorted(m for m in {!r} if m in sys.modules)))'.format(
+            HEAVY_MODULES))
+    assert loaded == []
+
+
+def test_import_time_budget():
+    code = (
+        'import time\n'
+        'start = time.perf_counter()\n'
+        'import fels\n'
+        'print(time.perf_counter() - start)')
+    # The best of a few runs, to be robust against a busy machine
+    seconds = min(_run_python(code) for _ in range(3))
+    assert seconds < IMPORT_BUDGET, (
+        'import fels took {:.3f}s, the budget is {:.3f}s'.format(
+            seconds, IMPORT_BUDGET))
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+The footprint index lookup of convert_wkt_to_scene must give the same scenes
+as evaluating the predicates on every footprint.
+"""
+import json
+import subprocess
+import sys
+import numpy as np
+import pytest
+import geopandas
+import shapely.geometry
+from fels.footprints import FootprintIndex, build_footprint_index
+
+
+def _tile_grid(num=40, size=1.1):
+    # Overlapping square footprints, like the S2 tiles
+    tiles = [shapely.geometry.box(x, y, x + size, y + size)
+             for y in range(num) for x in range(num)]
+    names = ['{:02d}{:02d}'.format(x, y) for y in range(num) for x in range(num)]
+    return geopandas.GeoDataFrame({'Name': names}, geometry=tiles)
+
+
+def _random_features(rng, num=30):
+    feats = []
+    for _ in range(num):
+        x, y = rng.uniform(-2, 41, size=2)
+        feats.append(shapely.geometry.Point(x, y))
+        width, height = rng.uniform(0.01, 3, size=2)
+        feats.append(shapely.geometry.box(x, y, x + width, y + height))
+    return feats
+
+
+@pytest.mark.parametrize('include_overlap,thresh', [
+    (False, 0.0), (True, 0.0), (True, 0.2), (True, 0.6)])
+def test_scene_index_matches_full_scan(tmp_path, include_overlap, thresh):
+    gdf = _tile_grid()
+    build_footprint_index(gdf.geometry.values, gdf.Name.values, str(tmp_path))
+    index = FootprintIndex(str(tmp_path))
+    rng = np.random.RandomState(0)
+    for feat in _random_features(rng):
+        if include_overlap:
+            if thresh > 0:
+                overlap = gdf.geometry.intersection(feat).area / feat.area
+                expected = np.flatnonzero((overlap > thresh).values)
+            else:
+                expected = np.flatnonzero(gdf.geometry.intersects(feat).values)
+        else:
+            expected = np.flatnonzero(gdf.geometry.contains(feat).values)
+        got = index.query(feat, include_overlap, thresh)
+        assert got.tolist() == expected.tolist()
+        assert (index.find(feat, include_overlap, thresh) ==
+                gdf.Name.values[expected].tolist())
+
+
+def test_scene_index_does_not_need_gdal(tmp_path):
+    gdf = _tile_grid(num=4)
+    build_footprint_index(gdf.geometry.values, gdf.Name.values, str(tmp_path))
+    output = subprocess.check_output([sys.executable, '-c', (
+        'import json, sys\n'
+        'import shapely.geometry\n'
+        'from fels.footprints import FootprintIndex\n'
+        'index = FootprintIndex({!r})\n'
+        'names = index.find(shapely.geometry.Point(1.5, 1.5), False)\n'
+        'loaded = [m for m in ["geopandas", "osgeo", "pyogrio", "fiona"]\n'
+        '          if m in sys.modules]\n'
+        'print(json.dumps([names, loaded]))').format(str(tmp_path))])
+    names, loaded = json.loads(output.decode('utf8').strip().splitlines()[-1])
+    assert names == ['0101']
+    assert loaded == []
+
+
+def test_scene_index_keeps_integer_names(tmp_path):
+    gdf = _tile_grid(num=3)
+    codes = [int(name) + 100000 for name in gdf.Name]
+    build_footprint_index(gdf.geometry.values, codes, str(tmp_path))
+    index = FootprintIndex(str(tmp_path))
+    assert index.find(shapely.geometry.Point(0.5, 0.5), False) == [100000]
+
+
+def test_ensure_footprint_index(tmp_path, monkeypatch):
+    pytest.importorskip('pyogrio')
+    from fels import footprints
+    data_dpath = tmp_path / 'data'
+    data_dpath.mkdir()
+    _tile_grid(num=4).to_file(
+        str(data_dpath / 'sentinel_2_index_shapefile.shp'))
+    monkeypatch.setattr(footprints, 'DATA_DPATH', str(data_dpath))
+    monkeypatch.setattr(footprints, 'SHIPPED_FOOTPRINTS_DPATH',
+                        str(data_dpath / 'footprints'))
+    monkeypatch.setattr(footprints, 'FELS_DEFAULT_OUTPUTDIR',
+                        str(tmp_path / 'cache'))
+    monkeypatch.setattr(footprints, 'GLOBAL_FOOTPRINT_INDEXES', {})
+    point = shapely.geometry.Point(1.5, 1.5)
+
+    # Without a shipped index, one is built in the cache directory
+    index = footprints.ensure_footprint_index('S2')
+    assert index.dpath.startswith(str(tmp_path / 'cache'))
+    assert index.find(point, False) == ['0101']
+
+    # The shipped index is preferred
+    footprints.build_footprint_index_from_shapefile(
+        str(data_dpath / 'sentinel_2_index_shapefile.shp'), 'Name',
+        str(data_dpath / 'footprints' / 'sentinel_2_index_shapefile'))
+    monkeypatch.setattr(footprints, 'GLOBAL_FOOTPRINT_INDEXES', {})
+    index = footprints.ensure_footprint_index('S2')
+    assert index.dpath.startswith(str(data_dpath / 'footprints'))
+    assert index.find(point, False) == ['0101']
+
+
+@pytest.mark.parametrize('include_overlap,thresh', [
+    (False, 0.0), (True, 0.0), (True, 0.6)])
+def test_query_many_matches_query(tmp_path, include_overlap, thresh):
+    gdf = _tile_grid()
+    build_footprint_index(gdf.geometry.values, gdf.Name.values, str(tmp_path))
+    index = FootprintIndex(str(tmp_path))
+    feats = _random_features(np.random.RandomState(1)) + [None]
+    feat_idxs, idxs = index.query_many(feats, include_overlap, thresh)
+    for feat_idx, feat in enumerate(feats):
+        expected = ([] if feat is None else
+                    index.query(feat, include_overlap, thresh).tolist())
+        assert idxs[feat_idxs == feat_idx].tolist() == expected
+
+
+def test_convert_aois_to_scenes(tmp_path, monkeypatch):
+    from fels import fels
+    gdf = _tile_grid(num=10)
+    build_footprint_index(gdf.geometry.values, gdf.Name.values, str(tmp_path))
+    index = FootprintIndex(str(tmp_path))
+    monkeypatch.setattr(fels, 'ensure_footprint_index', lambda sat: index)
+    features = [
+        {'type': 'Feature', 'id': 'a', 'properties': {'field': 'x'},
+         'geometry': shapely.geometry.mapping(shapely.geometry.box(
+             1.2, 1.2, 3.5, 2.5))},
+        {'type': 'Feature', 'id': 'b', 'properties': {'field': 'y'},
+         'geometry': {'type': 'Point', 'coordinates': [2.5, 2.5]}},
+        {'type': 'Feature', 'id': 'c', 'properties': {'field': 'z'},
+         'geometry': None},
+    ]
+    collection = {'type': 'FeatureCollection', 'features': features}
+    fpath = str(tmp_path / 'aois.geojson')
+    with open(fpath, 'w') as file:
+        json.dump(collection, file)
+
+    for include_overlap in [False, True]:
+        aoi_scenes, scenes = fels.convert_aois_to_scenes(
+            'S2', collection, include_overlap)
+        assert sorted(aoi_scenes) == ['a', 'b', 'c']
+        for feature in features[:2]:
+            assert aoi_scenes[feature['id']] == fels.convert_wkt_to_scene(
+                'S2', feature['geometry'], include_overlap)
+        assert aoi_scenes['c'] == []
+        # The scenes of all areas, once each, in the order of the footprints
+        assert sorted(scenes) == sorted(set(aoi_scenes['a']) |
+                                        set(aoi_scenes['b']))
+        assert scenes == [name for name in gdf.Name if name in scenes]
+
+        # The same areas from a file and with ids from a property
+        from_file = fels.convert_aois_to_scenes(
+            'S2', fpath, include_overlap, id_field='field')
+        assert from_file == (
+            {'x': aoi_scenes['a'], 'y': aoi_scenes['b'], 'z': []}, scenes)
+
+
+def test_cover_selects_fewer_scenes(tmp_path):
+    import shapely
+    gdf = _tile_grid(num=20, size=2.5)
+    build_footprint_index(gdf.geometry.values, gdf.Name.values, str(tmp_path))
+    index = FootprintIndex(str(tmp_path))
+    rng = np.random.RandomState(2)
+    feats = _random_features(rng, num=10) + [
+        shapely.geometry.LineString([(0.5, 0.5), (7.5, 3.2)]),
+        shapely.geometry.box(2.2, 3.7, 12.9, 9.1)]
+    for feat in feats:
+        intersecting = index.query(feat, True)
+        idxs, covered = index.cover(feat)
+        assert set(idxs.tolist()) <= set(intersecting.tolist())
+        union = shapely.union_all(index.geometries(idxs))
+        inside = feat.intersection(shapely.geometry.box(0, 0, 21.5, 21.5))
+        if feat.area > 0:
+            assert inside.difference(union).area < 1e-9
+            assert covered == pytest.approx(inside.area / feat.area)
+        else:
+            assert inside.is_empty or union.covers(inside)
+    # Every other tile in each direction is enough
+    idxs, covered = index.cover(feats[-1])
+    assert covered == pytest.approx(1.0)
+    assert len(idxs) * 2 < len(index.query(feats[-1], True))
+
+
+def test_concurrent_index_builds(tmp_path):
+    import concurrent.futures
+    gdf = _tile_grid(num=4)
+    dpath = str(tmp_path / 'index')
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        list(executor.map(lambda _: build_footprint_index(
+            gdf.geometry.values, gdf.Name.values, dpath), range(8)))
+    # Each build used a directory of its own, and none is left behind
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['index']
+    index = FootprintIndex(dpath)
+    assert index.find(shapely.geometry.Point(0.5, 0.5), False, 0) == ['0000']
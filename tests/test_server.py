@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of ``fels serve`` and ``fels --server``, mostly with a stand-in for
+the catalogue queries.
+"""
+import concurrent.futures
+import contextlib
+import datetime
+import socket
+import subprocess
+import sys
+import time
+import pytest
+import fels
+from fels import server as fels_server
+from fels import fels as fels_cli
+
+
+# Serves with a stand-in for the catalogue queries, which prints the
+# directory it runs in
+SERVER_CODE = """
+import datetime, os, sys
+from fels import fels, server
+
+def _run_fels(options):
+    if options.scene == 'broken':
+        raise ValueError('broken scene')
+    print('Searching for {} in {}'.format(options.scene, os.getcwd()))
+    if options.dates:
+        return [datetime.date(2018, 1, 2), datetime.date(2018, 1, 5)]
+    return ['gs://bucket/{}_1'.format(options.scene),
+            'gs://bucket/{}_2'.format(options.scene)]
+
+fels._run_fels = _run_fels
+server.make_server(sys.argv[1]).serve_forever()
+"""
+
+# Serves real queries
+REAL_SERVER_CODE = """
+import sys
+from fels import server
+server.make_server(sys.argv[1]).serve_forever()
+"""
+
+
+def _free_address():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    address = '127.0.0.1:{}'.format(sock.getsockname()[1])
+    sock.close()
+    return address
+
+
+@contextlib.contextmanager
+def _server_process(code):
+    address = _free_address()
+    proc = subprocess.Popen([sys.executable, '-c', code, address])
+    try:
+        for _ in range(100):
+            status = fels_server.server_status(address)
+            if status is not None:
+                break
+            time.sleep(0.1)
+        assert status is not None, 'the server did not start'
+        yield address, proc
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+@pytest.fixture
+def running_server(monkeypatch):
+    with _server_process(SERVER_CODE) as (address, proc):
+        monkeypatch.setattr(fels_server, 'DEFAULT_SERVER_ADDRESS', address)
+        yield address, proc
+
+
+@pytest.fixture
+def fake_run(monkeypatch):
+    # Stand-in for local runs
+    calls = []
+
+    def _run_fels(options):
+        calls.append(options.scene)
+        return ['gs://bucket/{}_1'.format(options.scene)]
+
+    monkeypatch.setattr(fels_cli, '_run_fels', _run_fels)
+    return calls
+
+
+def test_server_status(running_server):
+    address, proc = running_server
+    status = fels_server.server_status(address)
+    assert status['version'] == fels.__version__
+    assert status['pid'] == proc.pid
+    assert not status['busy']
+
+
+def test_forward_cli(running_server, fake_run, tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    code = fels_cli.main(['52SDG', 'S2', '2018-01-01', '2018-02-01', '-l',
+                          '--server'])
+    assert code == 0
+    # The server ran in the directory of the client
+    assert capsys.readouterr().out.splitlines() == [
+        'Searching for 52SDG in {}'.format(tmp_path),
+        'gs://bucket/52SDG_1', 'gs://bucket/52SDG_2']
+    assert fake_run == []
+
+
+def test_run_fels_on_server(running_server):
+    urls = fels_server.run_fels_on_server('52SDG', 'S2', '2018-01-01',
+                                          '2018-02-01', list=True)
+    assert urls == ['gs://bucket/52SDG_1', 'gs://bucket/52SDG_2']
+    dates = fels_server.run_fels_on_server('52SDG', 'S2', '2018-01-01',
+                                           '2018-02-01', list=True,
+                                           dates=True)
+    assert dates == [datetime.date(2018, 1, 2), datetime.date(2018, 1, 5)]
+
+
+def test_server_survives_errors(running_server, capsys):
+    address, _ = running_server
+    with pytest.raises(RuntimeError, match='broken scene'):
+        fels_server.run_fels_on_server('broken', 'S2', list=True)
+    code = fels_cli.main(['broken', 'S2', '2018-01-01', '2018-02-01', '-l',
+                          '--server'])
+    assert code == 1
+    assert 'ValueError: broken scene' in capsys.readouterr().err
+    assert fels_server.server_status(address) is not None
+
+
+def test_runs_locally_without_server(fake_run, monkeypatch, capsys):
+    address = _free_address()
+    monkeypatch.setattr(fels_server, 'DEFAULT_SERVER_ADDRESS', address)
+    fels_cli.main(['52SDG', 'S2', '2018-01-01', '2018-02-01', '-l',
+                   '--server'])
+    out = capsys.readouterr().out
+    assert 'No fels server is running at {}'.format(address) in out
+    assert 'gs://bucket/52SDG_1' in out
+    assert fake_run == ['52SDG']
+
+
+def test_server_runs_catalogue_queries(tmp_path):
+    # The cached sqlite connection is used by the handler thread of each
+    # request
+    header = ['GRANULE_ID', 'MGRS_TILE', 'SENSING_TIME', 'CLOUD_COVER',
+              'BASE_URL']
+    urls = []
+    lines = [','.join(header)]
+    for day, cloud_cover in [(2, 10.0), (5, 80.0), (9, 30.0)]:
+        safe = 'S2A_MSIL1C_201801{:02d}T020000_N0206_R031_T52SDG_201801{:02d}T050000.SAFE'.format(day, day)
+        url = 'gs://gcp-public-data-sentinel-2/tiles/52/S/DG/' + safe
+        lines.append(','.join([
+            'L1C_T52SDG_{}'.format(day), '52SDG',
+            '2018-01-{:02d}T02:00:00.000Z'.format(day), str(cloud_cover), url]))
+        urls.append(url.replace('gs://', 'http://storage.googleapis.com/'))
+    (tmp_path / 'index_Sentinel.csv').write_text('\n'.join(lines) + '\n')
+    with _server_process(REAL_SERVER_CODE) as (address, _):
+        # The handler threads of concurrent requests are alive at the same
+        # time, so they cannot share the thread id of the connection
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            results = list(executor.map(
+                lambda _: fels_server.run_fels_on_server(
+                    '52SDG', 'S2', '2018-01-01', '2018-02-01', cloudcover=50,
+                    list=True, outputcatalogs=str(tmp_path), address=address),
+                range(4)))
+        assert results == [[urls[0], urls[2]]] * 4
+        dates = fels_server.run_fels_on_server(
+            '52SDG', 'S2', '2018-01-01', '2018-02-01', list=True, dates=True,
+            latest=True, outputcatalogs=str(tmp_path), address=address)
+        assert dates == [datetime.date(2018, 1, 9)]
+        assert fels_server.server_status(address)['sqlite_connections'] == 1